@@ -0,0 +1,68 @@
+# api/analytics.py
+# Дневные агрегаты событий мини-приложения из elaj/analytics.py: события и уникальные
+# пользователи, топ комплексов/районов, переходы воронки (open_estate>ask_bot_estate и т.д.).
+#   GET /api/analytics?days=1[&day=YYYYMMDD][&estate=Orbi City][&district=Новый бульвар]
+# Нужен ELAJ_ANALYTICS_TOKEN (или ELAJ_METRICS_TOKEN) и заголовок "Authorization: Bearer <token>"
+# (без токена в окружении эндпоинт отвечает 401). Токен в query string не принимается.
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import os
+import re
+import json
+import hmac
+import logging
+
+from elaj import runtime
+from elaj.analytics import report
+
+logger = logging.getLogger("analytics")
+
+ANALYTICS_TOKEN = os.environ.get("ELAJ_ANALYTICS_TOKEN") or os.environ.get("ELAJ_METRICS_TOKEN", "")
+MAX_DAYS = 31
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        if not self._authorized():
+            self._send_response(401, {"error": "Unauthorized"})
+            return
+
+        try:
+            days = min(max(int(query.get("days", ["1"])[0]), 1), MAX_DAYS)
+        except ValueError:
+            self._send_response(400, {"error": "days must be an integer"})
+            return
+        day = query.get("day", [None])[0]
+        if day is not None and not re.fullmatch(r"\d{8}", day):
+            self._send_response(400, {"error": "day must be YYYYMMDD"})
+            return
+
+        try:
+            result = runtime.run(report(
+                days, day,
+                estate=query.get("estate", [None])[0],
+                district=query.get("district", [None])[0],
+            ))
+            self._send_response(200, result)
+        except Exception as e:
+            logger.error(f"Analytics report failed: {e}")
+            self._send_response(500, {"error": str(e)})
+
+    def _authorized(self) -> bool:
+        if not ANALYTICS_TOKEN:
+            # Без токена эндпоинт закрыт: открытые метрики видны всем
+            logger.warning("ELAJ_ANALYTICS_TOKEN is not set, request denied")
+            return False
+        header = self.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return False
+        token = header[7:]
+        # Байты, а не str: compare_digest падает с TypeError на не-ASCII строках
+        return hmac.compare_digest(token.encode("utf-8"), ANALYTICS_TOKEN.encode("utf-8"))
+
+    def _send_response(self, status, response_dict):
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(json.dumps(response_dict, ensure_ascii=False).encode())
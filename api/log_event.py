@@ -1,13 +1,15 @@
 # api/log_event.py
 from http.server import BaseHTTPRequestHandler
 import json
-import os
-import redis
 from datetime import datetime
 import logging
-logger = logging.getLogger("log_event")
 
-redis_client = redis.from_url(os.environ.get("REDIS_URL"), decode_responses=True)
+from elaj import runtime
+from elaj import analytics
+from elaj.storage import redis_client
+from elaj.events import queue_event
+
+logger = logging.getLogger("log_event")
 
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
@@ -25,48 +27,14 @@ class handler(BaseHTTPRequestHandler):
         
         try:
             data = json.loads(post_data)
-            user_id = data.get('user_id')
-            
-            if not user_id:
-                self._send_response(400, {"error": "No user_id"})
-                return
-
-            profile_key = f"user_profile:{user_id}"
-
-            event_type = data.get('event_type', 'unknown')
-
-            # Если тип сообщения calculator_budget_stats — сохраняем в user_stats по под-ключам (для данного пользователя)
-            if event_type == "calculator_budget_stats":
-                details = data.get('details', {})
-                for key, value in details.items():
-                    redis_client.hset(f"user_stats:{user_id}", f"calc_{key}", value)
-
-
-            redis_client.rpush(f"user_events:{user_id}", json.dumps(data))
-            logger.info(f"Logged event for user {user_id}: {event_type}")
-
-            if event_type == 'create_profile' and user_id != 'UNRECOGNISED_USER':
-                if not redis_client.exists(profile_key):
-                    user_info = data.get('details', {}).get('user_info', {})
-                    if user_info:
-                        redis_client.hset(profile_key, mapping={
-                            "username": user_info.get('username', ''),
-                            "first_name": user_info.get('first_name', ''),
-                            "last_name": user_info.get('last_name', ''),
-                            "language_code": user_info.get('language_code', 'ru'),
-                            "fetched": datetime.now().isoformat()
-                        })
-                        redis_client.expire(profile_key, 60 * 24 * 3600)  # 60 дней
-                    else:
-                        # Если user_info пустой — логируем, но не создаём
-                        print(f"Warning: Empty user_info for {user_id}")
-
-            # Увеличиваем счетчик событий для данного типа и пользователя, устанавливаем время жизни на _ дней
-            redis_client.hincrby(f"user_stats:{user_id}", event_type, 1)
-            redis_client.expire(f"user_events:{user_id}", 60 * 24 * 3600)
-            redis_client.expire(f"user_stats:{user_id}", 60 * 24 * 3600)
-
-            self._send_response(200, {"status": "ok"})
+            # Redis-запросы выполняются асинхронно в общем event loop процесса
+            if isinstance(data, list) or (isinstance(data, dict) and 'events' in data):
+                # Пакет событий: [{...}, ...] или {"events": [{...}, ...]}
+                events = data if isinstance(data, list) else data['events']
+                status, response = runtime.run(log_events_batch(events))
+            else:
+                status, response = runtime.run(log_event(data))
+            self._send_response(status, response)
         
         except Exception as e:
             self._send_response(500, {"error": str(e)})
@@ -80,4 +48,166 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')  # на всякий случай
         self.end_headers()
-        self.wfile.write(json.dumps(response_dict).encode())
\ No newline at end of file
+        self.wfile.write(json.dumps(response_dict).encode())
+
+
+# Максимальный размер пакета событий в одном запросе
+MAX_BATCH = 200
+EVENT_TTL = 60 * 24 * 3600  # 60 дней
+
+
+def _normalize_event(data) -> tuple[dict | None, str | None]:
+    """Проверить событие и привести поля к ожидаемым типам: (событие, None) или (None, ошибка)"""
+    if not isinstance(data, dict):
+        return None, "Event must be an object"
+    user_id = data.get('user_id')
+    if not user_id:
+        return None, "No user_id"
+    if not isinstance(user_id, (str, int)) or isinstance(user_id, bool):
+        return None, "user_id must be a string or a number"
+    event_type = data.get('event_type') or 'unknown'
+    if not isinstance(event_type, str):
+        return None, "event_type must be a string"
+    details = data.get('details') or {}
+    if not isinstance(details, dict):
+        return None, "details must be an object"
+    # Район — к одному ключу: в разных событиях он приходит как district_key, district_name или district
+    details = analytics.normalize_district(details)
+    return {**data, 'user_id': str(user_id), 'event_type': event_type[:100], 'details': details}, None
+
+
+def _redis_value(value):
+    # Redis принимает только строки и числа; остальное (None, bool, списки) — как JSON
+    if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+async def _prefetch(events: list[dict]) -> tuple[set, dict]:
+    """Одним round-trip: user_id из create_profile-событий, для которых профиля ещё нет,
+    и district_key для событий, где район указан только именем (проставляются в events);
+    вторым значением — новые связки имя района -> ключ из пакета"""
+    user_ids = list({
+        data['user_id'] for data in events
+        if data.get('event_type') == 'create_profile' and data['user_id'] != 'UNRECOGNISED_USER'
+    })
+    districts = analytics.unknown_districts(events)
+    found = {}
+    if user_ids or districts:
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(f"user_profile:{user_id}")
+        if districts:
+            pipe.hmget(analytics.DISTRICT_KEYS, districts)
+        replies = await pipe.execute()
+        if districts:
+            found = {slug: key for slug, key in zip(districts, replies.pop()) if key}
+    else:
+        replies = []
+    links = analytics.resolve_districts(events, found)
+    return {user_id for user_id, exists in zip(user_ids, replies) if not exists}, links
+
+
+def _queue_log_event(pipe, data: dict, missing_profiles: set, touched: set, rollup_keys: set):
+    """Добавить в pipeline все записи одного события"""
+    user_id = data['user_id']
+    event_type = data['event_type']
+    details = data['details']
+
+    # Если тип сообщения calculator_budget_stats — сохраняем в user_stats по под-ключам (для данного пользователя)
+    if event_type == "calculator_budget_stats" and details:
+        pipe.hset(f"user_stats:{user_id}", mapping={f"calc_{key}": _redis_value(value) for key, value in details.items()})
+
+    # Сырое событие — в ограниченный стрим, строка сводки для бота — рендерится сразу
+    queue_event(pipe, user_id, event_type, details, json.dumps(data))
+
+    if event_type == 'create_profile' and user_id in missing_profiles:
+        user_info = details.get('user_info')
+        if user_info and isinstance(user_info, dict):
+            profile_key = f"user_profile:{user_id}"
+            pipe.hset(profile_key, mapping={
+                "username": _redis_value(user_info.get('username') or ''),
+                "first_name": _redis_value(user_info.get('first_name') or ''),
+                "last_name": _redis_value(user_info.get('last_name') or ''),
+                "language_code": _redis_value(user_info.get('language_code') or 'ru'),
+                "fetched": datetime.now().isoformat()
+            })
+            pipe.expire(profile_key, EVENT_TTL)  # 60 дней
+            missing_profiles.discard(user_id)
+        else:
+            # Если user_info пустой — логируем, но не создаём
+            print(f"Warning: Empty user_info for {user_id}")
+
+    # Увеличиваем счетчик событий для данного типа и пользователя
+    pipe.hincrby(f"user_stats:{user_id}", event_type, 1)
+    touched.add(user_id)
+
+    # Дневные агрегаты: счётчики, уникальные пользователи, переходы воронки (elaj/analytics.py)
+    analytics.queue_rollups(pipe, user_id, event_type, details, rollup_keys)
+
+
+async def _apply_events(events: list[dict]) -> list[str | None]:
+    """Записать события одним pipeline; для каждого события вернуть None или текст ошибки"""
+    missing_profiles, district_links = await _prefetch(events)
+
+    pipe = redis_client.pipeline(transaction=False)
+    touched = set()
+    rollup_keys = set()
+    spans = []
+    for data in events:
+        start = len(pipe)
+        _queue_log_event(pipe, data, missing_profiles, touched, rollup_keys)
+        spans.append((start, len(pipe)))
+
+    # Время жизни статистики продлеваем один раз на пользователя, а не на каждое событие
+    for user_id in touched:
+        pipe.expire(f"user_stats:{user_id}", EVENT_TTL)
+    analytics.queue_expire(pipe, rollup_keys)
+    analytics.queue_district_keys(pipe, district_links)
+
+    replies = await pipe.execute(raise_on_error=False)
+    errors = []
+    for start, end in spans:
+        failed = [r for r in replies[start:end] if isinstance(r, Exception)]
+        errors.append(str(failed[0]) if failed else None)
+    return errors
+
+
+async def log_event(data: dict):
+    """Сохранить одно событие мини-приложения, вернуть (HTTP-статус, тело ответа)"""
+    data, error = _normalize_event(data)
+    if error:
+        return 400, {"error": error}
+
+    error, = await _apply_events([data])
+    if error:
+        return 500, {"error": error}
+
+    logger.info(f"Logged event for user {data['user_id']}: {data['event_type']}")
+    return 200, {"status": "ok"}
+
+
+async def log_events_batch(events: list):
+    """Сохранить пакет событий одним pipeline; в ответе — статус по каждому событию"""
+    if not isinstance(events, list):
+        return 400, {"error": "events must be a list"}
+    if len(events) > MAX_BATCH:
+        return 413, {"error": f"Too many events (max {MAX_BATCH})"}
+
+    results = [None] * len(events)
+    valid = []
+    for i, data in enumerate(events):
+        data, error = _normalize_event(data)
+        if error:
+            results[i] = {"status": "error", "error": error}
+        else:
+            valid.append((i, data))
+
+    if valid:
+        errors = await _apply_events([data for _, data in valid])
+        for (i, _data), error in zip(valid, errors):
+            results[i] = {"status": "error", "error": error} if error else {"status": "ok"}
+
+    accepted = sum(1 for r in results if r["status"] == "ok")
+    logger.info(f"Logged batch: {accepted}/{len(events)} events")
+    return 200, {"status": "ok", "accepted": accepted, "results": results}
@@ -0,0 +1,57 @@
+# api/metrics.py
+# Тайминги стадий обработки сообщений (p50/p95/p99) и счётчики токенов из elaj/metrics.py.
+#   GET /api/metrics?days=1
+# Нужен ELAJ_METRICS_TOKEN и заголовок "Authorization: Bearer <token>" (без токена в окружении
+# эндпоинт отвечает 401). Токен в query string не принимается: он оседает в логах и истории.
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import os
+import json
+import hmac
+import logging
+
+from elaj import runtime
+from elaj.metrics import report
+
+logger = logging.getLogger("metrics")
+
+METRICS_TOKEN = os.environ.get("ELAJ_METRICS_TOKEN", "")
+MAX_DAYS = 7
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        if not self._authorized():
+            self._send_response(401, {"error": "Unauthorized"})
+            return
+
+        try:
+            days = min(max(int(query.get("days", ["1"])[0]), 1), MAX_DAYS)
+        except ValueError:
+            self._send_response(400, {"error": "days must be an integer"})
+            return
+
+        try:
+            self._send_response(200, runtime.run(report(days)))
+        except Exception as e:
+            logger.error(f"Metrics report failed: {e}")
+            self._send_response(500, {"error": str(e)})
+
+    def _authorized(self) -> bool:
+        if not METRICS_TOKEN:
+            # Без токена эндпоинт закрыт: открытые метрики видны всем
+            logger.warning("ELAJ_METRICS_TOKEN is not set, request denied")
+            return False
+        header = self.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return False
+        token = header[7:]
+        # Байты, а не str: compare_digest падает с TypeError на не-ASCII строках
+        return hmac.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8"))
+
+    def _send_response(self, status, response_dict):
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(json.dumps(response_dict, ensure_ascii=False).encode())
@@ -0,0 +1,555 @@
+# bench/load.py
+# Офлайн нагрузочный тест: webhook() и log_event.handler без сети.
+#   - Telegram Bot API — локальный HTTP-сервер-заглушка (задержка настраивается),
+#     он же отдаёт "фото" для проверки ссылок (HEAD);
+#   - OpenAI — детерминированный FakeRunner вместо agents.Runner (задержка модели,
+#     число вызовов инструментов, фото в ответе);
+#   - Redis — in-memory fakeredis (pip install "fakeredis[lua]") или локальный Redis (--redis-url).
+# Отчёт: пропускная способность, перцентили задержки, обращения к Redis и Bot API на сообщение,
+# число запусков модели (видно объединение сообщений), тайминги стадий из elaj/metrics.py.
+#
+#   python bench/load.py                                   # синтетика: 50 чатов × 4 сообщения
+#   python bench/load.py --chats 200 --concurrency 64 --model-latency 1.5 --tool-calls 2
+#   python bench/load.py --updates recorded_updates.jsonl --events recorded_events.jsonl
+#   python bench/load.py --redis-url redis://localhost:6379/15 --flush --json
+import os
+import sys
+import json
+import hashlib
+import time
+import zlib
+import random
+import asyncio
+import logging
+import argparse
+import threading
+import http.client
+from types import SimpleNamespace
+from collections import Counter
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUESTIONS = [
+    "Здравствуйте! Какие есть апартаменты у моря в Батуми?",
+    "Сколько стоит студия в Orbi City?",
+    "какая доходность от аренды?",
+    "Покажите фото комплекса",
+    "А есть что-то до 60 тысяч долларов?",
+    "Можно ли купить в рассрочку?",
+    "Какой район лучше для сдачи в аренду?",
+    "Спасибо!",
+]
+EVENTS = [
+    ("open_home", {}),
+    ("open_districts", {}),
+    ("focus_district", {"district_name": "Новый бульвар"}),
+    ("open_estate", {"estate_name": "Orbi City", "district_name": "Новый бульвар"}),
+    ("view_apartment", {"estate": "Orbi City", "district": "Новый бульвар"}),
+    ("calculator_budget_stats", {"budget_min": 45000, "budget_max": 90000, "budget_avg": 65000}),
+    ("ask_bot_estate", {"estate_name": "Orbi City"}),
+]
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+class BenchServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer с очередью соединений не меньше числа одновременных клиентов
+    (по умолчанию listen(5): при --concurrency 32 лишние соединения сбрасываются)"""
+    daemon_threads = True
+
+    def __init__(self, address, handler_class, backlog: int = 128):
+        self.request_queue_size = max(backlog, 128)
+        super().__init__(address, handler_class)
+
+
+# ===== Заглушка Telegram Bot API =====
+
+class FakeTelegram:
+    """Минимальный Bot API: отвечает на методы, которые вызывает бот, и считает вызовы"""
+
+    def __init__(self, latency: float, flood_every: int = 0, backlog: int = 128):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.sends = 0
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.message_id = 1000
+        self.server = BenchServer(("127.0.0.1", 0), self._handler_class(), backlog)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def next_message(self, chat_id, **extra) -> dict:
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    @staticmethod
+    def photo_sizes(media: str) -> list[dict]:
+        """Как у Telegram: file_id для загруженного по URL фото, при повторной отправке — тот же"""
+        file_id = media if not media.startswith("http") else "bench-" + hashlib.md5(media.encode()).hexdigest()[:16]
+        return [{"file_id": file_id, "file_unique_id": file_id[-12:], "width": 1280, "height": 853}]
+
+    def result(self, method: str, params: dict):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Elaj", "username": "elaj_bench_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method == "getChat":
+            return {"id": chat_id, "type": "private", "first_name": "Bench", "bio": "load test",
+                    "accent_color_id": 0, "max_reaction_count": 11}
+        if method == "sendChatAction":
+            return True
+        if method == "sendMediaGroup":
+            try:
+                media = [item.get("media", "") for item in json.loads(params.get("media", "[]"))]
+            except ValueError:
+                media = [""]
+            return [self.next_message(chat_id, photo=self.photo_sizes(item)) for item in media]
+        if method in ("sendMessage", "editMessageText"):
+            return self.next_message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            return self.next_message(chat_id, photo=self.photo_sizes(str(params.get("photo", ""))))
+        return True
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                # "Фото" для проверки ссылок в elaj/images.py
+                self.send_response(200 if self.path.startswith("/photos/") else 404)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+                method = self.path.rsplit("/", 1)[-1]
+                ctype = self.headers.get("Content-Type", "")
+                params = {}
+                if "json" in ctype:
+                    params = json.loads(body or b"{}")
+                elif "urlencoded" in ctype:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                with fake.lock:
+                    fake.calls[method] += 1
+                    # Каждый N-й send*/edit* — 429, как при флуд-контроле Telegram
+                    flood = False
+                    if fake.flood_every and method.startswith(("send", "edit")) and method != "sendChatAction":
+                        fake.sends += 1
+                        flood = fake.sends % fake.flood_every == 0
+                    if flood:
+                        fake.calls["429"] += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if flood:
+                    status, payload = 429, json.dumps({
+                        "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1},
+                    }).encode()
+                else:
+                    status, payload = 200, json.dumps({"ok": True, "result": fake.result(method, params)}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+# ===== Детерминированный Runner вместо OpenAI =====
+
+class FakeRunner:
+    """Подменяет agents.Runner в elaj/agent.py: задержка модели и инструментов, без сети"""
+
+    def __init__(self, model_latency: float, jitter: float, tool_calls: int, tool_latency: float,
+                 photo_every: int, photo_base: str):
+        self.model_latency = model_latency
+        self.jitter = jitter
+        self.tool_calls = tool_calls
+        self.tool_latency = tool_latency
+        self.photo_every = photo_every
+        self.photo_base = photo_base
+        self.runs = 0
+
+    async def _prepare(self, context):
+        """Вызовы инструментов и детерминированный ответ для входа"""
+        from elaj import metrics
+        from elaj.catalog import catalog_available, get_catalog
+
+        self.runs += 1
+        text = getattr(context, "workflow_input_as_text", "") or ""
+        # Одинаковый вход — одинаковый ответ и задержка (seed от текста, а не от порядка запусков)
+        rng = random.Random(zlib.crc32(text.encode("utf-8")))
+
+        items = []
+        for _ in range(self.tool_calls):
+            await asyncio.sleep(self.tool_latency)
+            if catalog_available():
+                with metrics.span("tool.search_catalog"):
+                    get_catalog().search(text[-200:])
+            raw = {"type": "function_call", "name": "search_catalog", "arguments": "{}"}
+            items.append(SimpleNamespace(type="tool_call_item", raw_item=raw, to_input_item=lambda raw=raw: raw))
+
+        photos = []
+        if self.photo_every and rng.randrange(self.photo_every) == 0:
+            photos = [f"{self.photo_base}/photos/{rng.randrange(500)}.jpg" for _ in range(rng.randint(1, 6))]
+        reply = "Ответ для нагрузочного теста. " * rng.randint(2, 20)
+        usage = SimpleNamespace(
+            input_tokens=len(text) // 3 + 1500, output_tokens=len(reply) // 3,
+            requests=1 + self.tool_calls, input_tokens_details=SimpleNamespace(cached_tokens=1024),
+        )
+        result = SimpleNamespace(
+            new_items=items,
+            context_wrapper=SimpleNamespace(usage=usage),
+            last_response_id=f"resp_bench_{self.runs}",
+            final_output_as=lambda cls: cls(photo_urls=photos, text=reply),
+        )
+        latency = max(0.0, rng.gauss(self.model_latency, self.jitter))
+        output = json.dumps({"photo_urls": photos, "text": reply}, ensure_ascii=False)
+        return result, latency, output
+
+    async def run(self, agent, input=None, run_config=None, context=None, previous_response_id=None, **kwargs):
+        result, latency, _output = await self._prepare(context)
+        await asyncio.sleep(latency)
+        return result
+
+    def run_streamed(self, agent, input=None, run_config=None, context=None, previous_response_id=None, **kwargs):
+        """Как Runner.run_streamed: stream_events() отдаёт response.created и дельты JSON-ответа,
+        задержка модели — первая треть до первого куска, остальное — между кусками"""
+        from openai.types.responses import ResponseTextDeltaEvent
+
+        streamed = SimpleNamespace()
+
+        async def stream_events():
+            result, latency, output = await self._prepare(context)
+            yield SimpleNamespace(type="raw_response_event", data=SimpleNamespace(type="response.created"))
+            await asyncio.sleep(latency / 3)
+            chunks = [output[i:i + 24] for i in range(0, len(output), 24)]
+            for chunk in chunks:
+                await asyncio.sleep(latency * 2 / 3 / len(chunks))
+                delta = ResponseTextDeltaEvent.model_construct(type="response.output_text.delta", delta=chunk)
+                yield SimpleNamespace(type="raw_response_event", data=delta)
+            vars(streamed).update(vars(result))
+
+        streamed.stream_events = stream_events
+        return streamed
+
+
+# ===== Подсчёт обращений к Redis =====
+
+class RedisOps:
+    """Команды и round-trip-ы к Redis (одиночная команда — 1/1, pipeline — N/1)"""
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def install(self):
+        from redis.asyncio.client import Redis, Pipeline
+        ops = self
+        execute_command = Redis.execute_command
+        pipeline_execute = Pipeline.execute
+
+        async def counted_command(client, *args, **options):
+            ops.commands += 1
+            ops.round_trips += 1
+            return await execute_command(client, *args, **options)
+
+        async def counted_pipeline(pipe, raise_on_error: bool = True):
+            if pipe.command_stack:
+                ops.commands += len(pipe.command_stack)
+                ops.round_trips += 1
+            return await pipeline_execute(pipe, raise_on_error)
+
+        Redis.execute_command = counted_command
+        Pipeline.execute = counted_pipeline
+
+    def snapshot(self) -> tuple[int, int]:
+        return self.commands, self.round_trips
+
+
+# ===== Нагрузка =====
+
+def synthetic_updates(args) -> list[tuple[float, dict]]:
+    """(время отправки, update): чаты стартуют равномерно за --ramp, сообщения чата — через --gap"""
+    rng = random.Random(args.seed)
+    updates = []
+    update_id = 10_000
+    for c in range(args.chats):
+        chat_id = 900_000 + c
+        start = rng.uniform(0, args.ramp)
+        user = {"id": chat_id, "is_bot": False, "first_name": f"User{c}", "username": f"user{c}", "language_code": "ru"}
+        for m in range(args.messages):
+            update_id += 1
+            text = "/start" if m == 0 and args.start else rng.choice(QUESTIONS)
+            updates.append((start + m * args.gap, {
+                "update_id": update_id,
+                "message": {"message_id": m + 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                            "from": user, "text": text},
+            }))
+    return sorted(updates, key=lambda x: x[0])
+
+
+def synthetic_events(args) -> list[dict]:
+    rng = random.Random(args.seed + 1)
+    events = []
+    for c in range(args.chats):
+        for _ in range(args.events_per_chat):
+            event_type, details = rng.choice(EVENTS)
+            events.append({"user_id": str(900_000 + c), "event_type": event_type, "details": details,
+                           "timestamp": time.time()})
+    return events
+
+
+def load_jsonl(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_webhook(updates: list[tuple[float, dict]], concurrency: int) -> tuple[list[float], int, float]:
+    """Отправить update в webhook() по расписанию (Flask test client), вернуть задержки и ошибки"""
+    from api.telegram_webhook import app
+
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    t0 = time.perf_counter()
+
+    def send(at: float, update: dict):
+        nonlocal errors
+        delay = at - (time.perf_counter() - t0)
+        if delay > 0:
+            time.sleep(delay)
+        started = time.perf_counter()
+        response = app.test_client().post("/api/telegram_webhook", json=update)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                errors += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for at, update in updates:
+            pool.submit(send, at, update)
+    return latencies, errors, time.perf_counter() - t0
+
+
+def replay_events(events: list[dict], concurrency: int, batch: int) -> tuple[list[float], int, float]:
+    """POST событий в log_event.handler, поднятый на локальном порту"""
+    from api.log_event import handler
+
+    class QuietHandler(handler):
+        def log_message(self, *args):
+            pass
+
+    server = BenchServer(("127.0.0.1", 0), QuietHandler, concurrency * 2)
+    threading.Thread(target=server.serve_forever, name="log-event", daemon=True).start()
+    port = server.server_address[1]
+
+    payloads = list(events) if batch <= 1 else [events[i:i + batch] for i in range(0, len(events), batch)]
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def post(payload):
+        nonlocal errors
+        body = json.dumps(payload).encode()
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            conn.request("POST", "/api/log_event", body=body, headers={"Content-Type": "application/json"})
+            status = conn.getresponse().status
+        except (OSError, http.client.HTTPException) as e:
+            # Сброс/таймаут соединения — ошибка запроса, а не повод прерывать прогон
+            logging.getLogger("bench").warning(f"log_event request failed: {e!r}")
+            status = None
+        finally:
+            conn.close()
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, payloads))
+    elapsed = time.perf_counter() - t0
+    server.shutdown()
+    return latencies, errors, elapsed
+
+
+def configure(args, telegram: FakeTelegram):
+    """Окружение до импорта elaj: все внешние вызовы идут в заглушки"""
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ["OPENAI_AGENTS_DISABLE_TRACING"] = "1"
+    os.environ["ELAJ_TELEGRAM_API_URL"] = f"{telegram.url}/bot"
+    os.environ["ELAJ_STREAM_REPLIES"] = "1" if args.stream else "0"
+    # Резюме и болтовня без вызовов OpenAI: извлекающее резюме, болтовня — к (поддельному) агенту
+    os.environ["ELAJ_SUMMARY_MODEL"] = ""
+    os.environ["ELAJ_ROUTER_MODEL"] = ""
+    os.environ["ELAJ_WEBHOOK_MODE"] = "inline"
+    os.environ["ELAJ_COALESCE_WINDOW"] = str(args.coalesce_window)
+    if args.no_cache:
+        os.environ["ELAJ_RESPONSE_CACHE"] = "0"
+    # Без --redis-url пул из REDIS_URL создаётся, но не используется
+    os.environ["REDIS_URL"] = args.redis_url or "redis://localhost:6379/0"
+
+    from elaj import storage
+    if not args.redis_url:
+        # In-memory Redis; модули elaj импортируют storage.redis_client уже после подмены
+        import fakeredis
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        storage.redis_client = client
+        storage._pool = client.connection_pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the webhook and log_event endpoints")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=4, help="messages per chat")
+    parser.add_argument("--gap", type=float, default=0.3, help="seconds between messages of one chat (bursts coalesce)")
+    parser.add_argument("--ramp", type=float, default=5.0, help="chats start uniformly over this many seconds")
+    parser.add_argument("--start", action="store_true", help="first message of every chat is /start")
+    parser.add_argument("--events-per-chat", type=int, default=10)
+    parser.add_argument("--event-batch", type=int, default=1, help="events per log_event request (1 = single-event API)")
+    parser.add_argument("--updates", help="JSONL of recorded Telegram updates (optional \"_at\" send offset, seconds)")
+    parser.add_argument("--events", help="JSONL of recorded log_event payloads")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--model-latency", type=float, default=1.0)
+    parser.add_argument("--model-jitter", type=float, default=0.3)
+    parser.add_argument("--tool-calls", type=int, default=1)
+    parser.add_argument("--tool-latency", type=float, default=0.05)
+    parser.add_argument("--photo-every", type=int, default=3, help="about one reply in N carries photos (0 = never)")
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--flood-every", type=int, default=0, help="every Nth Bot API send returns 429 retry_after=1")
+    parser.add_argument("--stream", action="store_true", help="streamed replies (ELAJ_STREAM_REPLIES=1)")
+    parser.add_argument("--coalesce-window", type=float, default=1.0)
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    parser.add_argument("--redis-url", help="use a real Redis instead of in-memory fakeredis")
+    parser.add_argument("--flush", action="store_true", help="FLUSHDB before the run (with --redis-url)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(args.telegram_latency, args.flood_every, args.concurrency * 4)
+    telegram.start()
+    configure(args, telegram)
+
+    from elaj import runtime, metrics
+    from elaj import agent as elaj_agent
+    from elaj.storage import redis_client
+
+    runner = FakeRunner(args.model_latency, args.model_jitter, args.tool_calls, args.tool_latency,
+                        args.photo_every, telegram.url)
+    elaj_agent.Runner = runner
+    ops = RedisOps()
+    ops.install()
+
+    if args.flush and args.redis_url:
+        runtime.run(redis_client.flushdb())
+    # Прогрев: event loop рантайма, Bot (getMe) и соединение с Redis не попадают в замеры
+    runtime.run(redis_client.ping())
+    runtime.run(runtime.get_bot())
+    runtime.ensure_openai()
+    telegram.calls.clear()
+
+    import api.telegram_webhook  # noqa: F401 — настраивает logging
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    if args.updates:
+        recorded = load_jsonl(args.updates)
+        updates = [(float(u.pop("_at", i * 0.05)), u) for i, u in enumerate(recorded)]
+    else:
+        updates = synthetic_updates(args)
+    events = load_jsonl(args.events) if args.events else synthetic_events(args)
+
+    report = {}
+
+    # События мини-приложения
+    before = ops.snapshot()
+    if events:
+        latencies, errors, elapsed = replay_events(events, args.concurrency, args.event_batch)
+        commands, round_trips = (a - b for a, b in zip(ops.snapshot(), before))
+        report["log_event"] = {
+            "events": len(events), "requests": len(latencies), "errors": errors,
+            "events_per_s": round(len(events) / elapsed, 1),
+            "latency": percentiles(latencies),
+            "redis_commands_per_event": round(commands / len(events), 2),
+            "redis_round_trips_per_event": round(round_trips / len(events), 2),
+        }
+
+    # Сообщения в webhook
+    before, telegram_before = ops.snapshot(), Counter(telegram.calls)
+    latencies, errors, elapsed = replay_webhook(updates, args.concurrency)
+    commands, round_trips = (a - b for a, b in zip(ops.snapshot(), before))
+    messages = len(updates)
+    telegram_calls = Counter(telegram.calls)
+    telegram_calls.subtract(telegram_before)
+    report["webhook"] = {
+        "messages": messages, "errors": errors, "elapsed_s": round(elapsed, 2),
+        "messages_per_s": round(messages / elapsed, 1),
+        "latency": percentiles(latencies),
+        "model_runs": runner.runs,
+        "model_runs_per_message": round(runner.runs / messages, 2),
+        "redis_commands_per_message": round(commands / messages, 2),
+        "redis_round_trips_per_message": round(round_trips / messages, 2),
+        "telegram_calls_per_message": {m: round(n / messages, 2) for m, n in sorted(telegram_calls.items()) if n},
+    }
+    report["stages"] = runtime.run(metrics.report(1))["stages"]
+
+    runtime.shutdown()
+    telegram.stop()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    for name in ("log_event", "webhook"):
+        if name not in report:
+            continue
+        print(f"== {name}")
+        for key, value in report[name].items():
+            print(f"  {key:<32} {value}")
+    print("== stages (ms)")
+    print(f"  {'stage':<24} {'count':>7} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for stage, s in report["stages"].items():
+        print(f"  {stage:<24} {s['count']:>7} {s['mean_ms'] or 0:>8} {s['p50_ms'] or 0:>8} "
+              f"{s['p95_ms'] or 0:>8} {s['p99_ms'] or 0:>8}")
+
+
+if __name__ == "__main__":
+    main()
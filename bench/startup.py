@@ -0,0 +1,105 @@
+# bench/startup.py
+# Время холодного импорта модулей (python -X importtime в отдельном процессе на каждый модуль).
+# Помогает следить, чтобы тяжёлые SDK не попадали обратно в путь холодного старта функций.
+#
+#   python bench/startup.py                      # таблица по умолчанию
+#   python bench/startup.py api.telegram_webhook --top 15
+#   python bench/startup.py --json               # для истории/CI
+#   python bench/startup.py --max-ms 400         # код выхода 1, если точка входа импортируется дольше
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Точки входа Vercel и модули, которые должны грузиться лениво
+DEFAULT_MODULES = [
+    "api.telegram_webhook",
+    "api.log_event",
+    "elaj.handler",
+    "elaj.agent",
+    "elaj.storage",
+    "flask",
+    "redis",
+    "telegram",
+    "openai",
+    "agents",
+    "pydantic",
+    "httpx",
+]
+
+
+def import_profile(module: str) -> dict:
+    """Импортировать модуль в чистом процессе; вернуть общее время и самые тяжёлые вложенные импорты"""
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    imports = []  # в порядке вывода: вложенные импорты идут перед родительским
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        head, cumulative_us, name = line.split("|", 2)
+        # вложенность импорта — отступ в имени (по 2 пробела на уровень)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(cumulative_us)))
+
+    error = None
+    if proc.returncode != 0:
+        error = (proc.stderr.strip().splitlines() or ["import failed"])[-1]
+    total = next((us for name, _depth, us in imports if name == module), 0)
+    return {"module": module, "ms": total / 1000, "error": error, "imports": imports}
+
+
+def top_imports(profile: dict, top: int) -> list[tuple[str, float]]:
+    """Самые тяжёлые прямые импорты модуля (по cumulative)"""
+    imports = profile["imports"]
+    position = next((i for i, (name, _d, _us) in enumerate(imports) if name == profile["module"]), None)
+    if position is None:
+        return []
+    depth = imports[position][1]
+    children = []
+    for name, child_depth, cumulative_us in reversed(imports[:position]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            children.append((name, cumulative_us / 1000))
+    return sorted(children, key=lambda x: -x[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import time per module")
+    parser.add_argument("modules", nargs="*", help=f"modules to profile (default: {', '.join(DEFAULT_MODULES)})")
+    parser.add_argument("--top", type=int, default=0, help="also list the N heaviest packages each module pulls in")
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    parser.add_argument("--max-ms", type=float, help="fail if the first module takes longer to import")
+    args = parser.parse_args()
+
+    modules = args.modules or DEFAULT_MODULES
+    profiles = [import_profile(module) for module in modules]
+
+    if args.json:
+        print(json.dumps([
+            {"module": p["module"], "ms": round(p["ms"], 1), "error": p["error"],
+             "top": [[name, round(ms, 1)] for name, ms in top_imports(p, args.top)]}
+            for p in profiles
+        ], ensure_ascii=False, indent=2))
+    else:
+        width = max(len(m) for m in modules)
+        for p in profiles:
+            status = f"  ({p['error']})" if p["error"] else ""
+            print(f"{p['module']:<{width}}  {p['ms']:8.1f} ms{status}")
+            for name, ms in top_imports(p, args.top):
+                print(f"{'':<{width}}    {name:<30} {ms:8.1f} ms")
+
+    if args.max_ms is not None and profiles[0]["ms"] > args.max_ms:
+        print(f"{profiles[0]['module']} import took {profiles[0]['ms']:.1f} ms > {args.max_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
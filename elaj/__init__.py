@@ -0,0 +1 @@
+# elaj: общие модули Telegram-бота Эладж (рантайм, хранилище, очереди)
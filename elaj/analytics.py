@@ -0,0 +1,300 @@
+# elaj/analytics.py
+# Агрегаты по событиям мини-приложения, которые считаются при записи (log_event),
+# чтобы вопросы вида "сколько уникальных пользователей сегодня открыли комплекс X,
+# а потом перешли в чат бота" не требовали обхода всех user_events:*.
+# На день (UTC) храним:
+#   elaj:an:{day}:events              hash event_type -> число событий
+#   elaj:an:{day}:users[:{event}]     HyperLogLog уникальных пользователей (всего / по типу)
+#   elaj:an:{day}:estate:{name}       hash event_type / "prev>next" -> число, :users — HLL,
+#                                     :funnel:{prev>next} — HLL перехода; то же для district
+#   elaj:an:{day}:estates / districts sorted set name -> число событий (топ)
+#   elaj:an:{day}:funnel              hash "prev>next" -> число переходов
+#   elaj:an:{day}:funnel:{prev>next}  HLL пользователей, прошедших переход
+#   elaj:an:{day}:steps:{user_id}     hash шагов пользователя за день (для переходов)
+#   elaj:an:district_keys             hash slug имени района -> district_key (из событий, где есть оба)
+# Район в агрегатах — всегда district_key: одни события приходят с ключом, другие только
+# с именем (district_name / district); имя переводится в ключ по district_keys, а пока связка
+# не известна — в slug имени (log_event: normalize_district, затем resolve_districts).
+# Все записи идут в pipeline события; чтение — фиксированное число команд на метрику.
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+ANALYTICS_ENABLED = os.environ.get("ELAJ_ANALYTICS", "1") == "1"
+ANALYTICS_TTL = int(os.environ.get("ELAJ_ANALYTICS_TTL", str(90 * 24 * 3600)))
+STEPS_TTL = 2 * 24 * 3600
+TOP_LIMIT = 10
+PREFIX = "elaj:an"
+ANONYMOUS = "UNRECOGNISED_USER"
+DISTRICT_KEYS = f"{PREFIX}:district_keys"
+
+# Переходы воронки: (предыдущий шаг, следующий, общий объект шагов или None)
+FUNNELS = [
+    ("open_districts", "focus_district", None),
+    ("focus_district", "open_estate", "district"),
+    ("open_estate", "view_apartment", "estate"),
+    ("open_estate", "ask_bot_estate", "estate"),
+    ("open_estate", "ask_manager_estate", "estate"),
+    ("view_apartment", "ask_bot_apartment", "estate"),
+    ("view_apartment", "ask_manager_apartment", "estate"),
+    ("open_calculator", "ask_bot_calc", None),
+    ("open_calculator", "ask_manager_calc", None),
+]
+
+# Посчитать переход, если предыдущий шаг пользователь уже сделал сегодня.
+# KEYS: шаги пользователя, счётчики переходов, HLL перехода, то же по объекту (hash объекта, HLL)
+# ARGV: поле предыдущего шага, переход, user_id, ttl, "1" — считать и по объекту
+_FUNNEL_SCRIPT = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then return 0 end
+redis.call('hincrby', KEYS[2], ARGV[2], 1)
+redis.call('pfadd', KEYS[3], ARGV[3])
+redis.call('expire', KEYS[3], ARGV[4])
+if ARGV[5] == '1' then
+  redis.call('hincrby', KEYS[4], ARGV[2], 1)
+  redis.call('pfadd', KEYS[5], ARGV[3])
+  redis.call('expire', KEYS[5], ARGV[4])
+end
+return 1
+"""
+# Шаги, с которых начинаются переходы (их отмечаем в elaj:an:{day}:steps:{user_id})
+_FUNNEL_STARTS = {prev for prev, _next, _scope in FUNNELS}
+
+
+def today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%d")
+
+
+def day_key(day: str, *parts) -> str:
+    return ":".join((PREFIX, day) + tuple(str(p) for p in parts))
+
+
+def district_slug(value) -> str:
+    """Ключ или имя района в одном виде: нижний регистр, пробелы и знаки -> "_" """
+    return re.sub(r"[\W_]+", "_", str(value).casefold()).strip("_")[:100]
+
+
+def normalize_district(details: dict) -> dict:
+    """Свести поля района события к district_key (slug ключа) и district_name (имя);
+    district_key без ключа в событии проставит resolve_districts"""
+    key = details.get("district_key")
+    name = details.get("district_name") or details.get("district")
+    if key is not None and not isinstance(key, (str, int)):
+        key = None
+    if name is not None and not isinstance(name, (str, int)):
+        name = None
+    normalized = {k: v for k, v in details.items() if k not in ("district_key", "district_name")}
+    if key and district_slug(key):
+        normalized["district_key"] = district_slug(key)
+    if name and str(name).strip():
+        normalized["district_name"] = str(name).strip()[:100]
+    return normalized
+
+
+def _district_links(events: list[dict]) -> dict[str, str]:
+    return {district_slug(d["details"]["district_name"]): d["details"]["district_key"]
+            for d in events if d["details"].get("district_key") and d["details"].get("district_name")}
+
+
+def unknown_districts(events: list[dict]) -> list[str]:
+    """slug имён районов из событий без ключа, которых нет и в связках этого же пакета"""
+    known = _district_links(events)
+    return list({district_slug(d["details"]["district_name"]) for d in events
+                 if d["details"].get("district_name") and not d["details"].get("district_key")} - set(known))
+
+
+def resolve_districts(events: list[dict], found: dict[str, str]) -> dict[str, str]:
+    """Проставить district_key событиям, где есть только имя района: по связкам из пакета,
+    затем из DISTRICT_KEYS (found — ответ HMGET по unknown_districts), иначе slug имени.
+    Возвращает новые связки пакета (для queue_district_keys)"""
+    links = _district_links(events)
+    known = {**found, **links}
+    for data in events:
+        details = data["details"]
+        if details.get("district_name") and not details.get("district_key"):
+            slug = district_slug(details["district_name"])
+            details["district_key"] = known.get(slug) or slug
+    return links
+
+
+def queue_district_keys(pipe, links: dict[str, str]):
+    """Запомнить связки имя района -> district_key"""
+    if ANALYTICS_ENABLED and links:
+        pipe.hset(DISTRICT_KEYS, mapping=links)
+
+
+async def district_key(name: str) -> str:
+    """district_key для среза отчёта: ключ или имя района"""
+    from elaj.storage import redis_client
+    slug = district_slug(name)
+    return await redis_client.hget(DISTRICT_KEYS, slug) or slug
+
+
+def event_scopes(details: dict) -> dict[str, str]:
+    """Комплекс и район события (район — district_key, см. normalize_district)"""
+    details = details or {}
+    district = details.get("district_key") or details.get("district_name") or details.get("district")
+    scopes = {
+        "estate": details.get("estate_name") or details.get("estate"),
+        "district": district_slug(district) if district else None,
+    }
+    return {scope: str(name)[:100] for scope, name in scopes.items() if name}
+
+
+def _step(event_type: str, scope: str | None, scopes: dict) -> str:
+    return f"{event_type}|{scopes[scope]}" if scope and scope in scopes else event_type
+
+
+def queue_rollups(pipe, user_id, event_type: str, details: dict, touched: set, day: str | None = None):
+    """Добавить в pipeline события агрегаты за день; touched — ключи, которым продлить TTL"""
+    if not ANALYTICS_ENABLED:
+        return
+    day = day or today()
+    user_id = str(user_id)
+    known_user = user_id != ANONYMOUS
+    scopes = event_scopes(details)
+
+    pipe.hincrby(day_key(day, "events"), event_type, 1)
+    touched.add(day_key(day, "events"))
+    if known_user:
+        pipe.pfadd(day_key(day, "users"), user_id)
+        pipe.pfadd(day_key(day, "users", event_type), user_id)
+        touched.update((day_key(day, "users"), day_key(day, "users", event_type)))
+
+    for scope, name in scopes.items():
+        pipe.hincrby(day_key(day, scope, name), event_type, 1)
+        pipe.zincrby(day_key(day, f"{scope}s"), 1, name)
+        touched.update((day_key(day, scope, name), day_key(day, f"{scope}s")))
+        if known_user:
+            pipe.pfadd(day_key(day, scope, name, "users"), user_id)
+            touched.add(day_key(day, scope, name, "users"))
+
+    if not known_user:
+        return
+    steps_key = day_key(day, "steps", user_id)
+    funnel_key = day_key(day, "funnel")
+    for prev, step, scope in FUNNELS:
+        if step != event_type:
+            continue
+        transition = f"{prev}>{step}"
+        scoped = bool(scope and scope in scopes)
+        scope_key = day_key(day, scope, scopes[scope]) if scoped else funnel_key
+        pipe.eval(
+            _FUNNEL_SCRIPT, 5,
+            steps_key, funnel_key, day_key(day, "funnel", transition), scope_key, f"{scope_key}:funnel:{transition}",
+            _step(prev, scope, scopes), transition, user_id, ANALYTICS_TTL, "1" if scoped else "",
+        )
+        touched.add(funnel_key)
+
+    if event_type in _FUNNEL_STARTS:
+        # Шаг отмечается и сам по себе, и с комплексом/районом — для переходов по объекту
+        pipe.hset(steps_key, mapping={event_type: 1, **{_step(event_type, scope, scopes): 1 for scope in scopes}})
+        pipe.expire(steps_key, STEPS_TTL)
+
+
+def queue_expire(pipe, touched: set):
+    """Продлить TTL агрегатов один раз на пакет событий"""
+    for key in touched:
+        pipe.expire(key, ANALYTICS_TTL)
+
+
+def _days(days: int, day: str | None = None) -> list[str]:
+    end = datetime.strptime(day, "%Y%m%d").replace(tzinfo=timezone.utc) if day else datetime.now(timezone.utc)
+    return [(end - timedelta(days=i)).strftime("%Y%m%d") for i in range(max(1, days))]
+
+
+def _sum_hashes(raws) -> dict[str, int]:
+    total: dict[str, int] = {}
+    for raw in raws:
+        for field, value in (raw or {}).items():
+            total[field] = total.get(field, 0) + int(value)
+    return total
+
+
+async def report(days: int = 1, day: str | None = None, estate: str | None = None, district: str | None = None) -> dict:
+    """Агрегаты за days дней (по day включительно): события, уникальные (HLL — объединение
+    за период), топ комплексов/районов, переходы воронки; estate/district — срез по объекту"""
+    from elaj.storage import redis_client
+    day_list = _days(days, day)
+    if district:
+        district = await district_key(district)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for d in day_list:
+        pipe.hgetall(day_key(d, "events"))
+    for d in day_list:
+        pipe.hgetall(day_key(d, "funnel"))
+    pipe.pfcount(*[day_key(d, "users") for d in day_list])
+    for d in day_list:
+        pipe.zrevrange(day_key(d, "estates"), 0, TOP_LIMIT * 2, withscores=True)
+    for d in day_list:
+        pipe.zrevrange(day_key(d, "districts"), 0, TOP_LIMIT * 2, withscores=True)
+    scoped = [(scope, name) for scope, name in (("estate", estate), ("district", district)) if name]
+    for scope, name in scoped:
+        for d in day_list:
+            pipe.hgetall(day_key(d, scope, name))
+        pipe.pfcount(*[day_key(d, scope, name, "users") for d in day_list])
+    results = await pipe.execute()
+
+    n = len(day_list)
+    events = _sum_hashes(results[:n])
+    funnel = _sum_hashes(results[n:2 * n])
+    users = results[2 * n]
+    tops = {}
+    for i, scope in enumerate(("estates", "districts")):
+        acc: dict[str, float] = {}
+        for rows in results[2 * n + 1 + i * n:2 * n + 1 + (i + 1) * n]:
+            for name, score in rows or []:
+                acc[name] = acc.get(name, 0) + score
+        tops[scope] = [{"name": name, "events": int(score)}
+                       for name, score in sorted(acc.items(), key=lambda kv: -kv[1])[:TOP_LIMIT]]
+    offset = 4 * n + 1
+    scoped_counts = {}
+    for scope, name in scoped:
+        scoped_counts[scope] = (_sum_hashes(results[offset:offset + n]), results[offset + n])
+        offset += n + 1
+
+    # Уникальные по типам событий и по переходам — вторым pipeline (поля известны из первого)
+    pipe = redis_client.pipeline(transaction=False)
+    for event_type in events:
+        pipe.pfcount(*[day_key(d, "users", event_type) for d in day_list])
+    for transition in funnel:
+        pipe.pfcount(*[day_key(d, "funnel", transition) for d in day_list])
+    for scope, name in scoped:
+        for field in scoped_counts[scope][0]:
+            if ">" in field:
+                pipe.pfcount(*[day_key(d, scope, name, "funnel", field) for d in day_list])
+    counts = iter(await pipe.execute())
+    event_users = {event_type: next(counts) for event_type in events}
+    funnel_users = {transition: next(counts) for transition in funnel}
+
+    def transitions(counters: dict, users: dict, from_users: dict | None) -> dict:
+        return {
+            transition: {
+                "count": count,
+                "unique_users": users.get(transition),
+                # Сколько уникальных сделали предыдущий шаг — для конверсии
+                **({"from_users": from_users.get(transition.split(">")[0])} if from_users is not None else {}),
+            }
+            for transition, count in sorted(counters.items())
+        }
+
+    scoped_results = {}
+    for scope, name in scoped:
+        counters, unique = scoped_counts[scope]
+        steps = {field: count for field, count in counters.items() if ">" in field}
+        scoped_results[scope] = {
+            "name": name,
+            "unique_users": unique,
+            "events": {field: count for field, count in sorted(counters.items()) if ">" not in field},
+            "funnel": transitions(steps, {field: next(counts) for field in counters if ">" in field}, None),
+        }
+
+    return {
+        "days": day_list,
+        "unique_users": users,
+        "events": {event_type: {"count": count, "unique_users": event_users.get(event_type)}
+                   for event_type, count in sorted(events.items())},
+        "top": tops,
+        "funnel": transitions(funnel, funnel_users, event_users),
+        **scoped_results,
+    }
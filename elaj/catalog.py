@@ -0,0 +1,265 @@
+# elaj/catalog.py
+# Каталог недвижимости (ajaria_realty_hierarchy.md) в памяти процесса.
+# Markdown разбирается один раз: каждый заголовок — узел иерархии
+# district → developer → estate → block → apartment, текст под ним — его описание
+# вместе с фото ("description" / "url"). Поиск — BM25 по узлам, плюс поиск по пути.
+# Заменяет удалённый FileSearchTool: ответ за доли миллисекунды и детерминированно.
+#
+# Каталог не хранится в репозитории. Файл кладётся в ELAJ_CATALOG_PATH перед деплоем
+# (python -m elaj.catalog --fetch) или скачивается процессом по ELAJ_CATALOG_URL при старте
+# (preload — вне event loop: webhook при импорте, воркер через to_thread); без него агент
+# работает с FileSearchTool (см. catalog_source).
+import os
+import re
+import json
+import math
+import logging
+import argparse
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.environ.get("ELAJ_CATALOG_PATH", "data/ajaria_realty_hierarchy.md")
+CATALOG_URL = os.environ.get("ELAJ_CATALOG_URL", "")
+# Куда процесс скачивает каталог, если его нет в сборке (в Vercel писать можно только в /tmp)
+CATALOG_CACHE_PATH = os.environ.get(
+    "ELAJ_CATALOG_CACHE_PATH", os.path.join(tempfile.gettempdir(), "ajaria_realty_hierarchy.md")
+)
+FETCH_TIMEOUT = 20
+LEVELS = ("district", "developer", "estate", "block", "apartment")
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_LEVEL_RE = re.compile(r"^\s*\**\s*(district|developer|estate|block|apartment)\b\s*[:\-—]?\s*", re.IGNORECASE)
+_PHOTO_RE = re.compile(
+    r'"?description"?\s*:\s*"(?P<description>[^"]*)".*?"?url"?\s*:\s*"(?P<url>https?://[^"]+)"'
+    r'|"?url"?\s*:\s*"(?P<url2>https?://[^"]+)".*?"?description"?\s*:\s*"(?P<description2>[^"]*)"',
+    re.DOTALL,
+)
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+STEM_CHARS = 6  # грубый стемминг: русские словоформы сводятся к первым 6 символам
+
+
+def tokenize(text: str) -> list[str]:
+    return [t[:STEM_CHARS] for t in _TOKEN_RE.findall(text.lower().replace("ё", "е"))]
+
+
+@dataclass
+class CatalogNode:
+    name: str
+    level: str
+    path: tuple[str, ...]
+    text: str = ""
+    photos: list[dict] = field(default_factory=list)
+
+    @property
+    def path_str(self) -> str:
+        return " / ".join(self.path)
+
+    def render(self, max_chars: int = 1500) -> str:
+        """Текст узла для агента: путь, описание и фото (тип определяется описанием/URL)"""
+        out = f"[{self.level}] {self.path_str}\n{self.text.strip()}"
+        if len(out) > max_chars:
+            out = out[:max_chars] + "…"
+        return out
+
+
+def parse_catalog(text: str) -> list[CatalogNode]:
+    """Разобрать markdown каталога в список узлов"""
+    nodes: list[CatalogNode] = []
+    stack: list[tuple[int, CatalogNode]] = []
+    body: list[str] = []
+
+    def flush():
+        if stack:
+            node = stack[-1][1]
+            node.text = "\n".join(body).strip()
+            node.photos = [
+                {
+                    "description": m.group("description") or m.group("description2") or "",
+                    "url": m.group("url") or m.group("url2"),
+                }
+                for m in _PHOTO_RE.finditer(node.text)
+            ]
+        body.clear()
+
+    for line in text.splitlines():
+        m = _HEADING_RE.match(line)
+        if not m:
+            body.append(line)
+            continue
+        flush()
+        depth = len(m.group(1))
+        title = m.group(2).strip().strip("*")
+        lm = _LEVEL_RE.match(title)
+        if lm:
+            level = lm.group(1).lower()
+            title = title[lm.end():].strip() or title
+        else:
+            level = LEVELS[min(depth, len(LEVELS)) - 1]
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        path = tuple(n.name for _, n in stack) + (title,)
+        node = CatalogNode(name=title, level=level, path=path)
+        stack.append((depth, node))
+        nodes.append(node)
+    flush()
+    return nodes
+
+
+class Catalog:
+    """Индекс каталога: BM25-поиск и поиск по пути иерархии"""
+
+    def __init__(self, nodes: list[CatalogNode], version: str = ""):
+        self.nodes = nodes
+        self.version = version
+        self._by_path = {self._norm_path(n.path): n for n in nodes}
+        self._docs = [Counter(tokenize(f"{n.path_str} {n.path_str} {n.text}")) for n in nodes]
+        self._lengths = [sum(d.values()) for d in self._docs]
+        self._avg_len = (sum(self._lengths) / len(self._lengths)) if nodes else 0.0
+        df = Counter()
+        for d in self._docs:
+            df.update(d.keys())
+        n = len(nodes)
+        self._idf = {t: math.log(1 + (n - f + 0.5) / (f + 0.5)) for t, f in df.items()}
+
+    @staticmethod
+    def _norm_path(path) -> tuple[str, ...]:
+        if isinstance(path, str):
+            path = re.split(r"\s*[/>→]\s*", path)
+        return tuple(p.strip().lower().replace("ё", "е") for p in path if p.strip())
+
+    def search(self, query: str, limit: int = 5, level: str | None = None) -> list[CatalogNode]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+        scored = []
+        for i, doc in enumerate(self._docs):
+            node = self.nodes[i]
+            if level and node.level != level:
+                continue
+            score = 0.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[i] / (self._avg_len or 1))
+            for t in terms:
+                tf = doc.get(t)
+                if tf:
+                    score += self._idf[t] * tf * (BM25_K1 + 1) / (tf + norm)
+            if score > 0:
+                scored.append((score, i))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return [self.nodes[i] for _, i in scored[:limit]]
+
+    def lookup(self, path) -> CatalogNode | None:
+        """Узел по полному пути ("Батуми / Застройщик / Комплекс") или по хвосту пути"""
+        key = self._norm_path(path)
+        if not key:
+            return None
+        node = self._by_path.get(key)
+        if node is not None:
+            return node
+        for full, candidate in self._by_path.items():
+            if full[-len(key):] == key:
+                return candidate
+        return None
+
+    def children(self, node: CatalogNode) -> list[CatalogNode]:
+        return [n for n in self.nodes if len(n.path) == len(node.path) + 1 and n.path[:-1] == node.path]
+
+
+_catalog: Catalog | None = None
+_fetched_path: str | None = None
+_fetch_attempted = False
+_lock = threading.RLock()
+
+
+def fetch_catalog(url: str = CATALOG_URL, dest: str = CATALOG_PATH) -> str:
+    """Скачать каталог по url в dest (через временный файл, чтобы не оставить обрезанный)"""
+    import httpx
+    response = httpx.get(url, timeout=FETCH_TIMEOUT, follow_redirects=True)
+    response.raise_for_status()
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    tmp = f"{dest}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp, dest)
+    return dest
+
+
+def catalog_path(fetch: bool = False) -> str | None:
+    """Файл каталога: ELAJ_CATALOG_PATH, иначе копия по ELAJ_CATALOG_URL.
+    Скачивание (fetch=True, раз на процесс) — синхронный HTTP, только вне event loop"""
+    global _fetched_path, _fetch_attempted
+    if os.path.exists(CATALOG_PATH):
+        return CATALOG_PATH
+    if not fetch or not CATALOG_URL:
+        return _fetched_path
+    with _lock:
+        if not _fetch_attempted:
+            _fetch_attempted = True
+            try:
+                if not os.path.exists(CATALOG_CACHE_PATH):
+                    fetch_catalog(CATALOG_URL, CATALOG_CACHE_PATH)
+                    logger.info(f"Catalog downloaded to {CATALOG_CACHE_PATH}")
+                _fetched_path = CATALOG_CACHE_PATH
+            except Exception as e:
+                logger.warning(f"Catalog download failed: {e}")
+    return _fetched_path
+
+
+def catalog_available() -> bool:
+    """Есть ли каталог (без скачивания — оно делается в preload при старте процесса)"""
+    return catalog_path() is not None
+
+
+def catalog_source() -> str:
+    """Какой поиск по каталогу у агента: локальный BM25 или FileSearchTool (для логов)"""
+    path = catalog_path()
+    return f"local BM25 ({path})" if path else f"hosted FileSearchTool (no catalog at {CATALOG_PATH})"
+
+
+def get_catalog() -> Catalog:
+    """Каталог процесса (разбирается один раз: в preload или при первом обращении)"""
+    global _catalog
+    if _catalog is None:
+        with _lock:
+            if _catalog is None:
+                from elaj.photo_index import catalog_version
+                with open(catalog_path() or CATALOG_PATH, encoding="utf-8") as f:
+                    text = f.read()
+                _catalog = Catalog(parse_catalog(text), version=catalog_version(text))
+                logger.info(f"Catalog {_catalog.version} loaded: {len(_catalog.nodes)} nodes")
+    return _catalog
+
+
+def preload() -> bool:
+    """При старте процесса, вне event loop: скачать каталог (если нужно) и разобрать его"""
+    if catalog_path(fetch=True) is None:
+        logger.info(f"Catalog search: {catalog_source()}")
+        return False
+    get_catalog()
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Download the catalog markdown for local search")
+    parser.add_argument("--fetch", action="store_true", help="download ELAJ_CATALOG_URL to --output")
+    parser.add_argument("--url", default=CATALOG_URL)
+    parser.add_argument("--output", default=CATALOG_PATH)
+    args = parser.parse_args()
+    if args.fetch:
+        if not args.url:
+            # Без адреса каталога — не ошибка: поиск остаётся на FileSearchTool
+            logger.warning("ELAJ_CATALOG_URL is not set, catalog not downloaded")
+        else:
+            fetch_catalog(args.url, args.output)
+    print(json.dumps({
+        "source": catalog_source(),
+        "nodes": len(get_catalog().nodes) if catalog_available() else 0,
+    }, ensure_ascii=False))
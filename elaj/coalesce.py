@@ -0,0 +1,168 @@
+# elaj/coalesce.py
+# Последовательная обработка сообщений одного чата с объединением "очередей" сообщений.
+# Пользователь часто пишет несколькими короткими сообщениями подряд; раньше каждое
+# запускало свой handle_message_async параллельно: гонки при записи истории и несколько
+# перекрывающихся ответов gpt-4.1.
+#
+# Теперь сообщение сначала кладётся в буфер чата elaj:pending:{chat_id}, а обрабатывает
+# буфер только владелец блокировки elaj:chatlock:{chat_id} (SET NX, общая для всех
+# процессов webhook и воркеров). Если в буфере уже несколько сообщений, владелец ждёт
+# короткое окно тишины; затем забирает все накопившиеся сообщения разом и запускает
+# агента один раз на всю пачку. Одиночное сообщение обрабатывается без ожидания.
+# Остальные вызовы только дописывают буфер и сразу возвращаются.
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+
+from elaj.storage import redis_client
+from elaj.handler import handle_message_async
+
+logger = logging.getLogger(__name__)
+
+COALESCE_ENABLED = os.environ.get("ELAJ_COALESCE", "1") == "1"
+COALESCE_WINDOW = float(os.environ.get("ELAJ_COALESCE_WINDOW", "1.0"))     # окно тишины, сек
+COALESCE_MAX_WAIT = float(os.environ.get("ELAJ_COALESCE_MAX_WAIT", "4"))   # дольше не ждём, даже если пишут
+LOCK_TTL = int(os.environ.get("ELAJ_CHAT_LOCK_TTL", "180"))                # если владелец упал
+PENDING_TTL = 600
+
+# Снять блокировку / продлить её, только если она всё ещё наша
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+_REFRESH_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end
+return 0
+"""
+
+
+def pending_key(chat_id) -> str:
+    return f"elaj:pending:{chat_id}"
+
+
+def lock_key(chat_id) -> str:
+    return f"elaj:chatlock:{chat_id}"
+
+
+def is_command(text: str) -> bool:
+    return text.strip().startswith("/")
+
+
+def merge_messages(batch: list[dict]) -> list[dict]:
+    """
+    Склеить подряд идущие сообщения в одно (ответ — на последнее из них).
+    Команды (/start) не склеиваются и обрабатываются по отдельности, в своём порядке.
+    """
+    merged: list[dict] = []
+    for msg in batch:
+        if merged and not is_command(msg["text"]) and not is_command(merged[-1]["text"]):
+            last = merged[-1]
+            last["text"] += "\n" + msg["text"]
+            last["message_id"] = msg["message_id"]
+            last["user"] = msg.get("user") or last["user"]
+        else:
+            merged.append(dict(msg))
+    return merged
+
+
+async def push_message(chat_id: int, text: str, message_id: int, user: dict):
+    """Дописать сообщение в буфер чата"""
+    entry = json.dumps({"chat_id": chat_id, "text": text, "message_id": message_id, "user": user or {},
+                        "ts": time.time()}, ensure_ascii=False)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.rpush(pending_key(chat_id), entry)
+    pipe.expire(pending_key(chat_id), PENDING_TTL)
+    await pipe.execute()
+
+
+async def _take(chat_id) -> list[dict]:
+    """Забрать весь буфер чата (атомарно)"""
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.lrange(pending_key(chat_id), 0, -1)
+    pipe.delete(pending_key(chat_id))
+    raw, _ = await pipe.execute()
+    batch = []
+    for item in raw or []:
+        try:
+            msg = json.loads(item)
+            msg.pop("ts", None)
+            batch.append(msg)
+        except Exception:
+            continue  # сломанная запись — пропускаем
+    return batch
+
+
+async def _wait_quiet(chat_id, refill) -> float:
+    """Ждать, пока с последнего сообщения в буфере не пройдёт COALESCE_WINDOW (но не дольше
+    COALESCE_MAX_WAIT); пустой буфер, одно сообщение или уже истёкшее окно — без ожидания.
+    Возвращает, сколько ждали, мс"""
+    if COALESCE_WINDOW <= 0:
+        return 0.0
+    started = time.monotonic()
+    first = True
+    while True:
+        if refill is not None:
+            await refill()
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.llen(pending_key(chat_id))
+        pipe.lindex(pending_key(chat_id), -1)
+        size, last = await pipe.execute()
+        # Одиночное сообщение отвечаем сразу: ждать окно ради возможного продолжения —
+        # значит задерживать каждый ответ. Дописанное во время ответа заберём следующей пачкой
+        if last is None or (first and size <= 1):
+            break
+        first = False
+        try:
+            quiet = time.time() - float(json.loads(last).get("ts", 0))
+        except Exception:
+            break
+        remaining = min(COALESCE_WINDOW - quiet, COALESCE_MAX_WAIT - (time.monotonic() - started))
+        if remaining <= 0:
+            break
+        await asyncio.sleep(remaining)
+    return (time.monotonic() - started) * 1000
+
+
+async def process_pending(chat_id, refill=None):
+    """
+    Обработать буфер чата, если блокировка чата свободна (иначе сообщения заберёт её владелец).
+    refill — корутина, дописывающая в буфер сообщения, полученные процессом за время ожидания
+    (воркер очереди передаёт сюда свою локальную очередь чата).
+    """
+    while True:
+        token = uuid.uuid4().hex
+        if not await redis_client.set(lock_key(chat_id), token, nx=True, ex=LOCK_TTL):
+            return
+        try:
+            # Окно тишины — только перед первой пачкой: пришедшее за время обработки
+            # и так ждало ответа дольше окна, забираем сразу
+            waited_ms = await _wait_quiet(chat_id, refill)
+            while True:
+                if refill is not None:
+                    await refill()
+                batch = await _take(chat_id)
+                if not batch:
+                    break
+                if len(batch) > 1:
+                    logger.info(f"Coalesced {len(batch)} messages for chat {chat_id}")
+                for args in merge_messages(batch):
+                    await redis_client.eval(_REFRESH_SCRIPT, 1, lock_key(chat_id), token, LOCK_TTL)
+                    await handle_message_async(**args, coalesce_wait_ms=waited_ms)
+                    waited_ms = None  # ожидание относим к первому ответу
+        finally:
+            await redis_client.eval(_RELEASE_SCRIPT, 1, lock_key(chat_id), token)
+        # Сообщение могло прийти между последним _take и снятием блокировки
+        if not await redis_client.llen(pending_key(chat_id)):
+            return
+
+
+async def submit_message(chat_id: int, text: str, message_id: int, user: dict):
+    """Принять сообщение: в буфер чата и, если чат свободен, обработать буфер"""
+    if not COALESCE_ENABLED:
+        await handle_message_async(chat_id=chat_id, text=text, message_id=message_id, user=user)
+        return
+    await push_message(chat_id, text, message_id, user)
+    await process_pending(chat_id)
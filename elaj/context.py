@@ -0,0 +1,227 @@
+# elaj/context.py
+# Загрузка и сохранение контекста чата за минимальное число обращений к Redis.
+# Все чтения перед запуском агента — один конвейер (pipeline),
+# все записи — одна транзакция (MULTI/EXEC) в ChatContext.commit().
+import os
+import json
+import time
+from dataclasses import dataclass, field
+
+from elaj.storage import redis_client
+from elaj.events import ACTIVITY_LIMIT, activity_key, calc_stats_key, last_estate_key
+from elaj.history import HISTORY_READ, HISTORY_TTL, history_key, legacy_history_key, make_entry, parse_entries, queue_append
+
+PROFILE_TTL = 12 * 30 * 24 * 3600   # TTL год
+PROFILE_HASH_TTL = 24 * 3600        # 24 часа
+CONVERSATION_TTL = int(os.environ.get("ELAJ_CONVERSATION_TTL", str(7 * 24 * 3600)))  # сколько продолжаем диалог по previous_response_id
+CONVERSATION_MAX_TURNS = int(os.environ.get("ELAJ_CONVERSATION_MAX_TURNS", "8"))  # дальше — заново, с резюме вместо цепочки
+RECENT_LIMIT = 15                   # последние 15 сообщений chat_history
+
+# Чаты, которым нужно обновить bio/дату рождения (bot.get_chat): chat_id -> когда поставлены в очередь.
+# Обрабатывается фоновым elaj/profile_refresh.py, а не при ответе на сообщение
+PROFILE_REFRESH_KEY = "elaj:profile_refresh"
+
+
+def profile_key(chat_id: int) -> str:
+    return f"user_profile:{chat_id}"
+
+
+def conversation_key(chat_id: int) -> str:
+    return f"elaj:conv:{chat_id}"
+
+
+def summary_key(chat_id: int) -> str:
+    return f"elaj:summary:{chat_id}"
+
+
+@dataclass
+class ChatContext:
+    """Всё, что нужно handle_message_async о чате, плюс накопленные изменения для commit()"""
+    chat_id: int
+    profile: dict[str, str] = field(default_factory=dict)
+    history: list[dict] = field(default_factory=list)
+    recent_messages: list[str] = field(default_factory=list)
+    activity: list[str] = field(default_factory=list)
+    calc_stats: str | None = None
+    last_estate: str | None = None
+    budgets: list[float] = field(default_factory=list)
+    last_profile_hash: str | None = None
+    # Последний ответ модели (хранится на стороне OpenAI) и хэш уже отправленной сводки действий
+    response_id: str | None = None
+    activity_hash: str | None = None
+    conversation_turns: int = 0
+    # Резюме старой части диалога и время последней вошедшей в него реплики
+    summary: str = ""
+    summary_upto: float = 0.0
+
+    # Отложенные записи
+    _profile_updates: dict[str, str] = field(default_factory=dict, repr=False)
+    _new_entries: list[str] = field(default_factory=list, repr=False)
+    _legacy_entries: list[str] = field(default_factory=list, repr=False)
+    _history_cleared: bool = field(default=False, repr=False)
+    _profile_hash: str | None = field(default=None, repr=False)
+    _conversation: dict[str, str] | None = field(default=None, repr=False)
+    _conversation_reset: bool = field(default=False, repr=False)
+    _refresh_requested: bool = field(default=False, repr=False)
+    _summary: dict[str, str] | None = field(default=None, repr=False)
+
+    def update_profile(self, **fields):
+        """Обновить поля профиля (запишутся при commit)"""
+        for key, value in fields.items():
+            if value is None:
+                continue
+            if self.profile.get(key) != value:
+                self._profile_updates[key] = value
+            self.profile[key] = value
+
+    def add_message(self, role: str, content: str):
+        """Добавить сообщение в историю (запишется при commit)"""
+        entry = make_entry(role, content)
+        self.history.append(json.loads(entry))
+        self._new_entries.append(entry)
+
+    def clear_history(self):
+        """Очистить историю чата"""
+        self.history = []
+        self._history_cleared = True
+        self._new_entries = []
+        self._legacy_entries = []
+        self.summary = ""
+        self.summary_upto = 0.0
+        self._summary = None
+        self.reset_conversation()
+
+    def set_conversation(self, response_id: str, activity_hash: str):
+        """Запомнить id ответа модели для продолжения диалога (previous_response_id)"""
+        self.response_id = response_id
+        self.activity_hash = activity_hash
+        self.conversation_turns += 1
+        self._conversation = {"response_id": response_id, "activity_hash": activity_hash,
+                              "turns": str(self.conversation_turns)}
+        self._conversation_reset = False
+
+    def reset_conversation(self):
+        """Следующий запуск агента начнёт диалог заново с полным контекстом"""
+        self.response_id = None
+        self.activity_hash = None
+        self.conversation_turns = 0
+        self._conversation = None
+        self._conversation_reset = True
+
+    def set_profile_hash(self, profile_hash: str):
+        """Запомнить хэш профиля, отправленного агенту"""
+        self.last_profile_hash = profile_hash
+        self._profile_hash = profile_hash
+
+    def set_summary(self, summary: str, upto: float):
+        """Запомнить резюме диалога до реплики с временем upto включительно"""
+        self.summary = summary
+        self.summary_upto = upto
+        self._summary = {"text": summary, "upto": repr(upto)}
+
+    def request_profile_refresh(self):
+        """Поставить чат в очередь фонового обновления профиля (bio, дата рождения)"""
+        self._refresh_requested = True
+
+    async def commit(self):
+        """Записать все накопленные изменения одной транзакцией"""
+        pipe = redis_client.pipeline(transaction=True)
+        queued = False
+
+        if self._profile_updates:
+            pipe.hset(profile_key(self.chat_id), mapping=self._profile_updates)
+            queued = True
+        if self.profile:
+            pipe.expire(profile_key(self.chat_id), PROFILE_TTL)
+            queued = True
+
+        if self._history_cleared:
+            pipe.delete(history_key(self.chat_id), legacy_history_key(self.chat_id), summary_key(self.chat_id))
+            queued = True
+        if self._legacy_entries or self._new_entries:
+            # Ленивая миграция: старый JSON-массив переносится в список вместе с новыми сообщениями
+            if self._legacy_entries:
+                pipe.delete(legacy_history_key(self.chat_id))
+            queue_append(pipe, self.chat_id, self._legacy_entries + self._new_entries)
+            queued = True
+
+        if self._profile_hash is not None:
+            pipe.set(f"last_profile_hash:{self.chat_id}", self._profile_hash, ex=PROFILE_HASH_TTL)
+            queued = True
+
+        if self._conversation_reset:
+            pipe.delete(conversation_key(self.chat_id))
+            queued = True
+        if self._conversation:
+            pipe.hset(conversation_key(self.chat_id), mapping=self._conversation)
+            pipe.expire(conversation_key(self.chat_id), CONVERSATION_TTL)
+            queued = True
+
+        if self._summary:
+            pipe.hset(summary_key(self.chat_id), mapping=self._summary)
+            pipe.expire(summary_key(self.chat_id), HISTORY_TTL)
+            queued = True
+
+        if self._refresh_requested:
+            # NX: время постановки не сдвигается, пока фоновая задача не обработала чат
+            pipe.zadd(PROFILE_REFRESH_KEY, {str(self.chat_id): time.time()}, nx=True)
+            queued = True
+
+        if queued:
+            await pipe.execute()
+
+        self._profile_updates = {}
+        self._new_entries = []
+        self._legacy_entries = []
+        self._history_cleared = False
+        self._profile_hash = None
+        self._conversation = None
+        self._conversation_reset = False
+        self._refresh_requested = False
+        self._summary = None
+
+
+async def load_context(chat_id: int) -> ChatContext:
+    """Прочитать профиль, историю, сводку действий и бюджеты чата за один round-trip"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(profile_key(chat_id))
+    pipe.lrange(history_key(chat_id), -HISTORY_READ, -1)
+    pipe.get(legacy_history_key(chat_id))
+    pipe.lrange(f"chat_history:{chat_id}", -RECENT_LIMIT, -1)
+    pipe.lrange(activity_key(chat_id), 0, ACTIVITY_LIMIT - 1)
+    pipe.get(calc_stats_key(chat_id))
+    pipe.get(last_estate_key(chat_id))
+    pipe.lrange(f"user_budgets:{chat_id}", 0, -1)
+    pipe.get(f"last_profile_hash:{chat_id}")
+    pipe.hgetall(conversation_key(chat_id))
+    pipe.hgetall(summary_key(chat_id))
+    (profile, history, legacy, recent, activity, calc_stats, last_estate, budgets, last_hash,
+     conversation, summary) = await pipe.execute()
+
+    history = parse_entries(history)
+    legacy_entries = []
+    if not history and legacy:
+        try:
+            legacy_items = json.loads(legacy)
+        except Exception:
+            legacy_items = []
+        history = legacy_items[-HISTORY_READ:]
+        legacy_entries = [json.dumps(item, ensure_ascii=False) for item in legacy_items]
+
+    return ChatContext(
+        chat_id=chat_id,
+        profile=profile or {},
+        history=history,
+        _legacy_entries=legacy_entries,
+        recent_messages=recent or [],
+        activity=activity or [],
+        calc_stats=calc_stats,
+        last_estate=last_estate,
+        budgets=[float(b) for b in budgets or []],
+        last_profile_hash=last_hash,
+        response_id=(conversation or {}).get("response_id"),
+        activity_hash=(conversation or {}).get("activity_hash"),
+        conversation_turns=int((conversation or {}).get("turns", 0)),
+        summary=(summary or {}).get("text", ""),
+        summary_upto=float((summary or {}).get("upto", 0)),
+    )
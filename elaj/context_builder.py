@@ -0,0 +1,90 @@
+# elaj/context_builder.py
+# Сборка входа агента в пределах бюджета токенов.
+# Части (вопрос, профиль, резюме диалога, последние реплики, действия в мини-приложении)
+# добавляются в порядке показа, а место под них выделяется по приоритету: сначала вопрос,
+# потом профиль, резюме и т.д. Списочные части (реплики, действия) урезаются построчно,
+# текстовые — обрезаются по длине. Так вход не растёт с длиной диалога.
+import os
+import math
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKENS = int(os.environ.get("ELAJ_CONTEXT_TOKENS", "1500"))
+CHARS_PER_TOKEN = 3.0    # грубая оценка для русского текста (с запасом)
+MIN_PART_TOKENS = 40     # обрезанный кусок короче этого не добавляем
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+@dataclass
+class _Part:
+    name: str
+    priority: int
+    text: str = ""
+    header: str = ""
+    lines: list[str] = field(default_factory=list)
+    keep: str = "first"
+    required: bool = False
+    rendered: str = ""
+
+
+class ContextBuilder:
+    """Собрать контекст из частей с приоритетами (меньше число — важнее) в пределах budget токенов"""
+
+    def __init__(self, budget: int = CONTEXT_TOKENS):
+        self.budget = budget
+        self.parts: list[_Part] = []
+        self.used = 0
+        self.dropped: list[str] = []
+
+    def add(self, name: str, text: str, priority: int, required: bool = False):
+        """Текстовая часть: целиком или обрезанная по длине (required — всегда целиком)"""
+        if text:
+            self.parts.append(_Part(name=name, priority=priority, text=text, required=required))
+
+    def add_lines(self, name: str, header: str, lines: list[str], priority: int, keep: str = "first"):
+        """Списочная часть: строки добавляются, пока помещаются.
+        keep="first" — важнее первые строки, keep="last" — последние (порядок показа сохраняется)"""
+        if lines:
+            self.parts.append(_Part(name=name, priority=priority, header=header, lines=list(lines), keep=keep))
+
+    def _fit_text(self, part: _Part, left: int) -> str:
+        tokens = estimate_tokens(part.text)
+        if part.required or tokens <= left:
+            return part.text
+        if left < MIN_PART_TOKENS:
+            return ""
+        return part.text[:int(left * CHARS_PER_TOKEN) - 1] + "…"
+
+    def _fit_lines(self, part: _Part, left: int) -> str:
+        left -= estimate_tokens(part.header)
+        ordered = part.lines if part.keep == "first" else list(reversed(part.lines))
+        taken = []
+        for line in ordered:
+            cost = estimate_tokens(line) + 1
+            if cost > left:
+                break
+            taken.append(line)
+            left -= cost
+        if not taken:
+            return ""
+        if part.keep == "last":
+            taken.reverse()
+        return part.header + "\n".join(taken)
+
+    def build(self) -> str:
+        left = self.budget
+        for part in sorted(self.parts, key=lambda p: p.priority):
+            part.rendered = self._fit_text(part, left) if not part.lines else self._fit_lines(part, left)
+            left -= estimate_tokens(part.rendered)
+            full = part.text if not part.lines else part.header + "\n".join(part.lines)
+            if part.rendered != full:
+                self.dropped.append(part.name)
+        self.used = self.budget - left
+        if self.dropped:
+            logger.info(f"Context budget {self.budget}: trimmed {', '.join(self.dropped)}")
+        return "".join(part.rendered for part in self.parts)
@@ -0,0 +1,70 @@
+# elaj/dedup.py
+# Идемпотентная обработка update по Telegram update_id.
+# Telegram повторяет доставку, если webhook долго не отвечает; без этого слоя
+# повтор запускал бы агента (gpt-4.1) второй раз и пользователь получал бы дубль ответа.
+#
+# Состояния ключа elaj:update:{update_id}:
+#   нет ключа   — update ещё не видели
+#   "inflight"  — обработка идёт (TTL короткий: если процесс упал, повтор Telegram пройдёт)
+#   "done"      — обработан, повторы игнорируются до истечения TTL
+import os
+import logging
+
+from elaj.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+INFLIGHT_TTL = int(os.environ.get("ELAJ_DEDUP_INFLIGHT_TTL", str(15 * 60)))
+DONE_TTL = int(os.environ.get("ELAJ_DEDUP_DONE_TTL", str(24 * 3600)))  # Telegram повторяет не дольше суток
+
+STATE_INFLIGHT = "inflight"
+STATE_DONE = "done"
+
+
+def _key(update_id) -> str:
+    return f"elaj:update:{update_id}"
+
+
+async def claim_update(update_id) -> bool:
+    """Атомарно занять update (SET NX). False — update уже обрабатывается или обработан"""
+    if update_id is None:
+        return True
+    try:
+        return bool(await redis_client.set(_key(update_id), STATE_INFLIGHT, nx=True, ex=INFLIGHT_TTL))
+    except Exception as e:
+        # Redis недоступен — лучше ответить дважды, чем не ответить совсем
+        logger.warning(f"Dedup claim failed for update {update_id}: {e}")
+        return True
+
+
+async def complete_update(update_id):
+    """Отметить update как обработанный"""
+    if update_id is None:
+        return
+    try:
+        await redis_client.set(_key(update_id), STATE_DONE, ex=DONE_TTL)
+    except Exception as e:
+        logger.warning(f"Dedup complete failed for update {update_id}: {e}")
+
+
+async def release_update(update_id):
+    """Снять отметку после ошибки, чтобы повторная доставка обработала update заново"""
+    if update_id is None:
+        return
+    try:
+        await redis_client.delete(_key(update_id))
+    except Exception as e:
+        logger.warning(f"Dedup release failed for update {update_id}: {e}")
+
+
+async def done_updates(update_ids: list) -> set:
+    """Какие из update уже обработаны (одним MGET)"""
+    update_ids = [update_id for update_id in update_ids if update_id is not None]
+    if not update_ids:
+        return set()
+    try:
+        states = await redis_client.mget([_key(update_id) for update_id in update_ids])
+    except Exception as e:
+        logger.warning(f"Dedup lookup failed: {e}")
+        return set()
+    return {update_id for update_id, state in zip(update_ids, states) if state == STATE_DONE}
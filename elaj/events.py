@@ -0,0 +1,119 @@
+# elaj/events.py
+# События мини-приложения: хранение и сводка "последних действий" для контекста бота.
+# Сырые события пишутся в ограниченный Redis Stream, а строки сводки рендерятся
+# один раз — при записи события (log_event), а не при каждом сообщении в чат.
+EVENTS_MAXLEN = 200          # сколько сырых событий храним на пользователя (приблизительно)
+ACTIVITY_LIMIT = 10          # сколько строк сводки показываем агенту
+EVENTS_TTL = 60 * 24 * 3600  # 60 дней
+ACTIVITY_HEADER = "\nПоследние действия в мини-приложении (обратный порядок):\n"
+
+
+def events_key(user_id) -> str:
+    return f"user_events_stream:{user_id}"
+
+
+def activity_key(user_id) -> str:
+    return f"user_activity:{user_id}"
+
+
+def calc_stats_key(user_id) -> str:
+    return f"user_calc_stats:{user_id}"
+
+
+def last_estate_key(user_id) -> str:
+    return f"user_last_estate:{user_id}"
+
+
+# Шаблоны строк сводки по типу события. Поля подставляются из details:
+#   {a|b}          — первое из полей a, b, которое есть в событии (иначе "неизвестно")
+#   {a|=нет данных} — поле a или значение по умолчанию после "="
+#   {who}          — "бота" или "менеджера" (по типу события ask_bot_* / ask_manager_*)
+EVENT_TEMPLATES = {
+    # Главная страница
+    'open_home': "зашёл на главную страницу",
+    'ask_bot_home': "- перешёл в чат {who} с главной страницы",
+    'ask_manager_home': "- перешёл в чат {who} с главной страницы",
+
+    # Районы
+    'open_districts': "открыл список районов",
+    'focus_district': "- задержался в районе: {district_name|district_key}",
+    'ask_bot_districts': "- перешёл в чат {who} со страницы районов",
+    'ask_manager_districts': "- перешёл в чат {who} со страницы районов",
+
+    # Комплекс (Estate)
+    'open_estate': "- открыл комплекс: {estate_name} ({district_name})",
+    'ask_bot_estate': "- перешёл в чат {who} из комплекс {estate_name}",
+    'ask_manager_estate': "- перешёл в чат {who} из комплекс {estate_name}",
+
+    # Апартаменты
+    'open_apartment': "- просмотрел апартаменты в {estate} ({district})",
+    'view_apartment': "- просмотрел апартаменты в {estate} ({district})",
+    'ask_bot_apartment': "- перешёл в чат {who} из апартаментов в {estate}",
+    'ask_manager_apartment': "- перешёл в чат {who} из апартаментов в {estate}",
+
+    # Калькулятор
+    'open_calculator': "- открыл калькулятор доходности",
+    'ask_bot_calc': "- перешёл в чат {who} из калькулятора (ценовая категория {price_category}, вне сезона {off_season_occupancy|=нет данных}%)",
+    'ask_manager_calc': "- перешёл в чат {who} из калькулятора (ценовая категория {price_category}, вне сезона {off_season_occupancy|=нет данных}%)",
+}
+
+
+class _EventFields(dict):
+    """Поля события для str.format_map: цепочки "a|b" и значения по умолчанию "a|=текст" """
+
+    def __missing__(self, key):
+        for name in key.split("|"):
+            if name.startswith("="):
+                return name[1:]
+            if name in self:
+                return self[name]
+        return "неизвестно"
+
+
+def render_event(et: str, d: dict) -> str | None:
+    """Строка сводки для события (None — событие в сводку не попадает)"""
+    template = EVENT_TEMPLATES.get(et)
+    if template is None:
+        return None
+    fields = _EventFields(d or {})
+    fields['who'] = 'бота' if 'bot' in et else 'менеджера'
+    return template.format_map(fields)
+
+
+def render_calc_stats(d: dict) -> str:
+    """Строка с последним бюджетом из калькулятора (хранится отдельно, только последняя)"""
+    min_b = d.get('budget_min', 'нет данных')
+    max_b = d.get('budget_max', 'нет данных')
+    avg_b = d.get('budget_avg', 'нет данных')
+    return f"- предположительный бюджет: ${min_b} – ${max_b} (среднее ${avg_b})"
+
+
+def queue_event(pipe, user_id, event_type: str, details: dict, raw: str):
+    """Добавить в pipeline запись события: сырой стрим + инкрементальная сводка"""
+    pipe.xadd(events_key(user_id), {"event": raw}, maxlen=EVENTS_MAXLEN, approximate=True)
+    pipe.expire(events_key(user_id), EVENTS_TTL)
+
+    details = details if isinstance(details, dict) else {}
+    # Комплекс, которым пользователь интересовался последним (для отпечатка кэша ответов)
+    estate = details.get('estate_name') or details.get('estate')
+    if estate:
+        pipe.set(last_estate_key(user_id), str(estate)[:100], ex=EVENTS_TTL)
+
+    if event_type == 'calculator_budget_stats':
+        pipe.set(calc_stats_key(user_id), render_calc_stats(details), ex=EVENTS_TTL)
+        return
+
+    line = render_event(event_type, details)
+    if line:
+        # Новые строки — в начало списка (сводка идёт в обратном порядке)
+        pipe.lpush(activity_key(user_id), line)
+        pipe.ltrim(activity_key(user_id), 0, ACTIVITY_LIMIT - 1)
+        pipe.expire(activity_key(user_id), EVENTS_TTL)
+
+
+def render_activity(lines: list[str], calc_stats: str | None) -> str:
+    """Готовый блок "последних действий" для контекста агента"""
+    lines = ([calc_stats] if calc_stats else []) + list(lines or [])
+    if not lines:
+        return ""
+    return ACTIVITY_HEADER + "\n".join(lines)
@@ -0,0 +1,172 @@
+# elaj/file_ids.py
+# Кэш Telegram file_id для фото каталога.
+# По URL Telegram каждый раз заново скачивает картинку с Cloudinary — альбом отправляется
+# секундами и иногда падает по таймауту. После первой отправки берём file_id из
+# возвращённых Message и храним в Redis (hash elaj:file_ids: url -> file_id); дальше то же
+# фото уходит по file_id, без скачивания. file_id привязан к боту: при смене токена
+# кэш нужно очистить (DEL elaj:file_ids).
+#
+# Прогрев для всего каталога через приватный канал (бот — администратор):
+# python -m elaj.file_ids --channel -100123456789 [--delete]
+import os
+import json
+import asyncio
+import logging
+import argparse
+
+from elaj import metrics
+from elaj import sender
+from elaj.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+FILE_IDS_ENABLED = os.environ.get("ELAJ_FILE_IDS", "1") == "1"
+FILE_IDS_KEY = "elaj:file_ids"
+WARM_CHANNEL = os.environ.get("ELAJ_FILE_ID_CHANNEL")
+WARM_INTERVAL = 3.0     # сек между альбомами при прогреве (лимиты Telegram на группы/каналы)
+ALBUM_LIMIT = 10
+
+# Копия в памяти процесса: url -> file_id (file_id не меняются, сбрасывать не нужно)
+_file_ids: dict[str, str] = {}
+
+
+async def lookup(urls: list[str]) -> dict[str, str]:
+    """file_id для уже загруженных фото (неизвестные URL в ответ не попадают)"""
+    if not FILE_IDS_ENABLED or not urls:
+        return {}
+    missing = [url for url in urls if url not in _file_ids]
+    if missing:
+        try:
+            for url, file_id in zip(missing, await redis_client.hmget(FILE_IDS_KEY, missing)):
+                if file_id:
+                    _file_ids[url] = file_id
+        except Exception as e:
+            logger.warning(f"file_id lookup failed: {e}")
+    return {url: _file_ids[url] for url in urls if url in _file_ids}
+
+
+async def remember(urls: list[str], messages) -> int:
+    """Сохранить file_id из ответа send_photo/send_media_group (сообщения — в порядке urls)"""
+    if not FILE_IDS_ENABLED:
+        return 0
+    found = {}
+    for url, message in zip(urls, messages):
+        if message is not None and message.photo:
+            # Самый большой размер — им и отправляем повторно
+            found[url] = message.photo[-1].file_id
+    new = {url: file_id for url, file_id in found.items() if _file_ids.get(url) != file_id}
+    if new:
+        _file_ids.update(new)
+        try:
+            await redis_client.hset(FILE_IDS_KEY, mapping=new)
+        except Exception as e:
+            logger.warning(f"file_id store failed: {e}")
+    return len(new)
+
+
+async def forget(urls: list[str]):
+    """Убрать file_id, которые Telegram не принял (бот сменился, файл удалён)"""
+    for url in urls:
+        _file_ids.pop(url, None)
+    if urls:
+        await redis_client.hdel(FILE_IDS_KEY, *urls)
+
+
+async def _send(bot, chat_id, urls: list[str], known: dict[str, str], caption: str | None, priority: str, **kwargs):
+    from telegram import InputMediaPhoto
+
+    if len(urls) == 1:
+        message = await sender.call(
+            bot.send_photo, chat_id, priority=priority, photo=known.get(urls[0], urls[0]), caption=caption, **kwargs
+        )
+        return [message]
+    media = [InputMediaPhoto(media=known.get(url, url), caption=caption if i == 0 else None)
+             for i, url in enumerate(urls)]
+    # Альбом для лимитов Telegram — столько сообщений, сколько в нём фото
+    return list(await sender.call(bot.send_media_group, chat_id, cost=len(media), priority=priority, media=media, **kwargs))
+
+
+async def send_photos(bot, chat_id, urls: list[str], caption: str | None = None, priority: str = sender.REPLY, **kwargs):
+    """Отправить фото (одно — send_photo, несколько — альбом до 10) по file_id, где он известен.
+    Если Telegram отверг file_id — повтор по URL. Возвращает отправленные сообщения"""
+    from telegram.error import BadRequest
+
+    urls = urls[:ALBUM_LIMIT]
+    known = await lookup(urls)
+    metrics.count("photos.file_id", len(known))
+    metrics.count("photos.by_url", len(urls) - len(known))
+    try:
+        messages = await _send(bot, chat_id, urls, known, caption, priority, **kwargs)
+    except BadRequest as e:
+        if not known:
+            raise
+        logger.warning(f"Cached file_id rejected ({e}), resending {len(urls)} photos by URL")
+        await forget(list(known))
+        known = {}
+        messages = await _send(bot, chat_id, urls, known, caption, priority, **kwargs)
+    await remember([url for url in urls if url not in known], [m for url, m in zip(urls, messages) if url not in known])
+    return messages
+
+
+async def warm(channel, catalog_path: str | None = None, delete: bool = False) -> dict:
+    """Загрузить в канал все рабочие фото каталога без file_id и сохранить их file_id"""
+    from elaj import runtime
+    from elaj import photo_index
+
+    catalog_path = catalog_path or photo_index.CATALOG_PATH
+    if not os.path.exists(catalog_path):
+        logger.warning(f"Catalog {catalog_path} not found, nothing to upload")
+        return {"skipped": True, "reason": "no catalog"}
+    with open(catalog_path, encoding="utf-8") as f:
+        urls = photo_index.extract_photo_urls(f.read())
+    index = await photo_index.lookup(urls)
+    urls = [url for url in urls if index.get(url, True)]   # заведомо битые не грузим
+    known = await lookup(urls)
+    todo = [url for url in urls if url not in known]
+
+    bot = await runtime.get_bot()
+    stored = failed = 0
+    for start in range(0, len(todo), ALBUM_LIMIT):
+        batch = todo[start:start + ALBUM_LIMIT]
+        try:
+            messages = await send_photos(bot, channel, batch, priority=sender.BACKGROUND, disable_notification=True)
+            stored += sum(1 for message in messages if message.photo)
+            if delete:
+                for message in messages:
+                    await bot.delete_message(chat_id=channel, message_id=message.message_id)
+        except Exception as e:
+            # Альбом падает целиком из-за одной ссылки — пробуем по одной
+            logger.warning(f"Album upload failed ({e}), uploading one by one")
+            for url in batch:
+                try:
+                    messages = await send_photos(bot, channel, [url], priority=sender.BACKGROUND, disable_notification=True)
+                    stored += 1
+                    if delete:
+                        await bot.delete_message(chat_id=channel, message_id=messages[0].message_id)
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f"Photo upload failed for {url}: {e}")
+        await asyncio.sleep(WARM_INTERVAL)
+
+    logger.info(f"file_id warm-up: {len(urls)} photos, {len(todo)} uploaded, {stored} stored, {failed} failed")
+    return {"total": len(urls), "uploaded": len(todo), "stored": stored, "failed": failed}
+
+
+async def _main(args):
+    from elaj import runtime
+    try:
+        return await warm(args.channel, args.catalog, args.delete)
+    finally:
+        await runtime.aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Pre-upload catalog photos and cache their Telegram file_id")
+    parser.add_argument("--channel", default=WARM_CHANNEL, help="private channel id (default: ELAJ_FILE_ID_CHANNEL)")
+    parser.add_argument("--catalog", default=None)
+    parser.add_argument("--delete", action="store_true", help="delete the uploaded messages afterwards")
+    args = parser.parse_args()
+    if not args.channel:
+        parser.error("--channel or ELAJ_FILE_ID_CHANNEL is required")
+    print(json.dumps(asyncio.run(_main(args))))
@@ -0,0 +1,383 @@
+# elaj/handler.py
+# Обработка одного сообщения Telegram: профиль, контекст, запуск агента, отправка ответа.
+# Используется и webhook-ом (синхронный режим), и воркером очереди.
+# Agents SDK, openai и streaming импортируются только перед запуском агента:
+# /start и ответы из кэша обходятся без них (быстрее холодный старт).
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+from elaj import runtime
+from elaj import file_ids
+from elaj import response_cache
+from elaj import metrics
+from elaj import router
+from elaj import sender
+from elaj import summary
+from elaj.context import CONVERSATION_MAX_TURNS, load_context
+from elaj.context_builder import ContextBuilder
+from elaj.events import ACTIVITY_HEADER, render_activity
+from elaj.images import filter_photo_urls
+from elaj.profile_refresh import chat_fetch_due
+
+logger = logging.getLogger(__name__)
+
+
+def parse_update(update: dict) -> dict | None:
+    """Достать из Telegram update аргументы для handle_message_async (None — не текстовое сообщение)"""
+    msg = (update or {}).get("message", {})
+    if not msg or "text" not in msg:
+        return None
+    return {
+        "chat_id": msg["chat"]["id"],
+        "text": msg["text"],
+        "message_id": msg["message_id"],
+        "user": msg.get("from", {}),
+    }
+
+
+async def run_agent(input_text: str, previous_response_id: str | None, reply=None):
+    """Запустить агента: потоково (если передан reply — elaj.streaming.ProgressiveReply) или обычным Runner.run"""
+    from elaj.agent import WorkflowInput, run_workflow, run_workflow_streamed
+
+    runtime.ensure_openai()
+    workflow_input = WorkflowInput(input_as_text=input_text, previous_response_id=previous_response_id)
+    if reply is not None:
+        return await run_workflow_streamed(workflow_input, reply)
+    return await run_workflow(workflow_input)
+
+
+def previous_response_expired(error: Exception) -> bool:
+    """Ошибка OpenAI из-за истёкшего/удалённого previous_response_id"""
+    import openai
+
+    return isinstance(error, (openai.NotFoundError, openai.BadRequestError)) and "previous" in str(error).lower()
+
+
+def parse_cached_reply(cached: str) -> tuple[str, list[str]]:
+    """Ответ из кэша: JSON {"text", "photo_urls"} (старые записи — просто текст)"""
+    try:
+        data = json.loads(cached)
+        return str(data["text"]), [u for u in data.get("photo_urls") or [] if isinstance(u, str)]
+    except (ValueError, TypeError, KeyError):
+        return cached, []
+
+
+async def _answer_fast(bot, ctx, decision: router.Route, text: str, message_id: int) -> bool:
+    """Ответ шаблоном или дешёвой моделью; False — не вышло, сообщение обработает агент"""
+    response = decision.reply
+    if decision.kind == router.LIGHT:
+        with metrics.span("telegram.typing"):
+            await sender.typing(bot, ctx.chat_id)
+        try:
+            with metrics.span("router.light"):
+                response = await router.light_reply(text, ctx.history[:-1])
+        except Exception as e:
+            logger.warning(f"Light model failed for chat {ctx.chat_id}: {e}")
+            response = None
+    router.log_decision(ctx.chat_id, decision, fallback=not response)
+    if not response:
+        return False
+
+    # В диалог на стороне OpenAI этот ответ не попадает: он есть в истории и резюме,
+    # а для следующего вопроса по делу он не важен — цепочку не сбрасываем
+    ctx.add_message("assistant", response)
+    with metrics.span("telegram.send"):
+        await sender.send_text(bot, ctx.chat_id, response, reply_to_message_id=message_id)
+    await summary.maybe_update(ctx)
+    # Все записи хода — одной транзакцией
+    with metrics.span("redis.commit"):
+        await ctx.commit()
+    return True
+
+
+async def handle_message_async(chat_id: int, text: str, message_id: int, user: dict,
+                               coalesce_wait_ms: float | None = None):
+    """Обработать сообщение; тайминги стадий и токены пишутся в метрики (elaj/metrics.py).
+    coalesce_wait_ms — сколько сообщение ждало окна тишины в elaj/coalesce.py"""
+    metrics.start_trace(chat_id=chat_id)
+    if coalesce_wait_ms is not None:
+        metrics.record("coalesce.wait", coalesce_wait_ms)
+    try:
+        with metrics.span("message.total"):
+            await _handle_message(chat_id, text, message_id, user)
+    finally:
+        await metrics.flush()
+
+
+async def _handle_message(chat_id: int, text: str, message_id: int, user: dict):
+    # Изменения контекста копятся в ctx и пишутся одной транзакцией в конце хода
+    # (ChatContext.commit); при ошибке — тем, что накопилось, чтобы не потерять сообщение
+    ctx = None
+    try:
+        # Общий Bot рантайма: соединения с Telegram переиспользуются между сообщениями
+        bot = await runtime.get_bot()
+
+        # Профиль, история, события и бюджеты — одним запросом к Redis
+        with metrics.span("redis.load_context"):
+            ctx = await load_context(chat_id)
+        profile = ctx.profile
+        
+        # проверяем, нужно ли обновлять профиль (если не сохранен в Redis, нет даты или не обновлялся _ дней)
+        should_fetch_profile = not profile or 'fetched' not in profile or (datetime.now() - datetime.fromisoformat(profile['fetched'])).total_seconds() > 60*60*24 * 7
+
+        # Обновляем поля из user info
+        if user and should_fetch_profile:
+            ctx.update_profile(
+                first_name=user.get('first_name', profile.get('first_name', '')),
+                last_name=user.get('last_name', profile.get('last_name', '')),
+                username=user.get('username', profile.get('username', '')),
+                language_code=user.get('language_code', profile.get('language_code', '')),
+                fetched=datetime.now().isoformat(),
+            )
+            # country_code: если есть гео/IP логика, добавьте здесь (например, via requests.get('https://ipapi.co/json/').json()['country_code'])
+        
+
+        # bio и дату рождения (get_chat) обновляет фоновая задача elaj/profile_refresh.py,
+        # здесь используется то, что уже есть в профиле
+        if chat_fetch_due(profile):
+            ctx.request_profile_refresh()
+
+        # Приветствие
+        if text.strip().lower() == "/start":
+            welcome = (
+                "Добро пожаловать! 🌊\n\n"
+                "Я — Эладж, ваш личный агент по премиум-недвижимости на черноморском побережье Аджарии.\n\n"
+                "• Первая линия моря\n"
+                "• Видовые апартаменты с доходностью 10–12% годовых\n"
+                "• Полное сопровождение сделки и управление арендой\n\n"
+                "Чем могу помочь сегодня?\n"
+                "— Подобрать объект для покупки\n"
+                "— Найти апартаменты для отдыха\n"
+                "— Рассчитать инвестиционную доходность\n\n"
+                "Или пишите сразу менеджеру → @ninaabramia97 (Нина)\n\n"
+                "P.S. Команда /start всегда начинает наш диалог с чистого листа"
+            )
+            # Очищаем историю при команде /start
+            ctx.clear_history()
+            with metrics.span("redis.commit"):
+                await ctx.commit()
+            with metrics.span("telegram.send"):
+                await sender.send_text(bot, chat_id, welcome, reply_to_message_id=message_id)
+            return
+
+        # Добавляем сообщение пользователя в историю
+        ctx.add_message("user", text)
+
+        # Тривиальные сообщения ("привет", "спасибо", "контакт менеджера") — без агента
+        decision = router.route(text, ctx.history[:-1], profile.get('language_code'))
+        if decision.kind != router.AGENT and await _answer_fast(bot, ctx, decision, text, message_id):
+            return
+        if decision.kind == router.AGENT:
+            router.log_decision(chat_id, decision)
+
+        # Типовые вопросы (рассрочка, доходность, ВНЖ...) отвечаются одинаково для всех: такой ответ
+        # генерируется без профиля и истории и кэшируется (elaj/response_cache.py)
+        faq = router.faq_intent(text) if response_cache.CACHE_ENABLED else None
+        cacheable = faq is not None and response_cache.is_cacheable(text)
+
+        with metrics.span("telegram.typing"):
+            await sender.typing(bot, chat_id)
+
+        # История диалога для контекста
+        history = ctx.history
+
+        # Проверяем, был ли профиль недавно в истории
+        profile_mentioned_recently = any("Профиль пользователя:" in msg for msg in ctx.recent_messages)
+
+        # Проверяем, изменился ли профиль с последнего раза
+        last_profile_hash = ctx.last_profile_hash
+        current_profile_str = json.dumps(profile, sort_keys=True)
+        current_hash = hashlib.md5(current_profile_str.encode()).hexdigest()
+
+        profile_changed = last_profile_hash != current_hash
+
+        # Решаем, передавать ли профиль
+        send_profile = profile and (not profile_mentioned_recently or profile_changed)
+
+        # Если передаём — обновляем хэш (общему ответу на типовой вопрос профиль не передаётся)
+        if send_profile and not cacheable:
+            ctx.set_profile_hash(current_hash)
+
+        # Продолжаем диалог на стороне OpenAI (previous_response_id), если он сохранён:
+        # тогда модели отправляется только новый вопрос и изменившиеся профиль/действия.
+        # Слишком длинная цепочка начинается заново с резюме — вход не растёт с длиной диалога
+        continuing = ctx.response_id is not None
+        if continuing and ctx.conversation_turns >= CONVERSATION_MAX_TURNS:
+            ctx.reset_conversation()
+            continuing = False
+
+        # Формируем текст профиля (в промпт попадёт, только если решили передавать)
+        profile_text = ""
+        if profile:
+            profile_text = (
+                f"Профиль пользователя:\n"
+                f"• Имя: {profile.get('first_name', 'unknown')}\n"
+                f"• Ник: @{profile.get('username', 'unknown')}\n"
+                f"• Язык: {profile.get('language_code', 'unknown')}\n"
+                # f"• Страна: {profile.get('country_code', 'unknown')}\n"
+                f"• Последний контакт: {profile.get('last_seen', 'unknown')}\n"
+            )
+
+            if profile.get('bio'):
+                profile_text += f"• О себе: {profile['bio'][:120]}{'...' if len(profile['bio']) > 120 else ''}\n"
+            if profile.get('birth_day'):
+                profile_text += f"• Дата рождения: {profile['birth_day']}.{profile['birth_month']}"
+                if profile.get('birth_year'):
+                    profile_text += f".{profile['birth_year']}"
+                profile_text += "\n"
+
+            # Если есть бюджет из калькулятора
+            budgets = ctx.budgets
+            if budgets:
+                min_b = min(budgets)
+                max_b = max(budgets)
+                avg_b = sum(budgets) / len(budgets)
+                profile_text += f"• Бюджет (из калькулятора): ${min_b:,.0f} – ${max_b:,.0f} (ср. ${avg_b:,.0f})\n"
+
+        logger.debug(f"Profile for chat {chat_id}: \n{profile_text}")
+
+        # Последние действия пользователя в мини-приложении (сводка готовится в log_event)
+        recent_activity = render_activity(ctx.activity, ctx.calc_stats)
+        activity_hash = hashlib.md5(recent_activity.encode()).hexdigest()
+        activity_lines = ([ctx.calc_stats] if ctx.calc_stats else []) + ctx.activity
+
+        # Реплики, ещё не свёрнутые в резюме (кроме текущего вопроса); старые — в ctx.summary
+        dialog_lines = [
+            f"{'Клиент' if msg['role'] == 'user' else 'Эладж'}: {msg['content']}"
+            for msg in summary.unsummarized(history[:-1], ctx.summary_upto)
+        ]
+        question_text = "\n\nТекущий вопрос: \n" + text
+
+        def build_context(full: bool) -> ContextBuilder:
+            """Части в порядке показа; priority — очередь на место в бюджете токенов (0 — вопрос)"""
+            builder = ContextBuilder()
+            if send_profile if full else profile_changed:
+                builder.add("profile", profile_text, priority=1)
+            if full or activity_hash != ctx.activity_hash:
+                builder.add_lines("activity", ACTIVITY_HEADER, activity_lines, priority=4)
+            if full:
+                if ctx.summary:
+                    builder.add("summary", "\n\nКраткое содержание предыдущего диалога:\n" + ctx.summary, priority=2)
+                builder.add_lines("dialog", "\n\nКонтекст предыдущего диалога:\n", dialog_lines, priority=3, keep="last")
+            builder.add("question", question_text, priority=0, required=True)
+            return builder
+
+        # Итоговый контекст (полный — для нового диалога или если сохранённый ответ истёк)
+        full_builder = build_context(full=True)
+        context_text = full_builder.build()
+        if continuing:
+            # Только то, чего модель ещё не видела в этом диалоге
+            builder = build_context(full=False)
+            input_text = builder.build()
+        else:
+            builder, input_text = full_builder, context_text
+        logger.debug(f"Context text for chat {chat_id} (continuing={continuing}): \n{input_text}")
+        metrics.count("context.tokens", builder.used)
+
+        # Ключ кэша — вопрос, тема и язык ответа; личного контекста в нём нет, как и в самом ответе
+        fingerprint = {"lang": router.language(text, profile.get('language_code')), "faq": faq}
+        cached = None
+        if cacheable:
+            with metrics.span("cache.lookup"):
+                cached = await response_cache.get(text, fingerprint)
+        reply = None
+
+        if cached is not None:
+            logger.info(f"Response cache hit for chat {chat_id}")
+            metrics.count("cache.hit")
+            response, photo_urls = parse_cached_reply(cached)
+            # Этого ответа нет в диалоге на стороне OpenAI — следующий запуск соберёт контекст заново
+            ctx.reset_conversation()
+        else:
+            from elaj.streaming import STREAM_REPLIES, ProgressiveReply
+
+            # Запуск агента из Agents SDK
+            if STREAM_REPLIES:
+                # Текст показывается пользователю по мере генерации
+                reply = ProgressiveReply(bot, chat_id, message_id)
+            if cacheable:
+                # Общий ответ: только вопрос, без профиля, истории и цепочки диалога
+                run_input, run_previous = question_text, None
+            else:
+                run_input, run_previous = input_text, ctx.response_id
+            try:
+                with metrics.span("agent.run"):
+                    result = await run_agent(run_input, run_previous, reply)
+            except Exception as e:
+                if run_previous is None or not previous_response_expired(e):
+                    raise
+                # Сохранённый ответ истёк/удалён — полный контекст с нуля
+                logger.info(f"Previous response expired for chat {chat_id}, rebuilding context")
+                metrics.count("agent.rebuild")
+                if reply is not None:
+                    reply = ProgressiveReply(bot, chat_id, message_id)
+                with metrics.span("agent.run"):
+                    result = await run_agent(context_text, None, reply)
+            response, photo_urls = result["output_text"], result["photo_urls"]
+            if cacheable:
+                # Ответ без контекста чата не продолжаем — следующий запуск соберёт контекст заново
+                ctx.reset_conversation()
+            elif result.get("response_id"):
+                ctx.set_conversation(result["response_id"], activity_hash)
+            if cacheable:
+                with metrics.span("cache.store"):
+                    await response_cache.put(
+                        text, fingerprint,
+                        json.dumps({"text": response, "photo_urls": photo_urls}, ensure_ascii=False)
+                    )
+
+        # Добавляем ответ ассистента в историю
+        ctx.add_message("assistant", response)
+
+        if reply is not None:
+            with metrics.span("telegram.send"):
+                await reply.finish(response, photo_urls)
+        else:
+            # Фото проверяются на сервере (индекс каталога / кэш / HEAD), а не отдельным вызовом инструмента
+            with metrics.span("images.filter"):
+                urls = await filter_photo_urls(photo_urls)
+            metrics.count("photos.dropped", len(set(photo_urls[:10])) - len(urls))
+
+            with metrics.span("telegram.send"):
+                await _send_reply(bot, chat_id, message_id, response, urls)
+
+        # Реплики, выпавшие из окна, сворачиваются в резюме — уже после ответа пользователю
+        await summary.maybe_update(ctx)
+
+        # Профиль, оба сообщения, цепочка диалога, хэш профиля и резюме — одной транзакцией
+        with metrics.span("redis.commit"):
+            await ctx.commit()
+
+    except Exception as e:
+        logger.exception(f"Message handling failed for chat {chat_id}: {e}")
+        metrics.count("message.error")
+        if ctx is not None:
+            try:
+                await ctx.commit()
+            except Exception as commit_error:
+                logger.warning(f"Context commit after error failed for chat {chat_id}: {commit_error}")
+        try:
+            bot = await runtime.get_bot()
+            await sender.call(
+                bot.send_message, chat_id,
+                text="Техническая заминка 🤖\nПишите сразу @a4k5o6 — он ответит мгновенно!",
+                reply_to_message_id=message_id
+            )
+        except:
+            pass
+
+
+async def _send_reply(bot, chat_id: int, message_id: int, response: str, urls: list[str]):
+    """Отправить ответ: фото с подписью, альбом (до 10 фото) или просто текст"""
+    if urls:
+        # Фото уходят по Telegram file_id, если уже загружались (elaj/file_ids.py);
+        # подпись — до 1024 символов по границе абзаца/строки, остальное — сообщениями
+        caption, rest = sender.split_caption(response)
+        await file_ids.send_photos(bot, chat_id, urls, caption=caption, reply_to_message_id=message_id)
+        for chunk in rest:
+            await sender.call(bot.send_message, chat_id, text=chunk, reply_to_message_id=message_id, disable_web_page_preview=True)
+    else:
+        await sender.send_text(bot, chat_id, response, reply_to_message_id=message_id, disable_web_page_preview=True)
+
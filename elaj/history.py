@@ -0,0 +1,100 @@
+# elaj/history.py
+# История диалога: ограниченный Redis list elaj:history:{chat_id}, по одному JSON на сообщение.
+# Запись — RPUSH + LTRIM + EXPIRE в одной транзакции (O(1) независимо от длины истории),
+# чтение — LRANGE только последних N сообщений.
+#
+# Старый формат — JSON-массив в строковом ключе elaj:chat:{chat_id}. Он переносится
+# лениво при первом обращении к чату (elaj/context.py) или разом:
+#   python -m elaj.history --migrate
+import json
+import time
+import asyncio
+import logging
+import argparse
+
+from elaj.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TTL = 30 * 24 * 3600   # TTL месяц
+HISTORY_LIMIT = 20             # храним последние 20 сообщений
+HISTORY_READ = 10              # для контекста агента читаем только последние 10 (старые — в резюме, elaj/summary.py)
+
+
+def history_key(chat_id) -> str:
+    return f"elaj:history:{chat_id}"
+
+
+def legacy_history_key(chat_id) -> str:
+    return f"elaj:chat:{chat_id}"
+
+
+def make_entry(role: str, content: str) -> str:
+    return json.dumps({"role": role, "content": content, "timestamp": time.time()}, ensure_ascii=False)
+
+
+def parse_entries(raw: list[str]) -> list[dict]:
+    entries = []
+    for item in raw or []:
+        try:
+            entries.append(json.loads(item))
+        except Exception:
+            continue  # если сломанный json — пропускаем
+    return entries
+
+
+def queue_append(pipe, chat_id, entries: list[str]):
+    """Добавить в pipeline запись сообщений с обрезкой и продлением TTL"""
+    key = history_key(chat_id)
+    pipe.rpush(key, *entries)
+    pipe.ltrim(key, -HISTORY_LIMIT, -1)
+    pipe.expire(key, HISTORY_TTL)
+
+
+async def migrate_chat(chat_id) -> bool:
+    """Перенести историю одного чата из старого формата (True — было что переносить)"""
+    raw = await redis_client.get(legacy_history_key(chat_id))
+    if raw is None:
+        return False
+    try:
+        old = json.loads(raw)[-HISTORY_LIMIT:]
+    except Exception:
+        old = []
+    pipe = redis_client.pipeline(transaction=True)
+    # Старые записи идут перед уже накопленными в новом формате
+    for item in reversed(old):
+        pipe.lpush(history_key(chat_id), json.dumps(item, ensure_ascii=False))
+    pipe.ltrim(history_key(chat_id), -HISTORY_LIMIT, -1)
+    pipe.expire(history_key(chat_id), HISTORY_TTL)
+    pipe.delete(legacy_history_key(chat_id))
+    await pipe.execute()
+    return True
+
+
+async def migrate_all(batch: int = 500) -> int:
+    """Перенести историю всех чатов из elaj:chat:* в списки"""
+    migrated = 0
+    async for key in redis_client.scan_iter(match="elaj:chat:*", count=batch):
+        if await migrate_chat(key.rsplit(":", 1)[1]):
+            migrated += 1
+    return migrated
+
+
+async def _main():
+    from elaj import storage
+    try:
+        count = await migrate_all()
+        logger.info(f"Migrated chat history for {count} chats")
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Chat history maintenance")
+    parser.add_argument("--migrate", action="store_true", help="convert elaj:chat:* JSON blobs into capped lists")
+    args = parser.parse_args()
+    if args.migrate:
+        asyncio.run(_main())
+    else:
+        parser.print_help()
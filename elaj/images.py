@@ -0,0 +1,97 @@
+# elaj/images.py
+# Проверка доступности изображений (URL фото из каталога) с кэшем в Redis.
+# Фото каталога сначала ищутся в предрассчитанном индексе (elaj/photo_index.py).
+# Кэш читается одним MGET, все промахи проверяются параллельно с общим дедлайном,
+# результаты пишутся одним pipeline. Одновременные проверки одного URL из разных
+# чатов объединяются в один HEAD-запрос.
+import os
+import asyncio
+import hashlib
+import logging
+
+from elaj import runtime
+from elaj import photo_index
+from elaj.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+MAX_URLS = 10
+VALID_TTL = 7 * 24 * 3600                                               # рабочие ссылки — неделя
+INVALID_TTL = int(os.environ.get("ELAJ_IMAGE_INVALID_TTL", "3600"))     # битые — час, вдруг починят
+CHECK_DEADLINE = float(os.environ.get("ELAJ_IMAGE_CHECK_DEADLINE", "4"))  # общий дедлайн на вызов, сек
+
+# url -> задача проверки, общая для всех конкурентных вызовов
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def cache_key(url: str) -> str:
+    url_hash = hashlib.md5(url.encode("utf-8")).hexdigest()
+    return f"img_check:{url_hash}"
+
+
+async def probe_url(url: str) -> str:
+    """Один HEAD-запрос: "True", если по ссылке отдаётся изображение"""
+    try:
+        r = await runtime.get_http_client().head(url, timeout=CHECK_DEADLINE, follow_redirects=True)
+        ok = r.status_code == 200 and r.headers.get("content-type", "").startswith("image/")
+        return str(ok)
+    except Exception:
+        return "False"
+
+
+def _check_shared(url: str) -> asyncio.Task:
+    """Вернуть уже идущую проверку URL или запустить новую"""
+    task = _inflight.get(url)
+    if task is None:
+        task = asyncio.create_task(probe_url(url))
+        _inflight[url] = task
+        task.add_done_callback(lambda _t, u=url: _inflight.pop(u, None))
+    return task
+
+
+async def check_image_urls(image_urls: list[str]) -> dict[str, str]:
+    """
+    Проверить до MAX_URLS ссылок, вернуть {"https://...": "True" | "False"}.
+    Ссылки, не успевшие проверку до дедлайна, считаются "False" и не кэшируются.
+    """
+    urls = list(dict.fromkeys(image_urls[:MAX_URLS]))
+    if not urls:
+        return {}
+
+    # Фото каталога — из индекса в памяти, без Redis и сети
+    results = {url: str(ok) for url, ok in (await photo_index.lookup(urls)).items()}
+    unknown = [url for url in urls if url not in results]
+    if not unknown:
+        return {url: results[url] for url in urls}
+
+    keys = [cache_key(url) for url in unknown]
+    cached = await redis_client.mget(keys)
+
+    tasks = {}
+    for url, value in zip(unknown, cached):
+        if value is not None:
+            results[url] = value
+        else:
+            tasks[url] = _check_shared(url)
+
+    if tasks:
+        # asyncio.wait не отменяет задачи по таймауту: проверку могут ждать и другие чаты
+        await asyncio.wait(list(tasks.values()), timeout=CHECK_DEADLINE)
+        pipe = redis_client.pipeline(transaction=False)
+        for url, task in tasks.items():
+            if task.done():
+                result = task.result()
+                pipe.setex(cache_key(url), VALID_TTL if result == "True" else INVALID_TTL, result)
+            else:
+                logger.info(f"Image check deadline exceeded: {url}")
+                result = "False"
+            results[url] = result
+        await pipe.execute()
+
+    return {url: results[url] for url in urls}
+
+
+async def filter_photo_urls(image_urls: list[str]) -> list[str]:
+    """Оставить только рабочие ссылки (в исходном порядке, без повторов, не больше MAX_URLS)"""
+    checked = await check_image_urls(image_urls)
+    return [url for url, ok in checked.items() if ok == "True"]
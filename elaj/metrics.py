@@ -0,0 +1,203 @@
+# elaj/metrics.py
+# Тайминги стадий обработки сообщения и счётчики токенов.
+# Внутри одного сообщения спаны копятся в памяти (contextvar), а в Redis пишутся одним
+# pipeline в конце (flush). Гистограммы — общие для всех процессов: hash на стадию и день
+# elaj:metrics:{YYYYMMDD}:{stage} с полями-корзинами (верхняя граница в мс), count и sum.
+# Перцентили считаются по корзинам в /api/metrics.
+import os
+import time
+import json
+import logging
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get("ELAJ_METRICS", "1") == "1"
+METRICS_TTL = 8 * 24 * 3600   # храним неделю (+ запас)
+PREFIX = "elaj:metrics"
+
+# Верхние границы корзин гистограммы, мс (последняя — всё, что дольше)
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 40000, 80000)
+OVERFLOW = "inf"
+
+# Спаны и счётчики текущего сообщения; None — трасса не начата (спаны игнорируются)
+_trace: contextvars.ContextVar[dict | None] = contextvars.ContextVar("elaj_metrics_trace", default=None)
+
+
+def day_key(day: str) -> str:
+    return f"{PREFIX}:{day}"
+
+
+def stage_key(day: str, stage: str) -> str:
+    return f"{PREFIX}:{day}:{stage}"
+
+
+def counters_key(day: str) -> str:
+    return f"{PREFIX}:{day}:counters"
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%d")
+
+
+def bucket_for(ms: float) -> str:
+    for bound in BUCKETS_MS:
+        if ms <= bound:
+            return str(bound)
+    return OVERFLOW
+
+
+def start_trace(**labels):
+    """Начать сбор спанов для текущей задачи (и всех задач, созданных из неё)"""
+    _trace.set({"labels": labels, "spans": [], "counters": {}})
+
+
+def record(stage: str, ms: float):
+    trace = _trace.get()
+    if trace is not None:
+        trace["spans"].append((stage, ms))
+
+
+def count(name: str, value: int = 1):
+    trace = _trace.get()
+    if trace is not None and value:
+        trace["counters"][name] = trace["counters"].get(name, 0) + value
+
+
+@contextmanager
+def span(stage: str):
+    """Замерить стадию: with metrics.span("redis.load_context"): ... (внутри можно await)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, (time.perf_counter() - started) * 1000)
+
+
+def record_usage(usage, prefix: str = "tokens"):
+    """Токены из результата Runner (RunResult.context_wrapper.usage)"""
+    if usage is None:
+        return
+    count(f"{prefix}.input", getattr(usage, "input_tokens", 0) or 0)
+    count(f"{prefix}.output", getattr(usage, "output_tokens", 0) or 0)
+    count(f"{prefix}.requests", getattr(usage, "requests", 0) or 0)
+    details = getattr(usage, "input_tokens_details", None)
+    count(f"{prefix}.cached", getattr(details, "cached_tokens", 0) or 0)
+
+
+async def flush():
+    """Записать спаны и счётчики текущей трассы в Redis одним pipeline и завершить трассу"""
+    trace = _trace.get()
+    _trace.set(None)
+    if trace is None or not METRICS_ENABLED or not (trace["spans"] or trace["counters"]):
+        return
+
+    # Одна строка на сообщение — для поиска медленных ответов в логах
+    logger.info("timings " + json.dumps({
+        **trace["labels"],
+        "spans": {stage: round(ms, 1) for stage, ms in trace["spans"]},
+        "counters": trace["counters"],
+    }, ensure_ascii=False))
+
+    from elaj.storage import redis_client
+    day = _today()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        stages = set()
+        for stage, ms in trace["spans"]:
+            key = stage_key(day, stage)
+            pipe.hincrby(key, bucket_for(ms), 1)
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "sum", round(ms, 3))
+            stages.add(stage)
+        for stage in stages:
+            pipe.expire(stage_key(day, stage), METRICS_TTL)
+        if stages:
+            pipe.sadd(day_key(day), *stages)
+            pipe.expire(day_key(day), METRICS_TTL)
+        for name, value in trace["counters"].items():
+            pipe.hincrby(counters_key(day), name, value)
+        if trace["counters"]:
+            pipe.expire(counters_key(day), METRICS_TTL)
+        await pipe.execute()
+    except Exception as e:
+        # Метрики не должны ронять ответ пользователю
+        logger.warning(f"Metrics flush failed: {e}")
+
+
+def percentile(buckets: dict[str, int], total: int, q: float) -> float | None:
+    """Оценка перцентиля по корзинам (линейно внутри корзины)"""
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for bound in BUCKETS_MS:
+        n = buckets.get(str(bound), 0)
+        if n and seen + n >= rank:
+            return round(lower + (bound - lower) * (rank - seen) / n, 1)
+        seen += n
+        lower = float(bound)
+    return float(BUCKETS_MS[-1])  # дальше последней границы — без оценки
+
+
+async def report(days: int = 1) -> dict:
+    """p50/p95/p99, среднее и число замеров по стадиям, плюс счётчики за последние days дней"""
+    from elaj.storage import redis_client
+    now = datetime.now(timezone.utc)
+    day_list = [(now - timedelta(days=i)).strftime("%Y%m%d") for i in range(max(1, days))]
+
+    pipe = redis_client.pipeline(transaction=False)
+    for day in day_list:
+        pipe.smembers(day_key(day))
+    stage_sets = await pipe.execute()
+
+    pairs = [(day, stage) for day, stages in zip(day_list, stage_sets) for stage in stages or []]
+    pipe = redis_client.pipeline(transaction=False)
+    for day, stage in pairs:
+        pipe.hgetall(stage_key(day, stage))
+    for day in day_list:
+        pipe.hgetall(counters_key(day))
+    results = await pipe.execute()
+
+    merged: dict[str, dict[str, float]] = {}
+    for (day, stage), raw in zip(pairs, results[:len(pairs)]):
+        acc = merged.setdefault(stage, {})
+        for field, value in (raw or {}).items():
+            acc[field] = acc.get(field, 0) + float(value)
+
+    counters: dict[str, int] = {}
+    for raw in results[len(pairs):]:
+        for name, value in (raw or {}).items():
+            counters[name] = counters.get(name, 0) + int(value)
+
+    stages = {}
+    for stage in sorted(merged):
+        acc = merged[stage]
+        total = int(acc.get("count", 0))
+        buckets = {k: int(v) for k, v in acc.items() if k not in ("count", "sum")}
+        stages[stage] = {
+            "count": total,
+            "mean_ms": round(acc.get("sum", 0) / total, 1) if total else None,
+            "p50_ms": percentile(buckets, total, 0.50),
+            "p95_ms": percentile(buckets, total, 0.95),
+            "p99_ms": percentile(buckets, total, 0.99),
+            "over_max": buckets.get(OVERFLOW, 0),
+        }
+    return {"days": day_list, "stages": stages, "counters": counters, "router": _router_savings(stages, counters)}
+
+
+def _router_savings(stages: dict, counters: dict) -> dict:
+    """Оценка сэкономленного маршрутизатором (elaj/router.py): пропущенные запуски агента
+    по среднему времени и токенам запуска агента за тот же период"""
+    saved = counters.get("router.saved_runs", 0)
+    agent = stages.get("agent.run") or {}
+    runs = agent.get("count") or 0
+    return {
+        "saved_runs": saved,
+        "share": round(saved / (saved + runs), 3) if saved + runs else None,
+        "saved_agent_s": round(saved * agent["mean_ms"] / 1000, 1) if runs else None,
+        "saved_input_tokens": saved * counters.get("tokens.input", 0) // runs if runs else None,
+    }
@@ -0,0 +1,158 @@
+# elaj/photo_index.py
+# Индекс доступности фото из каталога (ajaria_realty_hierarchy.md).
+# Все URL каталога проверяются один раз офлайн, результат хранится в Redis
+# (hash elaj:photo_index) и/или в JSON-файле, который едет вместе с деплоем.
+# На горячем пути check_image_urls отвечает по индексу из памяти, без сети.
+#
+# Пересборка: python -m elaj.photo_index [--if-changed] [--output data/photo_index.json]
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+
+from elaj.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.environ.get("ELAJ_CATALOG_PATH", "data/ajaria_realty_hierarchy.md")
+INDEX_PATH = os.environ.get("ELAJ_PHOTO_INDEX_PATH", "data/photo_index.json")
+INDEX_KEY = "elaj:photo_index"
+INDEX_META_KEY = "elaj:photo_index:meta"
+# Как часто процесс сверяет версию индекса в Redis
+RELOAD_INTERVAL = int(os.environ.get("ELAJ_PHOTO_INDEX_RELOAD", "300"))
+BUILD_CONCURRENCY = 16
+
+_URL_RE = re.compile(r'https?://[^\s"\'<>()\[\]]+')
+_IMAGE_EXT = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+
+# Индекс в памяти процесса: url -> True/False
+_index: dict[str, bool] = {}
+_index_version: str | None = None
+_checked_at = 0.0
+
+
+def extract_photo_urls(text: str) -> list[str]:
+    """Все URL изображений из текста каталога (в порядке появления, без повторов)"""
+    urls = []
+    for url in _URL_RE.findall(text):
+        url = url.rstrip(".,;:")
+        if "res.cloudinary.com" in url or url.lower().endswith(_IMAGE_EXT):
+            urls.append(url)
+    return list(dict.fromkeys(urls))
+
+
+def catalog_version(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def _load_file(path: str):
+    global _index, _index_version
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    _index = {url: bool(ok) for url, ok in data.get("urls", {}).items()}
+    _index_version = data.get("version")
+
+
+async def _refresh():
+    """Подтянуть индекс из Redis, если там появилась новая версия"""
+    global _index, _index_version
+    version = await redis_client.hget(INDEX_META_KEY, "version")
+    if version is None or version == _index_version:
+        return
+    raw = await redis_client.hgetall(INDEX_KEY)
+    _index = {url: ok == "1" for url, ok in raw.items()}
+    _index_version = version
+    logger.info(f"Photo index {version} loaded ({len(_index)} urls)")
+
+
+async def lookup(urls: list[str]) -> dict[str, bool]:
+    """Результаты индекса для известных URL (неизвестные в ответ не попадают)"""
+    global _checked_at
+    now = time.monotonic()
+    if now - _checked_at > RELOAD_INTERVAL:
+        _checked_at = now
+        if _index_version is None and os.path.exists(INDEX_PATH):
+            try:
+                _load_file(INDEX_PATH)
+            except Exception as e:
+                logger.warning(f"Photo index file {INDEX_PATH} not loaded: {e}")
+        try:
+            await _refresh()
+        except Exception as e:
+            logger.warning(f"Photo index refresh failed: {e}")
+    return {url: _index[url] for url in urls if url in _index}
+
+
+async def build_index(catalog_path: str = CATALOG_PATH, output: str | None = None, if_changed: bool = False) -> dict:
+    """Проверить все фото каталога и сохранить индекс в Redis (и в файл, если задан output)"""
+    # Импорт здесь: images импортирует этот модуль для lookup
+    from elaj.images import probe_url
+
+    if not os.path.exists(catalog_path):
+        # Каталог не лежит в репозитории — без него индексировать нечего (см. ELAJ_CATALOG_URL)
+        logger.warning(f"Catalog {catalog_path} not found, photo index is not rebuilt")
+        return {"skipped": True, "reason": "no catalog"}
+    with open(catalog_path, encoding="utf-8") as f:
+        text = f.read()
+    version = catalog_version(text)
+
+    if if_changed and await redis_client.hget(INDEX_META_KEY, "version") == version:
+        logger.info(f"Photo index is up to date ({version})")
+        return {"version": version, "skipped": True}
+
+    urls = extract_photo_urls(text)
+    semaphore = asyncio.Semaphore(BUILD_CONCURRENCY)
+
+    async def check(url):
+        async with semaphore:
+            return url, await probe_url(url) == "True"
+
+    results = dict(await asyncio.gather(*(check(url) for url in urls)))
+
+    # Пишем во временный ключ и атомарно подменяем, чтобы читатели не видели полуготовый индекс
+    tmp_key = f"{INDEX_KEY}:tmp:{version}"
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(tmp_key)
+    if results:
+        pipe.hset(tmp_key, mapping={url: "1" if ok else "0" for url, ok in results.items()})
+        pipe.rename(tmp_key, INDEX_KEY)
+    else:
+        pipe.delete(INDEX_KEY)
+    pipe.hset(INDEX_META_KEY, mapping={
+        "version": version,
+        "built_at": int(time.time()),
+        "total": len(results),
+        "invalid": sum(1 for ok in results.values() if not ok),
+    })
+    await pipe.execute()
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({"version": version, "urls": results}, f, ensure_ascii=False, indent=1)
+
+    invalid = [url for url, ok in results.items() if not ok]
+    for url in invalid:
+        logger.warning(f"Broken photo in catalog: {url}")
+    logger.info(f"Photo index {version}: {len(results)} urls, {len(invalid)} broken")
+    return {"version": version, "total": len(results), "invalid": len(invalid)}
+
+
+async def _main(args):
+    from elaj import runtime
+    try:
+        return await build_index(args.catalog, args.output, args.if_changed)
+    finally:
+        await runtime.aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build the catalog photo validity index")
+    parser.add_argument("--catalog", default=CATALOG_PATH)
+    parser.add_argument("--output", default=None, help="also write the index to a JSON file")
+    parser.add_argument("--if-changed", action="store_true", help="skip when the catalog version is unchanged")
+    print(json.dumps(asyncio.run(_main(parser.parse_args()))))
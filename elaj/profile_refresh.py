@@ -0,0 +1,134 @@
+# elaj/profile_refresh.py
+# Фоновое обновление профиля из bot.get_chat (bio и дата рождения).
+# Раньше get_chat вызывался прямо в handle_message_async, до "typing": медленный или
+# упавший запрос к Telegram задерживал ответ. Теперь обработчик только ставит чат
+# в sorted set elaj:profile_refresh (elaj/context.py), а эта задача забирает
+# самые давние чаты пачками и обновляет их с ограничением скорости.
+#
+# Запуск: python -m elaj.profile_refresh [--once]
+# (воркер очереди крутит тот же цикл сам, см. elaj/worker.py)
+import os
+import time
+import asyncio
+import logging
+import argparse
+from datetime import datetime
+
+from elaj import runtime
+from elaj import metrics
+from elaj.storage import redis_client
+from elaj.context import PROFILE_REFRESH_KEY, PROFILE_TTL, profile_key
+
+logger = logging.getLogger(__name__)
+
+CHAT_FETCH_INTERVAL = 60*60*24 * 3   # bio/дату рождения перезапрашиваем раз в 3 суток
+REFRESH_BATCH = int(os.environ.get("ELAJ_PROFILE_REFRESH_BATCH", "50"))
+REFRESH_RATE = float(os.environ.get("ELAJ_PROFILE_REFRESH_RATE", "5"))  # get_chat в секунду
+POLL_INTERVAL = 60
+
+
+def chat_fetch_due(profile: dict) -> bool:
+    """Пора ли обновить bio/дату рождения: по возрасту last_chat_fetch (раз в 3 суток).
+    Отсутствие bio/даты рождения не повод: у многих их просто нет"""
+    last_fetch = profile.get('last_chat_fetch')
+    if not last_fetch:
+        return True
+    try:
+        return (datetime.now() - datetime.fromisoformat(last_fetch)).total_seconds() > CHAT_FETCH_INTERVAL
+    except ValueError:
+        return True
+
+
+async def fetch_chat_fields(bot, chat_id) -> dict[str, str]:
+    """Поля профиля из get_chat; при ошибке — только отметка о попытке"""
+    fields = {}
+    try:
+        chat = await bot.get_chat(chat_id=chat_id)
+
+        # Био / о себе
+        if chat.bio:
+            fields['bio'] = chat.bio.strip()[:500]  # обрезаем на всякий случай
+
+        # Дата рождения
+        if chat.birthdate:
+            fields['birth_day'] = str(chat.birthdate.day)
+            fields['birth_month'] = str(chat.birthdate.month)
+            if getattr(chat.birthdate, 'year', None):
+                fields['birth_year'] = str(chat.birthdate.year)
+    except Exception as e:
+        # Чаще всего — бот не в чате, пользователь заблокировал бота и т.д.
+        logger.info(f"get_chat failed for {chat_id}: {e}")
+
+    # Отмечаем, когда последний раз запрашивали (и после ошибки, чтобы не пытаться слишком часто)
+    fields['last_chat_fetch'] = datetime.now().isoformat()
+    return fields
+
+
+async def refresh_batch(limit: int = REFRESH_BATCH) -> int:
+    """Обновить до limit чатов из очереди (самые давние первыми), вернуть их число"""
+    chat_ids = await redis_client.zrangebyscore(PROFILE_REFRESH_KEY, "-inf", time.time(), start=0, num=limit)
+    if not chat_ids:
+        return 0
+
+    bot = await runtime.get_bot()
+    metrics.start_trace(job="profile_refresh")
+    for chat_id in chat_ids:
+        started = time.monotonic()
+        with metrics.span("telegram.get_chat"):
+            fields = await fetch_chat_fields(bot, chat_id)
+
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(profile_key(chat_id), mapping=fields)
+        pipe.expire(profile_key(chat_id), PROFILE_TTL)
+        pipe.zrem(PROFILE_REFRESH_KEY, chat_id)
+        await pipe.execute()
+
+        # Не чаще REFRESH_RATE запросов в секунду — get_chat делит лимиты с ответами бота
+        await asyncio.sleep(max(0.0, 1 / REFRESH_RATE - (time.monotonic() - started)))
+
+    await metrics.flush()
+    logger.info(f"Refreshed {len(chat_ids)} profiles")
+    return len(chat_ids)
+
+
+async def refresh_all() -> int:
+    """Разобрать всю очередь обновления"""
+    total = 0
+    while True:
+        count = await refresh_batch()
+        total += count
+        if count < REFRESH_BATCH:
+            return total
+
+
+async def refresh_loop():
+    """Бесконечный цикл для долгоживущего процесса (воркера)"""
+    while True:
+        try:
+            await refresh_all()
+        except Exception as e:
+            logger.error(f"Profile refresh failed: {e}")
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def _main(once: bool):
+    await runtime.attach()
+    try:
+        if once:
+            count = await refresh_all()
+            logger.info(f"Profile refresh done: {count} chats")
+        else:
+            await refresh_loop()
+    finally:
+        await runtime.aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Background bot.get_chat profile refresher")
+    parser.add_argument("--once", action="store_true", help="process the current queue and exit")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_main(args.once))
+    except KeyboardInterrupt:
+        pass
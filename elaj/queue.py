@@ -0,0 +1,63 @@
+# elaj/queue.py
+# Очередь входящих Telegram update в Redis Stream.
+# Webhook только кладёт update в стрим и сразу отвечает 200,
+# обработку выполняет воркер (elaj/worker.py) через consumer group.
+#
+# Записи одного чата разные воркеры получают вперемешку, поэтому у каждой записи
+# есть номер в чате (seq): elaj:chatorder:{chat_id} — hash {seq: выдано, done: обработано}.
+# Воркер берёт запись seq, только когда done >= seq - 1 (или предыдущая зависла дольше ORDER_WAIT).
+import os
+import json
+
+from elaj.storage import redis_client
+
+STREAM_KEY = os.environ.get("ELAJ_STREAM_KEY", "elaj:updates")
+STREAM_GROUP = os.environ.get("ELAJ_STREAM_GROUP", "elaj-workers")
+# Приблизительный предел длины стрима (старые подтверждённые записи вытесняются)
+STREAM_MAXLEN = int(os.environ.get("ELAJ_STREAM_MAXLEN", "10000"))
+ORDER_TTL = 24 * 3600
+# Записи, которые воркер так и не смог обработать (elaj/worker.py, MAX_ATTEMPTS)
+DEAD_KEY = f"{STREAM_KEY}:dead"
+
+# Выдать номер в чате и добавить запись одной операцией: порядок seq совпадает с порядком в стриме
+# KEYS: стрим, порядок чата; ARGV: maxlen, chat_id, update, ttl
+_ENQUEUE_SCRIPT = """
+local seq = redis.call('hincrby', KEYS[2], 'seq', 1)
+redis.call('expire', KEYS[2], ARGV[4])
+return redis.call('xadd', KEYS[1], 'MAXLEN', '~', ARGV[1], '*',
+  'chat_id', ARGV[2], 'seq', seq, 'update', ARGV[3])
+"""
+# Отметить запись seq обработанной (done только растёт)
+_DONE_SCRIPT = """
+if tonumber(redis.call('hget', KEYS[1], 'done') or '0') < tonumber(ARGV[1]) then
+  redis.call('hset', KEYS[1], 'done', ARGV[1])
+  redis.call('expire', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+def order_key(chat_id) -> str:
+    return f"elaj:chatorder:{chat_id}"
+
+
+async def enqueue_update(update: dict, chat_id: int) -> str:
+    """Положить update в стрим, вернуть id записи"""
+    return await redis_client.eval(
+        _ENQUEUE_SCRIPT, 2, STREAM_KEY, order_key(chat_id),
+        STREAM_MAXLEN, str(chat_id), json.dumps(update, ensure_ascii=False), ORDER_TTL,
+    )
+
+
+async def turn_ready(chat_id, seq) -> bool:
+    """Обработаны ли все предыдущие записи чата (записи без seq — из старой версии — сразу)"""
+    if not seq:
+        return True
+    done = await redis_client.hget(order_key(chat_id), "done")
+    return int(done or 0) >= int(seq) - 1
+
+
+async def finish_turn(chat_id, seq):
+    """Пропустить следующую запись чата"""
+    if seq:
+        await redis_client.eval(_DONE_SCRIPT, 1, order_key(chat_id), int(seq), ORDER_TTL)
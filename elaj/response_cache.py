@@ -0,0 +1,119 @@
+# elaj/response_cache.py
+# Кэш ответов агента на повторяющиеся вопросы ("сколько стоит", "какая доходность", ...).
+# Ключ — нормализованный вопрос + грубый отпечаток контекста (язык, комплекс, о котором речь).
+# Версия кэша включает хэш исходника агента (инструкции, модель), версию каталога и счётчик поколений,
+# поэтому при их изменении старые ответы становятся недоступны и истекают по TTL.
+# LRU: sorted set с временем последнего обращения, лишние записи вытесняются при записи.
+import os
+import re
+import time
+import hashlib
+import logging
+from functools import lru_cache
+
+from elaj.storage import redis_client
+from elaj.photo_index import INDEX_META_KEY
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.environ.get("ELAJ_RESPONSE_CACHE", "1") == "1"
+CACHE_TTL = int(os.environ.get("ELAJ_RESPONSE_CACHE_TTL", str(24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.environ.get("ELAJ_RESPONSE_CACHE_MAX", "5000"))
+MAX_QUESTION_CHARS = 200     # длинные вопросы почти не повторяются — не кэшируем
+VERSION_REFRESH = 60         # как часто перечитывать версию из Redis, сек
+
+PREFIX = "elaj:rcache"
+LRU_KEY = f"{PREFIX}:lru"
+STATS_KEY = f"{PREFIX}:stats"
+GEN_KEY = f"{PREFIX}:gen"
+
+_WORD_RE = re.compile(r"[\w']+", re.UNICODE)
+
+_version: str | None = None
+_version_checked = 0.0
+
+
+def normalize_question(text: str) -> str:
+    """Нижний регистр, без пунктуации/эмодзи, одиночные пробелы, ё→е"""
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return " ".join(words)
+
+
+def is_cacheable(text: str) -> bool:
+    normalized = normalize_question(text)
+    return 0 < len(normalized) <= MAX_QUESTION_CHARS and not text.strip().startswith("/")
+
+
+@lru_cache(maxsize=1)
+def _instructions_version() -> str:
+    # Хэш файла elaj/agent.py, а не вызов инструкций: импорт agent тянет Agents SDK,
+    # а попадание в кэш должно обходиться без него. Любая правка агента сбрасывает кэш
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.py")
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:8]
+
+
+async def _current_version() -> str:
+    """Версия кэша: инструкции + версия каталога + поколение (перечитывается раз в минуту)"""
+    global _version, _version_checked
+    now = time.monotonic()
+    if _version is None or now - _version_checked > VERSION_REFRESH:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(GEN_KEY)
+        pipe.hget(INDEX_META_KEY, "version")
+        generation, catalog = await pipe.execute()
+        _version = f"{_instructions_version()}.{catalog or '-'}.{generation or 0}"
+        _version_checked = now
+    return _version
+
+
+def _entry_key(version: str, question: str, fingerprint: dict) -> str:
+    parts = [question] + [f"{k}={fingerprint[k] or ''}" for k in sorted(fingerprint)]
+    digest = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+    return f"{PREFIX}:{version}:{digest}"
+
+
+async def get(text: str, fingerprint: dict) -> str | None:
+    """Ответ из кэша или None (попадания/промахи считаются в elaj:rcache:stats)"""
+    if not CACHE_ENABLED or not is_cacheable(text):
+        return None
+    key = _entry_key(await _current_version(), normalize_question(text), fingerprint)
+    response = await redis_client.get(key)
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hincrby(STATS_KEY, "hits" if response is not None else "misses", 1)
+    if response is not None:
+        pipe.zadd(LRU_KEY, {key: time.time()})
+    await pipe.execute()
+    return response
+
+
+async def put(text: str, fingerprint: dict, response: str):
+    """Сохранить ответ; при переполнении вытеснить давно не использованные записи"""
+    if not CACHE_ENABLED or not is_cacheable(text) or not response:
+        return
+    key = _entry_key(await _current_version(), normalize_question(text), fingerprint)
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(key, response, ex=CACHE_TTL)
+    pipe.zadd(LRU_KEY, {key: time.time()})
+    pipe.zcard(LRU_KEY)
+    size = (await pipe.execute())[-1]
+
+    if size > CACHE_MAX_ENTRIES:
+        evicted = await redis_client.zpopmin(LRU_KEY, size - CACHE_MAX_ENTRIES)
+        if evicted:
+            await redis_client.delete(*[member for member, _score in evicted])
+            await redis_client.hincrby(STATS_KEY, "evictions", len(evicted))
+
+
+async def invalidate():
+    """Сбросить весь кэш (новое поколение ключей)"""
+    global _version
+    await redis_client.incr(GEN_KEY)
+    _version = None
+
+
+async def stats() -> dict:
+    raw = await redis_client.hgetall(STATS_KEY)
+    return {k: int(v) for k, v in raw.items()}
@@ -0,0 +1,228 @@
+# elaj/router.py
+# Маршрутизация сообщений перед агентом: тривиальные сообщения ("привет", "спасибо",
+# "контакт менеджера") не стоят полного запуска gpt-4.1 с FileSearchTool.
+# Локальные правила делят сообщения на три маршрута:
+#   template — готовый ответ без вызова модели;
+#   light    — короткая болтовня без вопросов о недвижимости: дешёвая модель без инструментов;
+#   agent    — всё остальное (и всё, в чём правила не уверены).
+# Решения пишутся в лог и счётчики метрик (router.*), оценка сэкономленного — в /api/metrics.
+# faq_intent выделяет среди вопросов агенту типовые (рассрочка, доходность, ВНЖ...): их ответы
+# общие для всех пользователей и кэшируются (elaj/response_cache.py).
+import os
+import re
+import random
+import logging
+from dataclasses import dataclass
+
+from elaj import runtime
+from elaj import metrics
+from elaj.response_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+ROUTER_ENABLED = os.environ.get("ELAJ_ROUTER", "1") == "1"
+ROUTER_MODEL = os.environ.get("ELAJ_ROUTER_MODEL", "gpt-4.1-nano")  # "" — болтовня идёт к агенту
+SMALLTALK_MAX_WORDS = 8
+
+TEMPLATE = "template"
+LIGHT = "light"
+AGENT = "agent"
+
+MANAGER = "@ninaabramia97 (Нина)"
+
+# Тривиальные фразы по намерениям; сообщение целиком должно состоять из них (и слов-связок)
+INTENT_PATTERNS = {
+    "manager": r"(?:контакт\w*|связаться|связь|телефон|номер)?\s*(?:с\s+)?(?:менеджер\w*|оператор\w*|живо\w* человек\w*|manager|operator|contact(?: manager)?)",
+    "thanks": r"спасибо|благодар\w*|спс|thanks?(?: you)?|thx|мадлоба",
+    "bye": r"пока|до свидания|до встречи|всего доброго|всего хорошего|bye|goodbye|see you",
+    "greeting": r"привет\w*|здравствуй\w*|добр\w+ (?:день|вечер|утро|времени суток)|доброе утро|hi|hello|hey|good (?:morning|afternoon|evening)|салам\w*|гамарджоба",
+    "ack": r"ок|окей|ok|okay|хорошо|понятно|ясно|понял\w*|отлично|супер|класс",
+}
+FILLER = {"и", "а", "вам", "тебе", "большое", "огромное", "еще", "раз", "очень", "so", "much", "very", "again", "дайте", "дай", "можно", "пожалуйста", "please", "нужен", "нужна"}
+# Приоритет, если в сообщении несколько намерений ("привет, дайте контакт менеджера")
+INTENT_ORDER = ("manager", "thanks", "bye", "greeting", "ack")
+
+# Признаки вопроса по делу (начала слов): такие сообщения всегда идут агенту
+DOMAIN_RE = re.compile(
+    r"\d|\b(?:квартир|апарт|недвиж|объект|комплекс|жк|цен|стоим|стоит|доход|аренд|сда|снять|куп|покуп|прод|инвест|"
+    r"район|батуми|кобулети|гонио|махинджаури|аджари|грузи|фото|вид|мор|метр|спальн|студи|ипотек|рассроч|бюджет|"
+    r"калькул|этаж|застрой|сдач|ремонт|налог|виз|гражданств|"
+    r"price|cost|apartment|flat|property|estate|rent|buy|invest|photo|sea|batumi|kobuleti|gonio|georgia|budget|yield)"
+)
+
+# Типовые вопросы, ответ на которые не зависит от пользователя (начала слов)
+FAQ_PATTERNS = {
+    "installment": r"рассроч|ипотек|кредит|installment|mortgage",
+    "yield": r"доходн|окупаем|yield|roi\b",
+    "residency": r"вид на жительств|внж|гражданств|резидентств|виз[аыу]?\b|residen|citizenship|visa",
+    "taxes": r"налог|tax",
+    "purchase": r"как (?:купить|оформить|проходит)|процесс покупки|документ|нотариус|иностран|how (?:to|do i|can i) buy|foreigner",
+    "districts": r"как(?:ой|ие) район|(?:which|what) (?:area|district)",
+    "management": r"управлени\w* (?:аренд|недвиж|апарт|объект)|property management",
+}
+FAQ_MAX_WORDS = 15
+# Слова, отсылающие к разговору или к самому клиенту: с ними вопрос уже не типовой
+CONTEXT_WORDS = {
+    "этот", "эта", "это", "эти", "этого", "этой", "этих", "этом", "тот", "та", "те", "там", "тут", "здесь",
+    "он", "она", "они", "него", "нее", "ней", "них", "ему", "им", "их", "мне", "меня", "мой", "моя", "мое",
+    "мои", "моего", "моей", "моих", "мы", "нас", "нам", "наш", "наша", "наши", "еще", "тоже", "также",
+    "вариант", "варианта", "варианты", "варианте", "вариантов",
+    "it", "this", "that", "these", "those", "there", "my", "me", "i", "we", "our", "us", "also", "too",
+    "again", "they", "them", "he", "she", "option", "options",
+}
+
+_FAQ_RE = re.compile("|".join(f"(?P<{name}>\\b(?:{pattern}))" for name, pattern in FAQ_PATTERNS.items()))
+_INTENT_RE = re.compile("|".join(f"(?P<{name}>\\b(?:{pattern})\\b)" for name, pattern in INTENT_PATTERNS.items()))
+
+TEMPLATES = {
+    "ru": {
+        "greeting": [
+            "Здравствуйте! 🌊 Я — Эладж, агент по недвижимости на побережье Аджарии.\n\n"
+            "Подобрать апартаменты для покупки или отдыха, рассчитать доходность? Расскажите, что ищете.",
+            "Привет! 👋 На связи Эладж.\n\n"
+            "Помогу выбрать апартаменты у моря в Батуми, Кобулети или Гонио. Что вас интересует?",
+        ],
+        "thanks": [
+            "Пожалуйста! 😊 Если появятся вопросы — пишите, я на связи.\n\n"
+            f"Обсудить детали покупки или аренды можно с менеджером → {MANAGER}",
+            "Рад помочь! 🌊 Захотите посмотреть ещё варианты или рассчитать доходность — просто напишите.",
+        ],
+        "bye": [
+            "Всего доброго! 🌊 Будут вопросы — пишите в любое время.\n\n"
+            f"Менеджер → {MANAGER}",
+        ],
+        "manager": [
+            f"Менеджер → {MANAGER} 📩\n\n"
+            "Напишите ей напрямую в Телеграм: ответит по покупке, аренде и просмотрам объектов.",
+        ],
+        "ack": [
+            "Отлично! 👍 Если захотите подобрать объект или рассчитать доходность — напишите, что важно.",
+        ],
+    },
+    "en": {
+        "greeting": [
+            "Hello! 🌊 I'm Elaj, your real estate agent on the Adjara coast.\n\n"
+            "Looking to buy, rent for a holiday or estimate rental yield? Tell me what you need.",
+        ],
+        "thanks": [
+            "You're welcome! 😊 Feel free to write if you have more questions.\n\n"
+            f"For purchase or rental details, contact our manager → {MANAGER}",
+        ],
+        "bye": [
+            f"Goodbye! 🌊 Write any time.\n\nManager → {MANAGER}",
+        ],
+        "manager": [
+            f"Our manager → {MANAGER} 📩\n\n"
+            "Message her on Telegram about purchase, rental and viewings.",
+        ],
+        "ack": [
+            "Great! 👍 Whenever you want to pick a property or estimate the yield, just tell me what matters.",
+        ],
+    },
+}
+
+LIGHT_INSTRUCTIONS = (
+    "Вы — Эладж, дружелюбный агент по премиум-недвижимости на черноморском побережье Аджарии "
+    "(Батуми, Кобулети, Гонио). Клиент написал короткое сообщение не по делу. Ответьте тепло и кратко "
+    "(до 300 символов), на языке клиента, с эмодзи, без выдуманных фактов об объектах и ценах. "
+    "В конце предложите помочь с подбором апартаментов или расчётом доходности. "
+    f"Контакт менеджера в Телеграм: {MANAGER} — упоминайте, только если уместно."
+)
+
+
+@dataclass
+class Route:
+    kind: str               # TEMPLATE / LIGHT / AGENT
+    intent: str             # намерение или причина выбора агента
+    reply: str | None = None
+
+
+def language(text: str, language_code: str | None) -> str:
+    if re.search(r"[а-яё]", text, re.IGNORECASE):
+        return "ru"
+    if re.search(r"[a-z]", text, re.IGNORECASE):
+        return "en"
+    return "ru" if (language_code or "ru").startswith("ru") else "en"
+
+
+def _asks_question(history: list[dict]) -> bool:
+    """Закончился ли последний ответ бота вопросом (тогда "хорошо"/"ок" — это ответ на него)"""
+    for msg in reversed(history):
+        if msg["role"] == "assistant":
+            return "?" in msg["content"].rstrip()[-200:]
+    return False
+
+
+def classify(text: str, history: list[dict] | None = None) -> tuple[str, str]:
+    """(маршрут, намерение) по локальным правилам; history — диалог до текущего сообщения"""
+    if not ROUTER_ENABLED or text.strip().startswith("/"):
+        return AGENT, "disabled" if not ROUTER_ENABLED else "command"
+
+    normalized = normalize_question(text)
+    if DOMAIN_RE.search(normalized):
+        return AGENT, "domain"
+
+    intents = [m.lastgroup for m in _INTENT_RE.finditer(normalized)]
+    rest = [word for word in _INTENT_RE.sub(" ", normalized).split() if word not in FILLER]
+    intent = next((name for name in INTENT_ORDER if name in intents), None)
+
+    if intent is None:
+        return AGENT, "unknown"
+    if (intent == "ack" or rest) and _asks_question(history or []):
+        # "хорошо, давайте" в ответ на "Подобрать варианты?" — это продолжение разговора
+        return AGENT, "answer"
+    if not rest:
+        return TEMPLATE, intent
+    if ROUTER_MODEL and len(rest) <= SMALLTALK_MAX_WORDS and intent != "manager":
+        return LIGHT, f"smalltalk.{intent}"
+    return AGENT, "mixed"
+
+
+def route(text: str, history: list[dict] | None = None, language_code: str | None = None) -> Route:
+    kind, intent = classify(text, history)
+    if kind == TEMPLATE:
+        return Route(kind, intent, random.choice(TEMPLATES[language(text, language_code)][intent]))
+    return Route(kind, intent)
+
+
+def faq_intent(text: str) -> str | None:
+    """Тема типового вопроса (ответ один для всех пользователей) или None — вопрос личный,
+    ссылается на разговор ("а там есть рассрочка?") или не из списка FAQ"""
+    normalized = normalize_question(text)
+    words = normalized.split()
+    if not words or text.strip().startswith("/") or len(words) > FAQ_MAX_WORDS:
+        return None
+    if any(word in CONTEXT_WORDS for word in words):
+        return None
+    m = _FAQ_RE.search(normalized)
+    return m.lastgroup if m else None
+
+
+async def light_reply(text: str, history: list[dict]) -> str:
+    """Ответ дешёвой модели без инструментов (контекст — две последние реплики)"""
+    recent = "\n".join(
+        f"{'Клиент' if msg['role'] == 'user' else 'Эладж'}: {msg['content'][:300]}" for msg in history[-2:]
+    )
+    client = runtime.ensure_openai()
+    response = await client.responses.create(
+        model=ROUTER_MODEL,
+        instructions=LIGHT_INSTRUCTIONS,
+        input=(f"Предыдущие реплики:\n{recent}\n\n" if recent else "") + f"Сообщение клиента:\n{text}",
+        max_output_tokens=200,
+        store=False,
+    )
+    metrics.record_usage(response.usage, prefix="tokens.router")
+    return (response.output_text or "").strip()
+
+
+def log_decision(chat_id: int, decision: Route, fallback: bool = False):
+    """Решение маршрутизатора: строка в лог и счётчики router.* (сэкономленные запуски агента)"""
+    kind = AGENT if fallback else decision.kind
+    metrics.count(f"router.{kind}")
+    metrics.count(f"router.intent.{decision.intent}")
+    if kind != AGENT:
+        metrics.count("router.saved_runs")
+    logger.info(
+        f"Route for chat {chat_id}: {kind} (intent={decision.intent}"
+        f"{', light model failed' if fallback else ''})"
+    )
@@ -0,0 +1,186 @@
+# elaj/runtime.py
+# Долгоживущий рантайм процесса: один event loop на процесс,
+# общий Telegram Bot и общий пул HTTP-соединений (Telegram + OpenAI).
+# На "тёплом" инстансе все вызовы webhook переиспользуют одни и те же
+# TLS-соединения вместо установки новых на каждое сообщение.
+#
+# Тяжёлые SDK (telegram, openai, agents, httpx) импортируются при первом использовании,
+# а не при импорте модуля: холодный старт функции и GET health check их не ждут.
+import os
+import sys
+import asyncio
+import atexit
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Размер пула соединений (на каждого клиента) и таймауты
+HTTP_POOL_SIZE = int(os.environ.get("ELAJ_HTTP_POOL_SIZE", "32"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("ELAJ_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("ELAJ_HTTP_READ_TIMEOUT", "30"))
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка нагрузочного теста bench/load.py)
+TELEGRAM_API_URL = os.environ.get("ELAJ_TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+_lock = threading.Lock()
+_loop: asyncio.AbstractEventLoop | None = None
+_thread: threading.Thread | None = None
+_bot = None            # telegram.Bot
+_openai_http = None    # httpx.AsyncClient клиента OpenAI
+_openai_client = None  # openai.AsyncOpenAI (тот же, что у Agents SDK)
+_http = None           # httpx.AsyncClient для прочих запросов
+_start_lock = asyncio.Lock()
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+async def _startup():
+    """Создать общий Bot внутри event loop рантайма (один раз)"""
+    global _bot
+    if _bot is not None:
+        return
+
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    bot = Bot(
+        token=os.environ["TELEGRAM_BOT_TOKEN"],
+        base_url=TELEGRAM_API_URL,
+        request=HTTPXRequest(
+            connection_pool_size=HTTP_POOL_SIZE,
+            connect_timeout=HTTP_CONNECT_TIMEOUT,
+            read_timeout=HTTP_READ_TIMEOUT,
+            pool_timeout=HTTP_CONNECT_TIMEOUT,
+        ),
+    )
+    await bot.initialize()
+    _bot = bot
+    logger.info("Runtime started (pool=%s)", HTTP_POOL_SIZE)
+
+
+def ensure_openai():
+    """Общий клиент OpenAI; при первом вызове настраивается и для Agents SDK"""
+    global _openai_http, _openai_client
+    if _openai_client is not None:
+        return _openai_client
+
+    import httpx
+    from openai import AsyncOpenAI
+    from agents import set_default_openai_client
+
+    # Общий httpx-клиент для OpenAI: keep-alive соединения живут между сообщениями
+    _openai_http = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE,
+        ),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT * 4, connect=HTTP_CONNECT_TIMEOUT),
+    )
+    _openai_client = AsyncOpenAI(http_client=_openai_http)
+    set_default_openai_client(_openai_client)
+    return _openai_client
+
+
+async def _shutdown():
+    """Аккуратно закрыть общие клиенты"""
+    global _bot, _openai_http, _openai_client, _http
+    if _bot is not None:
+        try:
+            await _bot.shutdown()
+        except Exception as e:
+            logger.warning(f"Bot shutdown failed: {e}")
+        _bot = None
+    if _openai_http is not None:
+        await _openai_http.aclose()
+        _openai_http = None
+        _openai_client = None
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+    # Redis закрываем, только если он вообще понадобился этому процессу
+    storage = sys.modules.get("elaj.storage")
+    if storage is not None:
+        await storage.close()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Вернуть event loop процесса (создаётся и запускается один раз)"""
+    global _loop, _thread
+    if _loop is not None:
+        return _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_loop, args=(loop,), name="elaj-runtime", daemon=True)
+            thread.start()
+            _loop, _thread = loop, thread
+            atexit.register(shutdown)
+    return _loop
+
+
+async def attach():
+    """Сделать текущий (уже запущенный) event loop loop-ом рантайма — для воркера"""
+    global _loop
+    with _lock:
+        if _loop is not None:
+            raise RuntimeError("Runtime event loop is already running")
+        _loop = asyncio.get_running_loop()
+    await get_bot()
+
+
+async def aclose():
+    """Закрыть клиенты рантайма, подключённого через attach()"""
+    global _loop
+    await _shutdown()
+    _loop = None
+
+
+def run(coro, timeout: float | None = None):
+    """Выполнить корутину в общем event loop и дождаться результата (из синхронного кода)"""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    return future.result(timeout)
+
+
+async def get_bot():
+    """Общий экземпляр telegram.Bot (соединения с Telegram переиспользуются).
+    Создаётся при первом обращении, поэтому эндпоинты без бота (log_event) его не поднимают."""
+    if _bot is None:
+        async with _start_lock:
+            await _startup()
+    return _bot
+
+
+def get_http_client():
+    """Общий httpx-клиент для прочих исходящих запросов (проверка изображений и т.п.)"""
+    global _http
+    if _http is None:
+        import httpx
+        _http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+    return _http
+
+
+def shutdown():
+    """Закрыть клиенты и остановить event loop (вызывается при завершении процесса)"""
+    global _loop, _thread
+    with _lock:
+        loop, thread = _loop, _thread
+        if loop is None or thread is None:
+            # loop не создан или принадлежит воркеру (закрывается через aclose)
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), loop).result(10)
+        except Exception as e:
+            logger.warning(f"Runtime shutdown failed: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        loop.close()
+        _loop, _thread = None, None
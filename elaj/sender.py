@@ -0,0 +1,192 @@
+# elaj/sender.py
+# Исходящие вызовы Telegram с учётом лимитов: ~30 сообщений в секунду на бота,
+# ~1 в секунду в один чат (короткие всплески допустимы), 20 в минуту в группу.
+# Раньше send_* уходили сразу, а RetryAfter (429) попадал в общий except и пользователь
+# получал "Техническая заминка". Теперь каждый вызов берёт токены из двух корзин —
+# общей и чата — одним EVAL в Redis (корзины общие для всех процессов webhook и воркеров),
+# при нехватке ждёт, а на RetryAfter засыпает на retry_after и повторяет.
+# Ответы пользователям (REPLY) важнее фоновых отправок (BACKGROUND): фоновым оставляется
+# запас общей корзины, промежуточные правки стримингом при нехватке просто пропускаются.
+import os
+import time
+import asyncio
+import logging
+
+from elaj import metrics
+from elaj.storage import redis_client
+
+logger = logging.getLogger(__name__)
+
+SEND_ENABLED = os.environ.get("ELAJ_SEND_LIMITS", "1") == "1"
+GLOBAL_RATE = float(os.environ.get("ELAJ_SEND_GLOBAL_RATE", "25"))    # сообщений в секунду на бота
+GLOBAL_BURST = float(os.environ.get("ELAJ_SEND_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.environ.get("ELAJ_SEND_CHAT_RATE", "1"))         # в личный чат
+CHAT_BURST = float(os.environ.get("ELAJ_SEND_CHAT_BURST", "4"))
+GROUP_RATE = 20 / 60                                                   # в группу: 20 в минуту
+BACKGROUND_RESERVE = GLOBAL_BURST * 0.3   # столько токенов общей корзины фоновым не достаётся
+MAX_WAIT = float(os.environ.get("ELAJ_SEND_MAX_WAIT", "30"))          # дольше не ждём, сек
+MAX_RETRIES = 3
+
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+
+REPLY = "reply"
+BACKGROUND = "background"
+
+PREFIX = "elaj:send"
+GLOBAL_KEY = f"{PREFIX}:global"
+
+# Корзины: hash {t: токены, ts: мс}. Вернуть 0 и списать cost или сколько мс подождать.
+# Время передаётся процессом (часы процессов примерно совпадают, ошибка — доли секунды)
+_TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local function level(key, rate, burst)
+  local b = redis.call('hmget', key, 't', 'ts')
+  local tokens = tonumber(b[1]) or burst
+  local ts = tonumber(b[2]) or now
+  return math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+end
+local g_rate, g_burst = tonumber(ARGV[2]), tonumber(ARGV[3])
+local c_rate, c_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local cost, reserve = tonumber(ARGV[6]), tonumber(ARGV[7])
+local g = level(KEYS[1], g_rate, g_burst)
+local c = level(KEYS[2], c_rate, c_burst)
+local g_cost = math.min(cost, g_burst - reserve)
+local c_cost = math.min(cost, c_burst)
+local wait = 0
+if g - reserve < g_cost then wait = math.max(wait, (g_cost + reserve - g) * 1000 / g_rate) end
+if c < c_cost then wait = math.max(wait, (c_cost - c) * 1000 / c_rate) end
+if wait == 0 then
+  g = g - g_cost
+  c = c - c_cost
+end
+redis.call('hset', KEYS[1], 't', tostring(g), 'ts', ARGV[1])
+redis.call('pexpire', KEYS[1], 60000)
+redis.call('hset', KEYS[2], 't', tostring(c), 'ts', ARGV[1])
+redis.call('pexpire', KEYS[2], 120000)
+return math.ceil(wait)
+"""
+
+
+def chat_key(chat_id) -> str:
+    return f"{PREFIX}:chat:{chat_id}"
+
+
+def _chat_rate(chat_id) -> float:
+    # У групп и каналов id отрицательные
+    return GROUP_RATE if int(chat_id) < 0 else CHAT_RATE
+
+
+async def _take(chat_id, cost: int, priority: str) -> float:
+    """Списать токены; 0 — можно отправлять, иначе сколько секунд подождать"""
+    reserve = BACKGROUND_RESERVE if priority == BACKGROUND else 0
+    wait_ms = await redis_client.eval(
+        _TAKE_SCRIPT, 2, GLOBAL_KEY, chat_key(chat_id),
+        int(time.time() * 1000), GLOBAL_RATE, GLOBAL_BURST, _chat_rate(chat_id), CHAT_BURST, cost, reserve,
+    )
+    return int(wait_ms) / 1000
+
+
+async def acquire(chat_id, cost: int = 1, priority: str = REPLY, block: bool = True) -> bool:
+    """Дождаться места в корзинах (не дольше MAX_WAIT); block=False — не ждать, а вернуть False"""
+    if not SEND_ENABLED:
+        return True
+    started = time.monotonic()
+    waited = False
+    while True:
+        try:
+            wait = await _take(chat_id, cost, priority)
+        except Exception as e:
+            # Без Redis отправляем как раньше — лимиты подстрахует обработка RetryAfter
+            logger.warning(f"Send limiter unavailable: {e}")
+            return True
+        if wait == 0:
+            break
+        if not block:
+            metrics.count("telegram.skipped")
+            return False
+        if time.monotonic() - started + wait > MAX_WAIT:
+            logger.warning(f"Send to chat {chat_id} throttled for {MAX_WAIT}s, sending anyway")
+            break
+        await asyncio.sleep(wait)
+        waited = True
+    if waited:
+        metrics.record("telegram.throttle", (time.monotonic() - started) * 1000)
+    return True
+
+
+async def _penalize(chat_id, seconds: float):
+    """После RetryAfter корзина чата уходит в минус — остальные процессы тоже подождут"""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(chat_key(chat_id), mapping={"t": str(-seconds * _chat_rate(chat_id)), "ts": int(time.time() * 1000)})
+        pipe.pexpire(chat_key(chat_id), 120000)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Send limiter penalty failed: {e}")
+
+
+def _seconds(retry_after) -> float:
+    # В новых версиях python-telegram-bot retry_after — timedelta
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+async def call(method, chat_id, *, cost: int = 1, priority: str = REPLY, **kwargs):
+    """Вызвать метод бота (bot.send_message и т.п.) с лимитами и повтором после RetryAfter"""
+    from telegram.error import RetryAfter
+
+    await acquire(chat_id, cost, priority)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await method(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            seconds = _seconds(e.retry_after)
+            metrics.count("telegram.retry_after")
+            if attempt == MAX_RETRIES or seconds > MAX_WAIT:
+                raise
+            logger.warning(f"Telegram flood control for chat {chat_id}: retry in {seconds}s")
+            await _penalize(chat_id, seconds)
+            with metrics.span("telegram.throttle"):
+                await asyncio.sleep(seconds)
+
+
+async def typing(bot, chat_id):
+    """"Печатает..." — без очереди и без повторов: при флуд-контроле просто пропускаем"""
+    from telegram.error import RetryAfter
+    try:
+        await bot.send_chat_action(chat_id=chat_id, action="typing")
+    except RetryAfter:
+        metrics.count("telegram.skipped")
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Разбить текст на части не длиннее limit — по абзацам, строкам, словам"""
+    chunks = []
+    while len(text) > limit:
+        # Самый крупный разрыв во второй половине куска, иначе — жёстко по limit
+        cut = next((pos for pos in (text.rfind(sep, 0, limit + 1) for sep in ("\n\n", "\n", " "))
+                    if pos >= limit // 2), limit)
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def split_caption(text: str) -> tuple[str, list[str]]:
+    """Подпись к фото (до 1024) и остаток текста сообщениями по 4096"""
+    if len(text) <= CAPTION_LIMIT:
+        return text, []
+    caption = split_text(text, CAPTION_LIMIT)[0]
+    return caption, split_text(text[len(caption):].lstrip())
+
+
+async def send_text(bot, chat_id, text: str, priority: str = REPLY, reply_to_message_id: int | None = None, **kwargs):
+    """Отправить текст любой длины (частями по 4096); ответом на сообщение — только первую часть"""
+    messages = []
+    for i, chunk in enumerate(split_text(text)):
+        messages.append(await call(
+            bot.send_message, chat_id, priority=priority, text=chunk,
+            reply_to_message_id=reply_to_message_id if i == 0 else None, **kwargs,
+        ))
+    return messages
@@ -0,0 +1,53 @@
+# elaj/storage.py
+# Общий асинхронный доступ к Redis для webhook, log_event и воркера.
+# Один пул соединений на процесс: конкурентные чаты ждут Redis параллельно,
+# не блокируя event loop рантайма (elaj/runtime.py).
+import os
+import redis.asyncio as aioredis
+
+# Размер пула, таймауты и интервал health-check настраиваются через окружение
+REDIS_POOL_SIZE = int(os.environ.get("ELAJ_REDIS_POOL_SIZE", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("ELAJ_REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("ELAJ_REDIS_CONNECT_TIMEOUT", "3"))
+REDIS_POOL_TIMEOUT = float(os.environ.get("ELAJ_REDIS_POOL_TIMEOUT", "5"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("ELAJ_REDIS_HEALTH_CHECK_INTERVAL", "30"))
+# Таймаут сокета для блокирующих чтений стрима (XREADGROUP BLOCK): должен быть заметно больше BLOCK
+REDIS_STREAM_SOCKET_TIMEOUT = float(os.environ.get("ELAJ_REDIS_STREAM_SOCKET_TIMEOUT", "30"))
+
+# ===== ИНИЦИАЛИЗАЦИЯ REDIS =====
+# BlockingConnectionPool: при исчерпании пула ждём свободное соединение (до REDIS_POOL_TIMEOUT),
+# а не открываем новые без ограничений
+_pool = aioredis.BlockingConnectionPool.from_url(
+    os.environ.get("REDIS_URL"),
+    max_connections=REDIS_POOL_SIZE,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    socket_keepalive=True,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    retry_on_timeout=True,
+    decode_responses=True,
+)
+redis_client = aioredis.Redis(connection_pool=_pool)
+
+# Отдельный небольшой пул для XREADGROUP BLOCK воркера. С общим socket_timeout пустой BLOCK 5000
+# упирался в таймаут сокета, повторялся (retry_on_timeout) и падал с TimeoutError, а повтор
+# чтения ">" мог выдать записи в PEL и потерять ответ. Здесь таймаут больше BLOCK и без повторов
+_stream_pool = aioredis.BlockingConnectionPool.from_url(
+    os.environ.get("REDIS_URL"),
+    max_connections=2,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_STREAM_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    socket_keepalive=True,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    retry_on_timeout=False,
+    decode_responses=True,
+)
+stream_client = aioredis.Redis(connection_pool=_stream_pool)
+
+
+async def close():
+    """Закрыть соединения пулов (при остановке рантайма)"""
+    await _pool.disconnect()
+    await _stream_pool.disconnect()
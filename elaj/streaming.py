@@ -0,0 +1,168 @@
+# elaj/streaming.py
+# Потоковая доставка ответа агента в Telegram: первое сообщение уходит,
+# как только пришёл первый осмысленный кусок текста, дальше оно редактируется
+# по мере генерации не чаще EDIT_INTERVAL (лимиты Telegram на edit в одном чате).
+# Агент отвечает JSON-ом ElajReply ({"photo_urls": [...], "text": "..."}): альбом
+# отправляется, как только список photo_urls пришёл целиком, текст — по мере генерации.
+import os
+import re
+import json
+import time
+import logging
+
+from telegram.error import BadRequest, RetryAfter
+
+from elaj import metrics
+from elaj import file_ids
+from elaj import sender
+from elaj.images import filter_photo_urls
+
+logger = logging.getLogger(__name__)
+
+STREAM_REPLIES = os.environ.get("ELAJ_STREAM_REPLIES", "0") == "1"
+EDIT_INTERVAL = float(os.environ.get("ELAJ_STREAM_EDIT_INTERVAL", "1.2"))  # сек между edit
+FIRST_CHUNK_CHARS = 40       # минимальный первый кусок, чтобы не слать "Зд"
+MESSAGE_LIMIT = 4096
+CURSOR = " ▌"
+
+_URLS_RE = re.compile(r'"photo_urls"\s*:\s*(\[[^\]]*\])')
+_TEXT_RE = re.compile(r'"text"\s*:\s*"')
+_HEX = set("0123456789abcdefABCDEF")
+
+
+def _partial_json_string(raw: str) -> str:
+    """Декодировать начало JSON-строки, обрезав незавершённую escape-последовательность"""
+    i = 0
+    while i < len(raw):
+        c = raw[i]
+        if c == '"':
+            break
+        if c == "\\":
+            if i + 1 >= len(raw):
+                break
+            if raw[i + 1] == "u":
+                if i + 6 > len(raw) or not set(raw[i + 2:i + 6]) <= _HEX:
+                    break
+                i += 6
+            else:
+                i += 2
+            continue
+        i += 1
+    try:
+        return json.loads('"' + raw[:i] + '"')
+    except ValueError:
+        return ""
+
+
+def parse_partial_reply(buffer: str):
+    """
+    Разобрать недописанный JSON ответа.
+    Возвращает (photo_urls или None, если список ещё не пришёл целиком; текст, полученный к этому моменту).
+    """
+    urls = None
+    m = _URLS_RE.search(buffer)
+    if m:
+        try:
+            urls = [u for u in json.loads(m.group(1)) if isinstance(u, str)]
+        except ValueError:
+            urls = None
+    t = _TEXT_RE.search(buffer)
+    text = _partial_json_string(buffer[t.end():]) if t else ""
+    return urls, text
+
+
+class ProgressiveReply:
+    """Ответ, который отправляется и дописывается по мере стриминга"""
+
+    def __init__(self, bot, chat_id: int, reply_to_message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to = reply_to_message_id
+        self.buffer = ""
+        self.message_id = None
+        self.shown = ""
+        self.photos_sent = False
+        self.last_edit = 0.0
+        self.created = time.monotonic()
+
+    @property
+    def started(self) -> bool:
+        return self.message_id is not None or self.photos_sent
+
+    def new_turn(self):
+        """Новый ответ модели (например, после вызова инструмента) — текст начинается заново"""
+        self.buffer = ""
+
+    async def on_delta(self, delta: str):
+        self.buffer += delta
+        urls, text = parse_partial_reply(self.buffer)
+        if urls and not self.photos_sent:
+            await self._send_photos(urls)
+
+        if self.message_id is None:
+            if len(text) >= FIRST_CHUNK_CHARS or "\n" in text:
+                await self._send_first(text)
+        elif time.monotonic() - self.last_edit >= EDIT_INTERVAL:
+            await self._edit(text + CURSOR)
+
+    async def finish(self, text: str, photo_urls: list[str]):
+        """Показать окончательный текст (и фото, если стриминг их не успел отправить)"""
+        if photo_urls and not self.photos_sent:
+            await self._send_photos(photo_urls)
+
+        head, *tail = sender.split_text(text) or [""]
+        if self.message_id is None:
+            if head:
+                await self._send_first(head)
+        else:
+            await self._edit(head, final=True)
+        for chunk in tail:
+            await sender.call(self.bot.send_message, self.chat_id, text=chunk, disable_web_page_preview=True)
+
+    async def _send_photos(self, urls: list[str]):
+        self.photos_sent = True
+        # Только ссылки, прошедшие проверку (индекс каталога / кэш)
+        with metrics.span("images.filter"):
+            urls = await filter_photo_urls(urls)
+        if not urls:
+            return
+        await file_ids.send_photos(self.bot, self.chat_id, urls, reply_to_message_id=self.reply_to)
+
+    async def _send_first(self, text: str):
+        message = await sender.call(
+            self.bot.send_message, self.chat_id, text=text[:MESSAGE_LIMIT],
+            reply_to_message_id=self.reply_to, disable_web_page_preview=True
+        )
+        self.message_id = message.message_id
+        # Сколько пользователь ждал первого текста (с начала запуска агента)
+        metrics.record("reply.first_text", (time.monotonic() - self.created) * 1000)
+        self.shown = text[:MESSAGE_LIMIT]
+        self.last_edit = time.monotonic()
+
+    async def _edit(self, text: str, final: bool = False):
+        text = text[:MESSAGE_LIMIT]
+        if text == self.shown or not text.strip():
+            return
+        try:
+            if final:
+                # Окончательный текст ждёт своей очереди (elaj/sender.py)
+                await sender.call(
+                    self.bot.edit_message_text, self.chat_id, message_id=self.message_id,
+                    text=text, disable_web_page_preview=True
+                )
+                self.shown = text
+            elif await sender.acquire(self.chat_id, priority=sender.BACKGROUND, block=False):
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id, message_id=self.message_id,
+                    text=text, disable_web_page_preview=True
+                )
+                self.shown = text
+            # Иначе промежуточная правка пропускается: лимиты нужнее ответам
+        except BadRequest as e:
+            # "message is not modified" и т.п. — не повод ронять ответ
+            logger.info(f"Edit skipped for chat {self.chat_id}: {e}")
+        except RetryAfter as e:
+            if final:
+                raise
+            logger.info(f"Edit skipped for chat {self.chat_id}: {e}")
+        self.last_edit = time.monotonic()
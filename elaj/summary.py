@@ -0,0 +1,75 @@
+# elaj/summary.py
+# Скользящее резюме диалога: реплики, выпавшие из окна последних RAW_TURNS, сворачиваются
+# в короткое резюме (elaj:summary:{chat_id}, см. elaj/context.py), которое идёт в контекст
+# агента вместо старых реплик. Обновляется пачками по SUMMARY_BATCH реплик после отправки
+# ответа, дешёвой моделью; если модель недоступна — простое извлекающее резюме.
+import os
+import logging
+
+from elaj import runtime
+from elaj import metrics
+
+logger = logging.getLogger(__name__)
+
+RAW_TURNS = int(os.environ.get("ELAJ_RAW_TURNS", "4"))              # последние реплики идут в контекст как есть
+SUMMARY_BATCH = int(os.environ.get("ELAJ_SUMMARY_BATCH", "2"))      # сворачиваем не реже, чем по 2 реплики
+SUMMARY_MODEL = os.environ.get("ELAJ_SUMMARY_MODEL", "gpt-4.1-mini")  # "" — без модели
+SUMMARY_MAX_CHARS = 800
+
+SUMMARY_INSTRUCTIONS = (
+    "Вы ведёте краткое резюме переписки клиента с Эладжем, агентом по недвижимости в Аджарии. "
+    "Обновите резюме с учётом новых реплик. Сохраните: что ищет клиент, бюджет и сроки, "
+    "интересующие районы и комплексы, что уже предложено и отправлено (без URL), договорённости "
+    "и открытые вопросы. Пишите по-русски, кратко, не более 600 символов. Только текст резюме."
+)
+
+
+def unsummarized(history: list[dict], upto: float) -> list[dict]:
+    """Реплики, ещё не вошедшие в резюме"""
+    return [msg for msg in history if float(msg.get("timestamp", 0) or 0) > upto]
+
+
+def _render_turns(turns: list[dict]) -> str:
+    return "\n".join(f"{'Клиент' if msg['role'] == 'user' else 'Эладж'}: {msg['content']}" for msg in turns)
+
+
+def _extractive(previous: str, turns: list[dict]) -> str:
+    """Резюме без модели: по одной укороченной строке на реплику, самые старые вытесняются"""
+    lines = [line for line in previous.split("\n") if line] + [
+        f"{'Клиент' if msg['role'] == 'user' else 'Эладж'}: {msg['content'][:150]}" for msg in turns
+    ]
+    while lines and len("\n".join(lines)) > SUMMARY_MAX_CHARS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+async def summarize(previous: str, turns: list[dict]) -> str:
+    """Новое резюме: предыдущее + свёрнутые реплики"""
+    if not SUMMARY_MODEL:
+        return _extractive(previous, turns)
+    client = runtime.ensure_openai()
+    response = await client.responses.create(
+        model=SUMMARY_MODEL,
+        instructions=SUMMARY_INSTRUCTIONS,
+        input=f"Текущее резюме:\n{previous or '(пусто)'}\n\nНовые реплики:\n{_render_turns(turns)}",
+        max_output_tokens=400,
+        store=False,
+    )
+    metrics.record_usage(response.usage, prefix="tokens.summary")
+    return (response.output_text or "").strip()[:SUMMARY_MAX_CHARS]
+
+
+async def maybe_update(ctx) -> bool:
+    """Свернуть в резюме реплики, выпавшие из окна RAW_TURNS (если их набралось SUMMARY_BATCH)"""
+    pending = unsummarized(ctx.history, ctx.summary_upto)[:-RAW_TURNS or None]
+    if len(pending) < SUMMARY_BATCH:
+        return False
+    with metrics.span("summary.update"):
+        try:
+            text = await summarize(ctx.summary, pending)
+        except Exception as e:
+            logger.warning(f"Summary update failed for chat {ctx.chat_id}: {e}")
+            text = _extractive(ctx.summary, pending)
+        # Запишется общим ctx.commit() в конце хода
+        ctx.set_summary(text, float(pending[-1].get("timestamp", 0) or 0))
+    return True
@@ -0,0 +1,299 @@
+# elaj/worker.py
+# Воркер очереди update: читает Redis Stream через consumer group,
+# обрабатывает много чатов параллельно, сохраняя порядок сообщений внутри чата.
+# Записи подтверждаются (XACK) только после обработки, поэтому после падения
+# воркера зависшие записи забирает другой воркер (XAUTOCLAIM).
+# Записи одного чата, попавшие к разным воркерам, обрабатываются по номеру в чате
+# (elaj/queue.py); пока запись ждёт в локальной очереди, воркер продлевает её (XCLAIM),
+# чтобы её не забрал другой воркер.
+#
+# Запуск: python -m elaj.worker
+import os
+import json
+import socket
+import asyncio
+import logging
+from collections import deque
+
+import redis
+
+from elaj import runtime
+from elaj.storage import REDIS_STREAM_SOCKET_TIMEOUT, redis_client, stream_client
+from elaj.handler import handle_message_async, parse_update
+from elaj import catalog
+from elaj import coalesce
+from elaj import profile_refresh
+from elaj.queue import STREAM_KEY, STREAM_GROUP, DEAD_KEY, turn_ready, finish_turn
+from elaj.dedup import complete_update, done_updates
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("elaj.worker")
+
+# Сколько чатов обрабатываем одновременно
+WORKER_CONCURRENCY = int(os.environ.get("ELAJ_WORKER_CONCURRENCY", "32"))
+# Сколько записей читаем за один XREADGROUP
+READ_COUNT = int(os.environ.get("ELAJ_WORKER_READ_COUNT", "64"))
+# BLOCK заметно меньше таймаута сокета блокирующих чтений (elaj/storage.py)
+READ_BLOCK_MS = min(5000, int(REDIS_STREAM_SOCKET_TIMEOUT * 1000 / 3))
+# Через сколько простоя чужая неподтверждённая запись считается брошенной
+CLAIM_IDLE_MS = int(os.environ.get("ELAJ_WORKER_CLAIM_IDLE_MS", str(5 * 60 * 1000)))
+CLAIM_INTERVAL = 30
+# Сколько ждать предыдущую запись чата у другого воркера, прежде чем обработать не по порядку
+ORDER_WAIT = float(os.environ.get("ELAJ_WORKER_ORDER_WAIT", "30"))
+ORDER_POLL = 0.2
+# Обновлять профили (bot.get_chat) в этом же процессе
+PROFILE_REFRESH = os.environ.get("ELAJ_WORKER_PROFILE_REFRESH", "1") == "1"
+# После стольких неудачных обработок запись уходит в DEAD_KEY, а не возвращается снова
+MAX_ATTEMPTS = int(os.environ.get("ELAJ_WORKER_MAX_ATTEMPTS", "3"))
+# Пауза после ошибки Redis в циклах чтения (растёт вдвое до MAX_BACKOFF)
+MAX_BACKOFF = 30
+
+
+async def _backoff(name: str, error: Exception, delay: float) -> float:
+    """Переждать ошибку Redis в цикле воркера; вернуть следующую паузу"""
+    logger.warning(f"{name} failed: {error!r}, retrying in {delay:.0f}s")
+    await asyncio.sleep(delay)
+    return min(delay * 2, MAX_BACKOFF)
+
+
+class Worker:
+    def __init__(self, client, consumer: str, reader=None):
+        self.client = client
+        # Клиент для XREADGROUP BLOCK (свой таймаут сокета, см. elaj/storage.py)
+        self.reader = reader or client
+        self.consumer = consumer
+        self.semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+        # chat_id -> очередь записей этого чата (порядок внутри чата сохраняется)
+        self.chat_queues: dict[str, deque] = {}
+        # id прочитанных этим процессом и ещё не подтверждённых записей
+        self.pending: set[str] = set()
+        self.tasks: set[asyncio.Task] = set()
+        self.inflight = 0
+        self.stopping = False
+
+    async def ensure_group(self):
+        try:
+            await self.client.xgroup_create(STREAM_KEY, STREAM_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def dispatch(self, entry_id: str, fields: dict):
+        """Поставить запись в очередь её чата; для нового чата запустить обработчик"""
+        if entry_id in self.pending:
+            return  # уже ждёт в очереди чата
+        self.pending.add(entry_id)
+        chat_id = fields.get("chat_id", "")
+        self.inflight += 1
+        queue = self.chat_queues.get(chat_id)
+        if queue is None:
+            queue = self.chat_queues[chat_id] = deque()
+            task = asyncio.create_task(self.run_chat(chat_id, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        queue.append((entry_id, fields))
+
+    async def wait_turn(self, chat_id: str, fields: dict):
+        """Дождаться, пока предыдущие записи чата обработают другие воркеры (не дольше ORDER_WAIT)"""
+        waited = 0.0
+        while not await turn_ready(chat_id, fields.get("seq")):
+            if waited >= ORDER_WAIT:
+                logger.warning(f"Chat {chat_id}: update #{fields.get('seq')} waited {ORDER_WAIT}s "
+                               f"for earlier updates, processing out of order")
+                return
+            await asyncio.sleep(ORDER_POLL)
+            waited += ORDER_POLL
+
+    async def run_chat(self, chat_id: str, queue: deque):
+        """Последовательно обработать все записи одного чата"""
+        while True:
+            if not queue:
+                del self.chat_queues[chat_id]
+                return
+            # Ждём вне семафора: слоты достаются чатам, которые можно обрабатывать
+            await self.wait_turn(chat_id, queue[0][1])
+            if not coalesce.COALESCE_ENABLED:
+                await self.run_entries(self.process, [queue.popleft()])
+                continue
+
+            # Всё, что накопилось в очереди чата (в том числе пока владелец ждёт окно тишины),
+            # уходит в общий буфер чата и обрабатывается одним запуском агента.
+            # Запись, перед которой есть необработанные чужие, остаётся до следующего круга
+            taken = []
+
+            async def refill():
+                while queue and (not taken or await turn_ready(chat_id, queue[0][1].get("seq"))):
+                    entry_id, fields = queue.popleft()
+                    taken.append((entry_id, fields))
+                    await self.push(fields)
+                    await finish_turn(chat_id, fields.get("seq"))
+
+            async def process_batch(_fields):
+                await refill()
+                await coalesce.process_pending(chat_id, refill=refill)
+
+            await self.run_entries(process_batch, taken)
+
+    async def run_entries(self, process, entries: list):
+        """Выполнить обработку и подтвердить записи (entries может пополняться во время обработки).
+        После ошибки записи не подтверждаются: их повторит claim_loop (до MAX_ATTEMPTS раз)"""
+        first = entries[0][1] if entries else None
+        error = None
+        try:
+            async with self.semaphore:
+                await process(first)
+        except Exception as e:
+            error = e
+            logger.error(f"Updates {[entry_id for entry_id, _ in entries]} failed: {e}")
+        finally:
+            for entry_id, fields in entries:
+                # Очередь чата идёт дальше и после ошибки: повтор не держит следующие сообщения
+                await finish_turn(fields.get("chat_id"), fields.get("seq"))
+                if error is None:
+                    await self.complete(fields)
+                    await self.client.xack(STREAM_KEY, STREAM_GROUP, entry_id)
+                elif await self.dead_letter(entry_id, fields, error):
+                    await self.client.xack(STREAM_KEY, STREAM_GROUP, entry_id)
+                self.pending.discard(entry_id)
+                self.inflight -= 1
+
+    async def dead_letter(self, entry_id: str, fields: dict, error: Exception) -> bool:
+        """Переложить запись в DEAD_KEY, если попытки исчерпаны; False — оставить на повтор.
+        Без XACK запись остаётся в PEL, а update — занятым в dedup: повтор Telegram не продублирует её"""
+        try:
+            rows = await self.client.xpending_range(STREAM_KEY, STREAM_GROUP, min=entry_id, max=entry_id, count=1)
+            attempts = int(rows[0]["times_delivered"]) if rows else MAX_ATTEMPTS
+            if attempts < MAX_ATTEMPTS:
+                logger.warning(f"Update {entry_id} will be retried (attempt {attempts}/{MAX_ATTEMPTS})")
+                return False
+            await self.client.xadd(
+                DEAD_KEY, {**fields, "entry_id": entry_id, "error": repr(error)[:500]}, maxlen=1000, approximate=True,
+            )
+        except Exception as e:
+            logger.warning(f"Dead-letter check for {entry_id} failed: {e}")
+            return False
+        logger.error(f"Update {entry_id} failed {attempts} times, moved to {DEAD_KEY}")
+        return True
+
+    async def push(self, fields: dict):
+        args = parse_update(json.loads(fields["update"]))
+        if args:
+            await coalesce.push_message(**args)
+
+    async def process(self, fields: dict):
+        args = parse_update(json.loads(fields["update"]))
+        if args:
+            await handle_message_async(**args)
+
+    @staticmethod
+    def update_id(fields: dict):
+        try:
+            return json.loads(fields["update"]).get("update_id")
+        except Exception:
+            return None
+
+    async def complete(self, fields: dict):
+        # update_id занят webhook-ом при постановке в очередь (elaj/dedup.py)
+        await complete_update(self.update_id(fields))
+
+    async def read_loop(self):
+        delay = 1.0
+        while not self.stopping:
+            # Не набираем больше, чем успеваем обработать
+            if self.inflight >= WORKER_CONCURRENCY * 4:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                response = await self.reader.xreadgroup(
+                    STREAM_GROUP, self.consumer, {STREAM_KEY: ">"},
+                    count=READ_COUNT, block=READ_BLOCK_MS,
+                )
+            except Exception as e:
+                # Разрыв соединения/таймаут Redis не должен останавливать воркер
+                delay = await _backoff("Stream read", e, delay)
+                continue
+            delay = 1.0
+            for _stream, entries in response or []:
+                for entry_id, fields in entries:
+                    self.dispatch(entry_id, fields)
+
+    async def touch_pending(self):
+        """Сбросить простой своих записей, ждущих в очередях чатов, — иначе через CLAIM_IDLE_MS
+        их заберёт другой воркер и обработает второй раз"""
+        ids = list(self.pending)
+        for start in range(0, len(ids), 500):
+            await self.client.xclaim(
+                STREAM_KEY, STREAM_GROUP, self.consumer, 0, ids[start:start + 500], justid=True,
+            )
+
+    async def claim_loop(self):
+        """Забирать записи, зависшие у упавших воркеров"""
+        delay = 1.0
+        while not self.stopping:
+            try:
+                await self.claim_pass()
+            except Exception as e:
+                delay = await _backoff("Stream claim", e, delay)
+                continue
+            delay = 1.0
+            await asyncio.sleep(CLAIM_INTERVAL)
+
+    async def claim_pass(self):
+        """Один проход: продлить свои записи и забрать брошенные чужие"""
+        await self.touch_pending()
+        start_id = "0-0"
+        while True:
+            result = await self.client.xautoclaim(
+                STREAM_KEY, STREAM_GROUP, self.consumer,
+                min_idle_time=CLAIM_IDLE_MS, start_id=start_id, count=READ_COUNT,
+            )
+            start_id = result[0]
+            # Свои записи, ждущие в очереди чата, не брошены
+            entries = [(entry_id, fields) for entry_id, fields in result[1] if entry_id not in self.pending]
+            done = await done_updates([self.update_id(fields) for _, fields in entries if fields])
+            for entry_id, fields in entries:
+                if not fields:  # запись могла быть вытеснена MAXLEN
+                    await self.client.xack(STREAM_KEY, STREAM_GROUP, entry_id)
+                elif self.update_id(fields) in done:
+                    # Обработана, но не подтверждена (воркер упал до XACK)
+                    logger.info(f"Reclaimed update {entry_id} is already done, acknowledging")
+                    await finish_turn(fields.get("chat_id"), fields.get("seq"))
+                    await self.client.xack(STREAM_KEY, STREAM_GROUP, entry_id)
+                else:
+                    logger.info(f"Reclaimed update {entry_id}")
+                    self.dispatch(entry_id, fields)
+            if start_id in ("0-0", b"0-0"):
+                break
+
+    async def drain(self):
+        """Дождаться обработки уже прочитанных записей"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+async def main():
+    await runtime.attach()
+    # Скачивание и разбор каталога — в отдельном потоке, до начала обработки
+    await asyncio.to_thread(catalog.preload)
+    worker = Worker(redis_client, consumer=f"{socket.gethostname()}-{os.getpid()}", reader=stream_client)
+    await worker.ensure_group()
+    logger.info(f"Worker {worker.consumer} started (concurrency={WORKER_CONCURRENCY})")
+    try:
+        loops = [worker.read_loop(), worker.claim_loop()]
+        if PROFILE_REFRESH:
+            loops.append(profile_refresh.refresh_loop())
+        await asyncio.gather(*loops)
+    finally:
+        worker.stopping = True
+        await worker.drain()
+        await runtime.aclose()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
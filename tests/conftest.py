@@ -0,0 +1,29 @@
+# tests/conftest.py
+# Окружение тестов: in-memory Redis (fakeredis) вместо REDIS_URL, без внешних вызовов.
+# Подмена storage.redis_client — до импорта остальных модулей elaj (как в bench/load.py).
+import os
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ["OPENAI_AGENTS_DISABLE_TRACING"] = "1"
+os.environ["ELAJ_STREAM_REPLIES"] = "0"
+os.environ["ELAJ_SUMMARY_MODEL"] = ""
+os.environ["ELAJ_ROUTER_MODEL"] = ""
+
+import fakeredis
+import pytest
+
+from elaj import storage
+
+_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+storage.redis_client = _client
+storage._pool = _client.connection_pool
+
+
+@pytest.fixture
+def redis():
+    """Чистый in-memory Redis; корутины выполняются в event loop рантайма"""
+    from elaj import runtime
+    runtime.run(_client.flushdb())
+    return _client
@@ -0,0 +1,35 @@
+from api import log_event
+from elaj import analytics, runtime
+
+
+def _log(user_id, event_type, **details):
+    status, _ = runtime.run(log_event.log_event({"user_id": user_id, "event_type": event_type, "details": details}))
+    assert status == 200
+
+
+def test_district_key_and_name_events_share_one_funnel_scope(redis):
+    # Одно событие с ключом и именем — по нему имя связывается с ключом
+    _log(2, "focus_district", district_key="new_boulevard", district_name="Новый бульвар")
+    _log(1, "focus_district", district_key="new_boulevard")
+    _log(1, "open_estate", estate_name="Orbi City", district_name="Новый бульвар")
+    _log(2, "open_estate", estate_name="Orbi City", district="новый  Бульвар")
+
+    for district in ("Новый бульвар", "new_boulevard"):
+        result = runtime.run(analytics.report(district=district))
+        scope = result["district"]
+        assert scope["events"] == {"focus_district": 2, "open_estate": 2}
+        assert scope["unique_users"] == 2
+        assert scope["funnel"]["focus_district>open_estate"]["count"] == 2
+    assert result["top"]["districts"] == [{"name": "new_boulevard", "events": 4}]
+
+
+def test_district_name_without_known_key_is_normalized(redis):
+    status, body = runtime.run(log_event.log_events_batch([
+        {"user_id": 3, "event_type": "focus_district", "details": {"district_name": "Old Town"}},
+        {"user_id": 3, "event_type": "open_estate", "details": {"estate_name": "X", "district": "old town"}},
+    ]))
+    assert status == 200 and body["accepted"] == 2
+
+    scope = runtime.run(analytics.report(district="Old Town"))["district"]
+    assert scope["events"] == {"focus_district": 1, "open_estate": 1}
+    assert scope["funnel"]["focus_district>open_estate"]["count"] == 1
@@ -0,0 +1,45 @@
+from elaj import catalog
+
+CATALOG_MD = """# District: Батуми
+Новый бульвар у моря
+## Estate: Orbi City
+"description": "вид на море", "url": "https://example.com/orbi.jpg"
+"""
+
+
+def _reset(monkeypatch, tmp_path):
+    monkeypatch.setattr(catalog, "CATALOG_PATH", str(tmp_path / "missing.md"))
+    monkeypatch.setattr(catalog, "CATALOG_CACHE_PATH", str(tmp_path / "cache.md"))
+    monkeypatch.setattr(catalog, "CATALOG_URL", "https://example.com/catalog.md")
+    monkeypatch.setattr(catalog, "_catalog", None)
+    monkeypatch.setattr(catalog, "_fetched_path", None)
+    monkeypatch.setattr(catalog, "_fetch_attempted", False)
+
+
+def test_catalog_available_never_downloads(monkeypatch, tmp_path):
+    _reset(monkeypatch, tmp_path)
+
+    def fetch(url, dest):
+        raise AssertionError("catalog_available must not download")
+
+    monkeypatch.setattr(catalog, "fetch_catalog", fetch)
+    assert not catalog.catalog_available()
+    assert catalog.catalog_source().startswith("hosted FileSearchTool")
+
+
+def test_preload_downloads_and_parses_once(monkeypatch, tmp_path):
+    _reset(monkeypatch, tmp_path)
+    calls = []
+
+    def fetch(url, dest):
+        calls.append(url)
+        with open(dest, "w", encoding="utf-8") as f:
+            f.write(CATALOG_MD)
+        return dest
+
+    monkeypatch.setattr(catalog, "fetch_catalog", fetch)
+    assert catalog.preload()
+    assert catalog.preload()
+    assert calls == ["https://example.com/catalog.md"]
+    assert catalog.catalog_available()
+    assert [node.name for node in catalog.get_catalog().search("Orbi", limit=1)] == ["Orbi City"]
@@ -0,0 +1,31 @@
+
+from elaj import coalesce, runtime
+
+
+def _push(chat_id, text, message_id):
+    return coalesce.push_message(chat_id, text, message_id, {"id": chat_id})
+
+
+def test_single_message_is_not_delayed(redis, monkeypatch):
+    monkeypatch.setattr(coalesce, "COALESCE_WINDOW", 1.0)
+    runtime.run(_push(1, "привет", 1))
+    assert runtime.run(coalesce._wait_quiet(1, None)) < 200
+
+
+def test_burst_waits_for_quiet_window(redis, monkeypatch):
+    monkeypatch.setattr(coalesce, "COALESCE_WINDOW", 0.3)
+    handled = []
+
+    async def fake_handle(**args):
+        handled.append(args)
+
+    monkeypatch.setattr(coalesce, "handle_message_async", fake_handle)
+
+    async def burst():
+        await _push(2, "есть квартиры", 1)
+        await _push(2, "у моря?", 2)
+        await coalesce.process_pending(2)
+
+    runtime.run(burst())
+    assert [args["text"] for args in handled] == ["есть квартиры\nу моря?"]
+    assert handled[0]["coalesce_wait_ms"] >= 250
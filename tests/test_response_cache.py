@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+from elaj import handler
+from elaj import runtime
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent), photo=None)
+
+    async def send_chat_action(self, chat_id, action):
+        return True
+
+
+def _user(chat_id):
+    return {"id": chat_id, "first_name": f"User{chat_id}", "username": f"user{chat_id}", "language_code": "ru"}
+
+
+def test_repeated_faq_question_with_profile_hits_cache(redis, monkeypatch):
+    bot = FakeBot()
+    runs = []
+
+    async def get_bot():
+        return bot
+
+    async def run_agent(input_text, previous_response_id, reply=None):
+        runs.append((input_text, previous_response_id))
+        return {"output_text": "Да, рассрочка есть.", "photo_urls": [], "response_id": f"resp_{len(runs)}"}
+
+    monkeypatch.setattr(runtime, "get_bot", get_bot)
+    monkeypatch.setattr(handler, "run_agent", run_agent)
+
+    question = "Можно ли купить в рассрочку?"
+    runtime.run(handler.handle_message_async(101, question, 1, _user(101)))
+    runtime.run(handler.handle_message_async(202, question, 1, _user(202)))
+    runtime.run(handler.handle_message_async(101, "можно ли купить в рассрочку", 2, _user(101)))
+
+    # Агент запускался один раз, и без профиля и цепочки диалога первого пользователя
+    assert len(runs) == 1
+    input_text, previous_response_id = runs[0]
+    assert previous_response_id is None
+    assert "Профиль пользователя" not in input_text and "User101" not in input_text
+    assert [text for _chat, text in bot.sent] == ["Да, рассрочка есть."] * 3
+    assert runtime.run(redis.hget("elaj:rcache:stats", "hits")) == "2"
+
+
+def test_question_referring_to_conversation_is_not_cached(redis, monkeypatch):
+    bot = FakeBot()
+    runs = []
+
+    async def get_bot():
+        return bot
+
+    async def run_agent(input_text, previous_response_id, reply=None):
+        runs.append(input_text)
+        return {"output_text": "Ответ.", "photo_urls": [], "response_id": None}
+
+    monkeypatch.setattr(runtime, "get_bot", get_bot)
+    monkeypatch.setattr(handler, "run_agent", run_agent)
+
+    for chat_id in (303, 404):
+        runtime.run(handler.handle_message_async(chat_id, "А там есть рассрочка?", 1, _user(chat_id)))
+
+    assert len(runs) == 2
+    assert "Профиль пользователя" in runs[0]
+    assert runtime.run(redis.hgetall("elaj:rcache:stats")) == {}
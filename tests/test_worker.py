@@ -0,0 +1,76 @@
+import asyncio
+
+from elaj import runtime
+from elaj import worker as worker_module
+from elaj.queue import STREAM_KEY, STREAM_GROUP, enqueue_update
+
+
+class FlakyReader:
+    """XREADGROUP, который сначала падает по таймауту, потом отдаёт записи из настоящего клиента"""
+
+    def __init__(self, client, failures: int):
+        self.client = client
+        self.failures = failures
+
+    async def xreadgroup(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise TimeoutError("Timeout reading from socket")
+        kwargs["block"] = None
+        return await self.client.xreadgroup(*args, **kwargs)
+
+
+def test_read_loop_survives_redis_errors(redis, monkeypatch):
+    monkeypatch.setattr(worker_module, "_backoff", _no_backoff)
+
+    async def scenario():
+        worker = worker_module.Worker(redis, "test", reader=FlakyReader(redis, failures=2))
+        await worker.ensure_group()
+        await enqueue_update({"update_id": 1}, 7)
+        dispatched = []
+        worker.dispatch = lambda entry_id, fields: (dispatched.append(entry_id), setattr(worker, "stopping", True))
+        await asyncio.wait_for(worker.read_loop(), timeout=5)
+        return dispatched
+
+    assert len(runtime.run(scenario())) == 1
+
+
+async def _no_backoff(name, error, delay):
+    await asyncio.sleep(0)
+    return delay
+
+
+def test_failed_update_is_retried_then_dead_lettered(redis, monkeypatch):
+    monkeypatch.setattr(worker_module, "CLAIM_IDLE_MS", 0)
+    monkeypatch.setattr(worker_module.coalesce, "COALESCE_ENABLED", False)
+
+    async def scenario():
+        worker = worker_module.Worker(redis, "test")
+        await worker.ensure_group()
+        await redis.set("elaj:update:1", "inflight")
+        await enqueue_update({"update_id": 1}, 7)
+        await enqueue_update({"update_id": 2}, 7)
+        attempts = []
+
+        async def process(fields):
+            attempts.append(fields["seq"])
+            if fields["seq"] == "1":
+                raise RuntimeError("agent down")
+
+        worker.process = process
+        response = await redis.xreadgroup(STREAM_GROUP, "test", {STREAM_KEY: ">"}, count=10)
+        for entry_id, fields in response[0][1]:
+            worker.dispatch(entry_id, fields)
+        await worker.drain()
+        # Первая не подтверждена и не отмечена обработанной, вторая не ждала её
+        first = (await redis.xpending(STREAM_KEY, STREAM_GROUP))["pending"]
+        state = await redis.get("elaj:update:1")
+        for _ in range(worker_module.MAX_ATTEMPTS - 1):
+            await worker.claim_pass()
+            await worker.drain()
+        return attempts, first, state, await redis.xpending(STREAM_KEY, STREAM_GROUP), await redis.xlen(worker_module.DEAD_KEY)
+
+    attempts, first, state, pending, dead = runtime.run(scenario())
+    assert attempts == ["1", "2", "1", "1"]
+    assert first == 1 and state == "inflight"
+    assert pending["pending"] == 0 and dead == 1